@@ -1,9 +1,9 @@
 # ConvLSTM architecture
 import torch
-import torch.nn.functional as F
 import torch.nn as nn
 
 from activations import Hardsigmoid,SatLU
+from fused_lstm import fused_acts, fused_lstm_update, stacked_conv
 from utils import *
 
 class ConvLSTMCell(nn.Module):
@@ -20,7 +20,9 @@ class ConvLSTMCell(nn.Module):
     input.
     """
     def __init__(self, in_channels, hidden_channels, kernel_size,
-                 LSTM_act, LSTM_c_act, out_act, bias=True, FC=False):
+                 LSTM_act, LSTM_c_act, out_act, bias=True, FC=False,
+                 fused_gates=False, cell_type='dense', cell_groups=4,
+                 cell_reduction=4):
         super(ConvLSTMCell, self).__init__()
         self.in_channels = in_channels
         self.hidden_channels = hidden_channels
@@ -33,80 +35,107 @@ class ConvLSTMCell(nn.Module):
         self.LSTM_c_act = get_activation(LSTM_c_act)
         self.out_act = get_activation(out_act)
 
+        # Fused gate update (C-dependent gates of FC cells can't be fused)
+        self.fused_gates = fused_gates and not FC
+        if self.fused_gates:
+            msg = "fused_gates needs dense gate convs"
+            assert cell_type == 'dense', msg
+            msg = "fused_gates supports activations %s" % fused_acts
+            assert LSTM_act in fused_acts and LSTM_c_act in fused_acts, msg
+            self.fused_acts = (LSTM_act,LSTM_c_act,LSTM_act) # gate,cell,out
+
         self.stride = 1 # Stride always 1 for simplicity
         self.dilation = 1 # Dilation always 1 for simplicity
-        _pad = 0 # Padding done manually in forward()
-        self.groups = 1 # Groups always 1 for simplicity
+        self.cell_type = cell_type # convs of gates (see gate_conv)
+        self.cell_groups = cell_groups # groups of 'grouped' cells
+        self.cell_reduction = cell_reduction # reduction of 'bottleneck' cells
+        # Padding done by the convs if symmetric, otherwise manually in
+        # forward() (same H,W)
+        _pad,self.padding = get_conv_pad(kernel_size)
 
         # Convolutional layers
-        self.Wxi = nn.Conv2d(in_channels,hidden_channels,kernel_size,
-                             self.stride,_pad,self.dilation,
-                             self.groups,self.bias)
-        self.Whi = nn.Conv2d(hidden_channels,hidden_channels,
-                             kernel_size,self.stride,_pad,
-                             self.dilation,self.groups,self.bias)
-        self.Wxf = nn.Conv2d(in_channels,hidden_channels,kernel_size,
-                             self.stride,_pad,self.dilation,
-                             self.groups,self.bias)
-        self.Whf = nn.Conv2d(hidden_channels,hidden_channels,
-                             kernel_size,self.stride,_pad,
-                             self.dilation,self.groups,self.bias)
-        self.Wxc = nn.Conv2d(in_channels,hidden_channels,kernel_size,
-                             self.stride,_pad,self.dilation,
-                             self.groups,self.bias)
-        self.Whc = nn.Conv2d(hidden_channels,hidden_channels,
-                             kernel_size,self.stride,_pad,
-                             self.dilation,self.groups,self.bias)
-        self.Wxo = nn.Conv2d(in_channels,hidden_channels,kernel_size,
-                             self.stride,_pad,self.dilation,
-                             self.groups,self.bias)
-        self.Who = nn.Conv2d(hidden_channels,hidden_channels,
-                             kernel_size,self.stride,_pad,
-                             self.dilation,self.groups,self.bias)
+        self.Wxi = gate_conv(in_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
+        self.Whi = gate_conv(hidden_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
+        self.Wxf = gate_conv(in_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
+        self.Whf = gate_conv(hidden_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
+        self.Wxc = gate_conv(in_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
+        self.Whc = gate_conv(hidden_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
+        self.Wxo = gate_conv(in_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
+        self.Who = gate_conv(hidden_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
 
         # Extra layers for fully connected
         if FC:
-            self.Wci = nn.Conv2d(hidden_channels,hidden_channels,kernel_size,
-                                 self.stride,_pad,self.dilation,
-                                 self.groups,self.bias)
-            self.Wcf = nn.Conv2d(hidden_channels,hidden_channels,kernel_size,
-                                 self.stride,_pad,self.dilation,
-                                 self.groups,self.bias)
-            self.Wco = nn.Conv2d(hidden_channels,hidden_channels,kernel_size,
-                                 self.stride,_pad,self.dilation,
-                                 self.groups,self.bias)
+            self.Wci = gate_conv(hidden_channels,hidden_channels,kernel_size,
+                                 _pad,self.bias,cell_type,cell_groups,
+                                 cell_reduction)
+            self.Wcf = gate_conv(hidden_channels,hidden_channels,kernel_size,
+                                 _pad,self.bias,cell_type,cell_groups,
+                                 cell_reduction)
+            self.Wco = gate_conv(hidden_channels,hidden_channels,kernel_size,
+                                 _pad,self.bias,cell_type,cell_groups,
+                                 cell_reduction)
         # 1 x 1 convolution for output
         self.out = nn.Conv2d(hidden_channels,in_channels,1,1,0,1,1)
 
-    def forward(self, X_t, hidden):
+    def forward(self, X_t, hidden, input_cache=None):
         H_tm1, C_tm1 = hidden
 
+        # Convs of X_t are reused from input_cache if it has them (same
+        # input as on the previous step)
+        if input_cache is not None and 'x' in input_cache:
+            x_gates = input_cache['x']
+        else:
+            x_gates = self.input_convs(X_t)
+            if input_cache is not None:
+                input_cache['x'] = x_gates
+
         # Manual zero-padding to make H,W same
-        in_height = X_t.shape[-2]
-        in_width = X_t.shape[-1]
-        padding = get_pad_same(in_height,in_width,self.kernel_size)
-        X_t_pad = F.pad(X_t,padding)
-        H_tm1_pad = F.pad(H_tm1,padding)
-        C_tm1_pad = F.pad(C_tm1,padding)
-
-        if not self.FC:
-            i_t = self.LSTM_act(self.Wxi(X_t_pad) + self.Whi(H_tm1_pad))
-            f_t = self.LSTM_act(self.Wxf(X_t_pad) + self.Whf(H_tm1_pad))
-            C_t = f_t*C_tm1 + i_t*self.LSTM_c_act(self.Wxc(X_t_pad) + self.Whc(H_tm1_pad))
-            o_t = self.LSTM_act(self.Wxo(X_t_pad) + self.Who(H_tm1_pad))
+        padding = self.padding
+        H_tm1_pad = pad_same(H_tm1,padding)
+        C_tm1_pad = pad_same(C_tm1,padding)
+
+        if self.fused_gates:
+            # Pre-activations of all gates from two convs, then one fused
+            # elementwise update
+            W_h = (self.Whi,self.Whf,self.Whc,self.Who)
+            gates = x_gates[0] + stacked_conv(H_tm1_pad,W_h)
+            H_t,C_t = fused_lstm_update(gates,C_tm1,*self.fused_acts)
+        elif not self.FC:
+            x_i,x_f,x_c,x_o = x_gates
+            i_t = self.LSTM_act(x_i + self.Whi(H_tm1_pad))
+            f_t = self.LSTM_act(x_f + self.Whf(H_tm1_pad))
+            C_t = f_t*C_tm1 + i_t*self.LSTM_c_act(x_c + self.Whc(H_tm1_pad))
+            o_t = self.LSTM_act(x_o + self.Who(H_tm1_pad))
             H_t = o_t*self.LSTM_act(C_t)
         else:
-            i_t = self.Wxi(X_t_pad) + self.Whi(H_tm1_pad) + self.Wci(C_tm1_pad)
+            x_i,x_f,x_c,x_o = x_gates
+            i_t = x_i + self.Whi(H_tm1_pad) + self.Wci(C_tm1_pad)
             i_t = self.LSTM_act(i_t)
 
-            f_t = self.Wxf(X_t_pad) + self.Whf(H_tm1_pad) + self.Wcf(C_tm1_pad)
+            f_t = x_f + self.Whf(H_tm1_pad) + self.Wcf(C_tm1_pad)
             f_t = self.LSTM_act(f_t)
 
-            C_t = self.Wxc(X_t_pad) + self.Whc(H_tm1_pad)
+            C_t = x_c + self.Whc(H_tm1_pad)
             C_t = f_t*C_tm1 + i_t*self.LSTM_c_act(C_t)
-            C_t_pad = F.pad(C_t,padding)
+            C_t_pad = pad_same(C_t,padding)
 
-            o_t = self.Wxo(X_t_pad) + self.Who(H_tm1_pad) + self.Wco(C_t_pad)
+            o_t = x_o + self.Who(H_tm1_pad) + self.Wco(C_t_pad)
             o_t = self.LSTM_act(o_t)
 
             H_t = o_t*self.LSTM_act(C_t)
@@ -118,10 +147,20 @@ class ConvLSTMCell(nn.Module):
 
         return R_t, (H_t,C_t)
 
+    def input_convs(self, X_t):
+        # Input-side convs of all gates (one stacked conv if fused_gates)
+        X_t_pad = pad_same(X_t,self.padding)
+        if self.fused_gates:
+            W_x = (self.Wxi,self.Wxf,self.Wxc,self.Wxo)
+            return (stacked_conv(X_t_pad,W_x),)
+        return (self.Wxi(X_t_pad),self.Wxf(X_t_pad),self.Wxc(X_t_pad),
+                self.Wxo(X_t_pad))
+
 class ConvLSTM(nn.Module):
     def __init__(self, in_channels, hidden_channels, kernel_size,
                  LSTM_act, LSTM_c_act, out_act, bias=True, FC=False,
-                 device='cpu'):
+                 device='cpu', fused_gates=False, static_input='never',
+                 R_cell_type='dense', R_cell_groups=4, R_cell_reduction=4):
         super(ConvLSTM,self).__init__()
         self.in_channels = in_channels
         self.hidden_channels = hidden_channels
@@ -132,10 +171,18 @@ class ConvLSTM(nn.Module):
         self.bias = bias
         self.FC = FC # use fully connected ConvLSTM
         self.device = device
+        self.fused_gates = fused_gates
+        self.static_input = static_input # reuse input convs if unchanged
+        self.R_cell_type = R_cell_type # gate convs of the cell (gate_conv)
+        self.R_cell_groups = R_cell_groups
+        self.R_cell_reduction = R_cell_reduction
 
         self.cell = ConvLSTMCell(in_channels, hidden_channels, kernel_size,
                                  LSTM_act, LSTM_c_act, out_act,
-                                 bias=True, FC=False)
+                                 bias=True, FC=False, fused_gates=fused_gates,
+                                 cell_type=R_cell_type,
+                                 cell_groups=R_cell_groups,
+                                 cell_reduction=R_cell_reduction)
 
     def forward(self,X):
         # Get initial states
@@ -144,10 +191,16 @@ class ConvLSTM(nn.Module):
         # Loop through image sequence
         preds = []
         seq_len = X.shape[1]
+        static_input = self.static_input
+        if not input_cache_exact(self):
+            static_input = 'never'
+        input_cache = None
         for t in range(seq_len-1): # last image not used for prediction
             X_t = X[:,t,:,:,:] # X dims: (batch,len,channels,height,width)
+            if static_input != 'never' and not reuse_input(X,t,static_input):
+                input_cache = {} # new input: recompute and cache
 
-            R_t,(H_t,C_t) = self.cell(X_t,(H_tm1,C_tm1))
+            R_t,(H_t,C_t) = self.cell(X_t,(H_tm1,C_tm1),input_cache)
 
             # Update
             preds.append(R_t.unsqueeze(1))
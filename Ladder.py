@@ -3,6 +3,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 
 from activations import Hardsigmoid, SatLU
 from utils import *
@@ -41,6 +42,8 @@ class LAhatCell(nn.Module):
         conv_dilation = 1 # always 1 for simplicity
         conv_groups = 1 # always 1 for simplicity
         conv1x1_kernel_size = 1 # used for 1x1 convolutional layers
+        # padding done by conv if symmetric, otherwise manually (same H,W)
+        same_pad_,self.padding = get_conv_pad(conv_kernel_size)
 
         # Parameters
         # Standard convolutional layer for Ahat_lp1
@@ -49,7 +52,7 @@ class LAhatCell(nn.Module):
                 self.BN = nn.BatchNorm2d(Ahat_in_channels)
             self.conv = nn.Conv2d(Ahat_in_channels,out_channels,
                                   conv_kernel_size,conv_stride,
-                                  conv_pad_,conv_dilation,conv_groups,
+                                  same_pad_,conv_dilation,conv_groups,
                                   conv_bias)
         # (1,1) convolutional layer for (Ahat,R)
         if no_R:
@@ -79,10 +82,7 @@ class LAhatCell(nn.Module):
             if self.use_BN:
                 Ahat_lp1 = self.BN(Ahat_lp1)
             Ahat_lp1 = self.out_act(Ahat_lp1)
-            in_height = Ahat_lp1.shape[2]
-            in_width = Ahat_lp1.shape[3]
-            padding = get_pad_same(in_height,in_width,self.conv_kernel_size)
-            Ahat_lp1 = F.pad(Ahat_lp1,padding)
+            Ahat_lp1 = pad_same(Ahat_lp1,self.padding)
             Ahat_lp1 = self.conv(Ahat_lp1)
             Ahat_lp1 = self.out_act(Ahat_lp1)
         # 1x1 convolution for (Ahat,R)
@@ -111,7 +111,10 @@ class LadderNet(nn.Module):
                  satlu_act,error_act,LSTM_act,LSTM_c_act,bias=True,
                  use_1x1_out=False,FC=True,no_R0=True,no_skip0=True,
                  no_A_conv=False,higher_satlu=False,local_grad=False,
-                 output='error',device='cpu'):
+                 output='error',device='cpu',grad_checkpoint=0,
+                 memory_format='contiguous',fused_gates=False,
+                 static_input='never',R_cell_type='dense',R_cell_groups=4,
+                 R_cell_reduction=4):
         super(LadderNet,self).__init__()
         self.in_channels = in_channels
         self.stack_sizes = stack_sizes
@@ -138,6 +141,13 @@ class LadderNet(nn.Module):
         self.local_grad = local_grad # gradients only broadcasted within layers
         self.output = output
         self.device = device
+        self.grad_checkpoint = grad_checkpoint # time steps per checkpoint
+        self.memory_format = get_memory_format(memory_format) # of all convs
+        self.fused_gates = fused_gates # fused gate update in R cells
+        self.static_input = static_input # reuse encoder if input unchanged
+        self.R_cell_type = R_cell_type # gate convs of R cells (gate_conv)
+        self.R_cell_groups = R_cell_groups
+        self.R_cell_reduction = R_cell_reduction
 
         # local gradients means no convolution in A, stack sizes is fixed
         if no_A_conv:
@@ -180,7 +190,10 @@ class LadderNet(nn.Module):
             kernel_size = R_kernel_sizes[l]
             cell = RCell(in_channels,out_channels,kernel_size,
                          LSTM_act,LSTM_c_act,
-                         is_last,self.bias,use_1x1_out,FC,False)
+                         is_last,self.bias,use_1x1_out,FC,False,
+                         fused_gates=fused_gates,cell_type=R_cell_type,
+                         cell_groups=R_cell_groups,
+                         cell_reduction=R_cell_reduction)
             R_layers.append(cell)
         self.R_layers = nn.ModuleList(R_layers)
 
@@ -221,94 +234,174 @@ class LadderNet(nn.Module):
         # E cells: subtract, ReLU, cat
         self.E_layer = ECell(error_act) # general: same for all layers
 
-    def forward(self,X):
-        # Get initial states
-        (H_tm1,C_tm1) = self.initialize(X)
+        # Conv weights (here) and states (in initialize) are converted to the
+        # memory format once. All intermediates then stay in that format.
+        self.to(memory_format=self.memory_format)
 
-        outputs = []
-        Ahat_t = [None] * self.nb_layers
+    @property
+    def output(self):
+        return self._output
 
-        # Loop through image sequence
+    @output.setter
+    def output(self,output):
+        # One of 'error','pred','rep', or a collection of them (forward then
+        # returns a dict of all of them from one pass). What the time loop
+        # records is resolved once here, rather than every step.
+        self._output = output
+        outputs = get_outputs(output)
+        self.record_errors = 'error' in outputs
+        self.record_preds = 'pred' in outputs
+        self.record_reps = 'rep' in outputs
+
+    def forward(self,X,hidden=None,return_hidden=False):
+        # Get initial states, or continue from states carried over from the
+        # previous chunk of the same sequence (truncated BPTT). States are
+        # ((H,C),Ahat), with no predictions (Ahat = None) at the start.
+        X = sequence_to_memory_format(X,self.memory_format)
+        continued = hidden is not None
+        if not continued:
+            hidden = (self.initialize(X),None)
+
+        preds = []
+        if continued and self.record_preds:
+            preds.append(hidden[1][0]) # prediction of first image in chunk
+
+        # Loop through image sequence in segments. With grad_checkpoint > 0,
+        # each segment of that many time steps only keeps its input states
+        # for backward, and its activations are recomputed.
         seq_len = X.shape[1]
-        for t in range(seq_len):
-            # Initialize list of states with consistent indexing
-            R_t = [None] * self.nb_layers
-            H_t = [None] * self.nb_layers
-            C_t = [None] * self.nb_layers
-            E_t = [None] * self.nb_layers
-            A_t = [None] * self.nb_layers
+        use_checkpoint = self.grad_checkpoint > 0 and torch.is_grad_enabled()
+        seg_len = self.grad_checkpoint if use_checkpoint else seq_len
+        errors = []
+        for t0 in range(0,seq_len,seg_len):
+            X_seg = X[:,t0:t0+seg_len] # X dims: (batch,len,channels,H,W)
+            record_first = continued or t0 > 0 # first time step doesn't count
+            if use_checkpoint:
+                segment = torch.utils.checkpoint.checkpoint(self.run_steps,
+                                                            X_seg,hidden,
+                                                            record_first,
+                                                            use_reentrant=False)
+            else:
+                segment = self.run_steps(X_seg,hidden,record_first)
+            seg_errors,seg_preds,reps,hidden = segment
+            errors += seg_errors
+            preds += seg_preds
+
+        # Errors and Preds returned as tensors
+        outputs = {}
+        if self.record_errors:
+            errors_t = torch.stack(errors) # (recorded steps,nb_layers)
+            n_missing = seq_len - len(errors) # rows of zeros up to seq_len
+            outputs['error'] = F.pad(errors_t,(0,0,0,n_missing))
+        if self.record_preds:
+            preds = preds[:-1] # last prediction is about the next chunk
+            preds_t = torch.stack(preds,dim=1) # (batch,len,in_channels,H,W)
+            outputs['pred'] = preds_t.contiguous()
+        # reps returned as list of tensors (last time step only)
+        if self.record_reps:
+            if self.no_R0:
+                outputs['rep'] = [R_l.contiguous() for R_l in reps[1:]]
+            else:
+                outputs['rep'] = [R_l.contiguous() for R_l in reps]
+        outputs_t = select_outputs(outputs,self.output)
+        if return_hidden:
+            return outputs_t, hidden
+        return outputs_t
 
-            # Encoder: A and R
-            for l in range(self.nb_layers):
-                A_layer = self.A_layers[l] # A cell
-                R_layer = self.R_layers[l] # R cell
-                if l == 0:
-                    A_t[l] = X[:,t,:,:,:] # first layer predicts pixels
-                    if self.no_R0:
-                        R_t[0] = None
-                    else:
-                        R_t[l],(H_t[l],C_t[l]) = R_layer(A_t[l], None,
-                                                         (H_tm1[l],C_tm1[l]))
-                else:
-                    if self.local_grad:
-                        A_t[l] = A_layer(A_t[l-1].detach())
-                    else:
-                        A_t[l] = A_layer(A_t[l-1])
-                    R_t[l], (H_t[l],C_t[l]) = R_layer(A_t[l], None,
-                                                      (H_tm1[l],C_tm1[l]))
+    def run_steps(self,X,hidden,record_first=True):
+        # Run consecutive time steps, keeping only what the output needs:
+        # mean errors for each step and layer, layer 0 predictions and the
+        # reps of the last step
+        errors = []
+        preds = []
+        static_input = self.static_input
+        if not input_cache_exact(self):
+            static_input = 'never'
+        input_cache = None
+        for t in range(X.shape[1]):
+            if static_input != 'never' and not reuse_input(X,t,static_input):
+                input_cache = {} # new input: recompute and cache
+            (R_t,E_t,Ahat_t),hidden = self.step(X[:,t],hidden,input_cache)
+            if self.record_errors and (t > 0 or record_first):
+                E_means = [torch.mean(E_l,dtype=torch.float32) for E_l in E_t]
+                errors.append(torch.stack(E_means))
+            if self.record_preds:
+                preds.append(Ahat_t[0])
+        return errors,preds,R_t,hidden
 
-            # Errors from predictions on previous time steps
-            if t > 0:
-                for l in range(self.nb_layers):
-                    E_t[l] = self.E_layer(A_t[l],Ahat_t[l])
+    def step(self,X_t,hidden,input_cache=None):
+        # Single time step: encoder (A and R) from the bottom, errors on the
+        # predictions from the previous step, then decoder (Ahat) from the top.
+        # A and the input convs of R cells only depend on the input, and are
+        # reused from input_cache if it has them.
+        (H_tm1,C_tm1),Ahat_tm1 = hidden
+        A_cached = None
+        if input_cache is not None:
+            A_cached = input_cache.get('A')
 
-            # Decoder: Ahat
-            for l in reversed(range(self.nb_layers)):
-                Ahat_layer = self.Ahat_layers[l]
-                if l == self.nb_layers - 1:
-                    Ahat_up = None
-                elif l > 0:
-                    target_size = (A_t[l].shape[2],A_t[l].shape[3])
-                    Ahat_up = F.interpolate(Ahat_t[l+1],target_size)
-                    if self.local_grad:
-                        Ahat_up = Ahat_up.detach()
-                elif l == 0:
-                    target_size = (A_t[l].shape[2],A_t[l].shape[3])
-                    Ahat_up = F.interpolate(Ahat_t[l+1],target_size)
-                    if self.local_grad:
-                        Ahat_up = Ahat_up.detach()
-                Ahat_t[l] = Ahat_layer(A_t[l],R_t[l],Ahat_up)
+        # Encoder: A and R (no R cell in first layer if no_R0)
+        A_t = []
+        R_t = []
+        H_t = []
+        C_t = []
+        for l in range(self.nb_layers):
+            A_lm1 = X_t if l == 0 else A_t[l-1]
+            A_l_cached = None if A_cached is None else A_cached[l]
+            R_cache = None
+            if input_cache is not None:
+                R_cache = input_cache.setdefault('R%d' % l,{})
+            A_l,R_l,(H_l,C_l) = self.encoder_step(l,A_lm1,(H_tm1[l],C_tm1[l]),
+                                                  A_l_cached,R_cache)
+            A_t.append(A_l)
+            R_t.append(R_l)
+            H_t.append(H_l)
+            C_t.append(C_l)
+        if input_cache is not None:
+            input_cache['A'] = A_t
 
-            # Update hidden states
-            (H_tm1,C_tm1) = (H_t,C_t)
+        # Errors from predictions on previous time step
+        E_t = None
+        if Ahat_tm1 is not None:
+            E_t = [self.E_layer(A_t[l],Ahat_tm1[l])
+                   for l in range(self.nb_layers)]
 
-            # Output
-            if self.output == 'pred':
-                if t < seq_len-1:
-                    outputs.append(Ahat_t[0])
-            elif self.output == 'rep':
-                if t == seq_len - 1: # only return reps for last time step
-                    if R_t[0] is None:
-                        outputs = R_t[1:]
-                    else:
-                        outputs = R_t
-            elif self.output == 'error':
-                if t > 0: # first time step doesn't count
-                    outputs.append(E_t)
+        # Decoder: Ahat (list built top-down)
+        Ahat_t = []
+        Ahat_lp1 = None
+        for l in reversed(range(self.nb_layers)):
+            Ahat_lp1 = self.decoder_step(l,A_t[l],R_t[l],Ahat_lp1)
+            Ahat_t.append(Ahat_lp1)
+        Ahat_t.reverse()
 
-        # Errors and Preds returned as tensors
-        if self.output == 'error':
-            outputs_t = torch.zeros(seq_len,self.nb_layers)
-            for t in range(seq_len-1):
-                for l in range(self.nb_layers):
-                    outputs_t[t,l] = torch.mean(outputs[t][l])
-        elif self.output == 'pred':
-            outputs_t = [output.unsqueeze(1) for output in outputs]
-            outputs_t = torch.cat(outputs_t,dim=1) # (batch,len,in_channels,H,W)
-        # reps returned as list of tensors
-        elif self.output == 'rep':
-            outputs_t = outputs
-        return outputs_t
+        return (R_t,E_t,Ahat_t),((H_t,C_t),Ahat_t)
+
+    def encoder_step(self,l,A_lm1,hidden_l,A_cached=None,R_cache=None):
+        # Encoder of layer l: A from A of the layer below (X_t in layer 0),
+        # or A_cached, then R
+        if l == 0:
+            A_l = A_lm1 # first layer predicts pixels
+        elif A_cached is not None:
+            A_l = A_cached
+        elif self.local_grad:
+            A_l = self.A_layers[l](A_lm1.detach())
+        else:
+            A_l = self.A_layers[l](A_lm1)
+        if l == 0 and self.no_R0:
+            R_l,(H_l,C_l) = None,(None,None)
+        else:
+            R_l,(H_l,C_l) = self.R_layers[l](A_l,None,hidden_l,R_cache)
+        return A_l,R_l,(H_l,C_l)
+
+    def decoder_step(self,l,A_l,R_l,Ahat_lp1):
+        # Decoder of layer l: Ahat from A and R of the layer and Ahat of the
+        # layer above (None in the top layer)
+        if Ahat_lp1 is None:
+            Ahat_up = None
+        else:
+            Ahat_up = F.interpolate(Ahat_lp1,A_l.shape[2:])
+            if self.local_grad:
+                Ahat_up = Ahat_up.detach()
+        return self.Ahat_layers[l](A_l,R_l,Ahat_up)
 
     def initialize(self,X):
         # input dimensions
@@ -319,9 +412,12 @@ class LadderNet(nn.Module):
         C_0 = []
         for l in range(self.nb_layers):
             R_channels = self.R_stack_sizes[l]
-            # All hidden states initialized with zeros
-            Hl = torch.zeros(batch_size,R_channels,height,width).to(self.device)
-            Cl = torch.zeros(batch_size,R_channels,height,width).to(self.device)
+            # All hidden states initialized with zeros (on the device of X,
+            # in the memory format of the model)
+            Hl = zeros_state(X,(batch_size,R_channels,height,width),
+                             self.memory_format)
+            Cl = zeros_state(X,(batch_size,R_channels,height,width),
+                             self.memory_format)
             H_0.append(Hl)
             C_0.append(Cl)
             # Update dims
@@ -3,8 +3,10 @@
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
+import torch.utils.checkpoint
 
 from activations import Hardsigmoid, SatLU
+from fused_lstm import fused_acts, fused_lstm_update, stacked_conv
 from utils import *
 
 # Convolutional LSTM cell used for R cells
@@ -22,7 +24,8 @@ class RCell(nn.Module):
     """
     def __init__(self, in_channels, hidden_channels, kernel_size,
                  LSTM_act, LSTM_c_act, is_last, bias=True, use_out=True,
-                 FC=False, no_ER=False, dropout_p=0.0):
+                 FC=False, no_ER=False, dropout_p=0.0, fused_gates=False,
+                 cell_type='dense', cell_groups=4, cell_reduction=4):
         super(RCell, self).__init__()
         self.in_channels = in_channels
         self.hidden_channels = hidden_channels
@@ -38,48 +41,61 @@ class RCell(nn.Module):
         self.LSTM_act = get_activation(LSTM_act)
         self.LSTM_c_act = get_activation(LSTM_c_act)
 
+        # Fused gate update (C-dependent gates of FC cells can't be fused)
+        self.fused_gates = fused_gates and not FC
+        if self.fused_gates:
+            msg = "fused_gates needs dense gate convs"
+            assert cell_type == 'dense', msg
+            msg = "fused_gates supports activations %s" % fused_acts
+            assert LSTM_act in fused_acts and LSTM_c_act in fused_acts, msg
+            self.fused_acts = (LSTM_act,LSTM_c_act,LSTM_act) # gate,cell,out
+
         self.stride = 1 # Stride always 1 for simplicity
         self.dilation = 1 # Dilation always 1 for simplicity
-        _pad = 0 # Padding done manually in forward()
-        self.groups = 1 # Groups always 1 for simplicity
+        self.cell_type = cell_type # convs of gates (see gate_conv)
+        self.cell_groups = cell_groups # groups of 'grouped' cells
+        self.cell_reduction = cell_reduction # reduction of 'bottleneck' cells
+        # Padding done by the convs if symmetric, otherwise manually in
+        # forward() (same H,W)
+        _pad,self.padding = get_conv_pad(kernel_size)
 
         # Convolutional layers
-        self.Wxi = nn.Conv2d(in_channels,hidden_channels,kernel_size,
-                             self.stride,_pad,self.dilation,
-                             self.groups,self.bias)
-        self.Whi = nn.Conv2d(hidden_channels,hidden_channels,
-                             kernel_size,self.stride,_pad,
-                             self.dilation,self.groups,self.bias)
-        self.Wxf = nn.Conv2d(in_channels,hidden_channels,kernel_size,
-                             self.stride,_pad,self.dilation,
-                             self.groups,self.bias)
-        self.Whf = nn.Conv2d(hidden_channels,hidden_channels,
-                             kernel_size,self.stride,_pad,
-                             self.dilation,self.groups,self.bias)
-        self.Wxc = nn.Conv2d(in_channels,hidden_channels,kernel_size,
-                             self.stride,_pad,self.dilation,
-                             self.groups,self.bias)
-        self.Whc = nn.Conv2d(hidden_channels,hidden_channels,
-                             kernel_size,self.stride,_pad,
-                             self.dilation,self.groups,self.bias)
-        self.Wxo = nn.Conv2d(in_channels,hidden_channels,kernel_size,
-                             self.stride,_pad,self.dilation,
-                             self.groups,self.bias)
-        self.Who = nn.Conv2d(hidden_channels,hidden_channels,
-                             kernel_size,self.stride,_pad,
-                             self.dilation,self.groups,self.bias)
+        self.Wxi = gate_conv(in_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
+        self.Whi = gate_conv(hidden_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
+        self.Wxf = gate_conv(in_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
+        self.Whf = gate_conv(hidden_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
+        self.Wxc = gate_conv(in_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
+        self.Whc = gate_conv(hidden_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
+        self.Wxo = gate_conv(in_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
+        self.Who = gate_conv(hidden_channels,hidden_channels,kernel_size,
+                             _pad,self.bias,cell_type,cell_groups,
+                             cell_reduction)
 
         # Extra layers for fully connected
         if FC:
-            self.Wci = nn.Conv2d(hidden_channels,hidden_channels,kernel_size,
-                                 self.stride,_pad,self.dilation,
-                                 self.groups,self.bias)
-            self.Wcf = nn.Conv2d(hidden_channels,hidden_channels,kernel_size,
-                                 self.stride,_pad,self.dilation,
-                                 self.groups,self.bias)
-            self.Wco = nn.Conv2d(hidden_channels,hidden_channels,kernel_size,
-                                 self.stride,_pad,self.dilation,
-                                 self.groups,self.bias)
+            self.Wci = gate_conv(hidden_channels,hidden_channels,kernel_size,
+                                 _pad,self.bias,cell_type,cell_groups,
+                                 cell_reduction)
+            self.Wcf = gate_conv(hidden_channels,hidden_channels,kernel_size,
+                                 _pad,self.bias,cell_type,cell_groups,
+                                 cell_reduction)
+            self.Wco = gate_conv(hidden_channels,hidden_channels,kernel_size,
+                                 _pad,self.bias,cell_type,cell_groups,
+                                 cell_reduction)
         # 1 x 1 convolution for output
         if use_out:
             self.out = nn.Conv2d(hidden_channels,hidden_channels,1,1,0,1,1)
@@ -87,51 +103,50 @@ class RCell(nn.Module):
         # Dropout
         self.dropout = nn.Dropout(dropout_p)
 
-    def forward(self, E, R_lp1, hidden):
+    def forward(self, E, R_lp1, hidden, input_cache=None):
         H_tm1, C_tm1 = hidden
 
-        # Upsample R_lp1
-        if not self.is_last:
-            target_size = (E.shape[2],E.shape[3])
-            R_up = F.interpolate(R_lp1,target_size)
-            if not self.no_ER:
-                x_t = torch.cat((E,R_up),dim=1) # cat on channel dim
-            else:
-                x_t = R_up
+        # Convs of the input only depend on E and R_lp1: if input_cache has
+        # them (same input as on the previous step), they are reused
+        if input_cache is not None and 'x' in input_cache:
+            x_gates = input_cache['x']
         else:
-            x_t = E
-
-        # Dropout on inputs
-        x_t = self.dropout(x_t)
+            x_gates = self.input_convs(E,R_lp1)
+            if input_cache is not None:
+                input_cache['x'] = x_gates
 
         # Manual zero-padding to make H,W same
-        in_height = x_t.shape[-2]
-        in_width = x_t.shape[-1]
-        padding = get_pad_same(in_height,in_width,self.kernel_size)
-        x_t_pad = F.pad(x_t,padding)
-        H_tm1_pad = F.pad(H_tm1,padding)
-        C_tm1_pad = F.pad(C_tm1,padding)
+        padding = self.padding
+        H_tm1_pad = pad_same(H_tm1,padding)
+        C_tm1_pad = pad_same(C_tm1,padding)
 
         # No dependence on C for i,f,o?
-        if not self.FC:
-            i_t = self.LSTM_act(self.Wxi(x_t_pad) + self.Whi(H_tm1_pad))
-            f_t = self.LSTM_act(self.Wxf(x_t_pad) + self.Whf(H_tm1_pad))
-            C_t = f_t*C_tm1 + i_t*self.LSTM_c_act(self.Wxc(x_t_pad) + \
-                                                  self.Whc(H_tm1_pad))
-            o_t = self.LSTM_act(self.Wxo(x_t_pad) + self.Who(H_tm1_pad))
+        if self.fused_gates:
+            # Pre-activations of all gates from two convs, then one fused
+            # elementwise update
+            W_h = (self.Whi,self.Whf,self.Whc,self.Who)
+            gates = x_gates[0] + stacked_conv(H_tm1_pad,W_h)
+            H_t,C_t = fused_lstm_update(gates,C_tm1,*self.fused_acts)
+        elif not self.FC:
+            x_i,x_f,x_c,x_o = x_gates
+            i_t = self.LSTM_act(x_i + self.Whi(H_tm1_pad))
+            f_t = self.LSTM_act(x_f + self.Whf(H_tm1_pad))
+            C_t = f_t*C_tm1 + i_t*self.LSTM_c_act(x_c + self.Whc(H_tm1_pad))
+            o_t = self.LSTM_act(x_o + self.Who(H_tm1_pad))
             H_t = o_t*self.LSTM_act(C_t)
         else:
-            i_t = self.Wxi(x_t_pad) + self.Whi(H_tm1_pad) + self.Wci(C_tm1_pad)
+            x_i,x_f,x_c,x_o = x_gates
+            i_t = x_i + self.Whi(H_tm1_pad) + self.Wci(C_tm1_pad)
             i_t = self.LSTM_act(i_t)
 
-            f_t = self.Wxf(x_t_pad) + self.Whf(H_tm1_pad) + self.Wcf(C_tm1_pad)
+            f_t = x_f + self.Whf(H_tm1_pad) + self.Wcf(C_tm1_pad)
             f_t = self.LSTM_act(f_t)
 
-            C_t = self.Wxc(x_t_pad) + self.Whc(H_tm1_pad)
+            C_t = x_c + self.Whc(H_tm1_pad)
             C_t = f_t*C_tm1 + i_t*self.LSTM_c_act(C_t)
-            C_t_pad = F.pad(C_t,padding)
+            C_t_pad = pad_same(C_t,padding)
 
-            o_t = self.Wxo(x_t_pad) + self.Who(H_tm1_pad) + self.Wco(C_t_pad)
+            o_t = x_o + self.Who(H_tm1_pad) + self.Wco(C_t_pad)
             o_t = self.LSTM_act(o_t)
 
             H_t = o_t*self.LSTM_act(C_t)
@@ -143,6 +158,29 @@ class RCell(nn.Module):
 
         return R_t, (H_t,C_t)
 
+    def input_convs(self, E, R_lp1):
+        # Input-side convs of all gates (one stacked conv if fused_gates)
+        # Upsample R_lp1
+        if not self.is_last:
+            R_up = F.interpolate(R_lp1,E.shape[2:])
+            if not self.no_ER:
+                x_t = torch.cat((E,R_up),dim=1) # cat on channel dim
+            else:
+                x_t = R_up
+        else:
+            x_t = E
+
+        # Dropout on inputs
+        x_t = self.dropout(x_t)
+
+        # Manual zero-padding to make H,W same
+        x_t_pad = pad_same(x_t,self.padding)
+        if self.fused_gates:
+            W_x = (self.Wxi,self.Wxf,self.Wxc,self.Wxo)
+            return (stacked_conv(x_t_pad,W_x),)
+        return (self.Wxi(x_t_pad),self.Wxf(x_t_pad),self.Wxc(x_t_pad),
+                self.Wxo(x_t_pad))
+
 # A cells = [Conv,ReLU,MaxPool]
 class ACell(nn.Module):
     def __init__(self,in_channels,out_channels,
@@ -165,9 +203,11 @@ class ACell(nn.Module):
 
         if not no_conv:
             conv_stride = 1 # always 1 for simplicity
-            _conv_pad = 0 # padding done manually
             conv_dilation = conv_dilation
             conv_groups = 1 # always 1 for simplicity
+            # padding done by conv if symmetric, otherwise manually
+            _conv_pad,self.padding = get_conv_pad(conv_kernel_size,
+                                                  conv_dilation) # same H,W
             self.conv =  nn.Conv2d(in_channels,out_channels,
                                    conv_kernel_size,conv_stride,
                                    _conv_pad,conv_dilation,conv_groups,
@@ -181,11 +221,7 @@ class ACell(nn.Module):
             E_lm1 = self.BN(E_lm1)
         if not self.no_conv:
             # Manual padding to keep H,W the same
-            in_height = E_lm1.shape[2]
-            in_width = E_lm1.shape[3]
-            padding = get_pad_same(in_height,in_width,self.conv_kernel_size,
-                                   self.conv_dilation)
-            E_lm1 = F.pad(E_lm1,padding)
+            E_lm1 = pad_same(E_lm1,self.padding)
             A = self.conv(E_lm1)
             A = self.act(A)
         else:
@@ -214,9 +250,10 @@ class AhatCell(nn.Module):
             self.BN = nn.BatchNorm2d(in_channels)
 
         conv_stride = 1 # always 1 for simplicity
-        conv_pad_ = 0 # padding done manually
         conv_dilation = 1 # always 1 for simplicity
         conv_groups = 1 # always 1 for simplicity
+        # padding done by conv if symmetric, otherwise manually (same H,W)
+        conv_pad_,self.padding = get_conv_pad(conv_kernel_size)
 
         # Parameters
         self.conv =  nn.Conv2d(in_channels,out_channels,
@@ -231,11 +268,8 @@ class AhatCell(nn.Module):
         if self.use_BN:
             R_l = self.BN(R_l)
         # Manual padding to keep dims the same
-        in_height = R_l.shape[2]
-        in_width = R_l.shape[3]
-        padding = get_pad_same(in_height,in_width,self.conv_kernel_size)
+        R_l = pad_same(R_l,self.padding)
         # Compute A_hat
-        R_l = F.pad(R_l,padding)
         A_hat = self.conv(R_l)
         A_hat = self.out_act(A_hat)
         if self.use_satlu:
@@ -262,7 +296,9 @@ class PredNet(nn.Module):
                  use_1x1_out=False,FC=False,dropout_p=0.0,send_acts=False,
                  no_ER=False,RAhat=False,no_A_conv=False,higher_satlu=False,
                  local_grad=False,conv_dilation=1,use_BN=False,output='error',
-                 device='cpu'):
+                 device='cpu',grad_checkpoint=0,memory_format='contiguous',
+                 fused_gates=False,static_input='never',R_cell_type='dense',
+                 R_cell_groups=4,R_cell_reduction=4):
         super(PredNet,self).__init__()
         self.in_channels = in_channels
         self.stack_sizes = stack_sizes
@@ -291,6 +327,13 @@ class PredNet(nn.Module):
         self.use_BN = use_BN
         self.output = output
         self.device = device
+        self.grad_checkpoint = grad_checkpoint # time steps per checkpoint
+        self.memory_format = get_memory_format(memory_format) # of all convs
+        self.fused_gates = fused_gates # fused gate update in R cells
+        self.static_input = static_input # reuse A chain if input unchanged
+        self.R_cell_type = R_cell_type # gate convs of R cells (gate_conv)
+        self.R_cell_groups = R_cell_groups
+        self.R_cell_reduction = R_cell_reduction
 
         # no convolution in A means stack sizes is fixed
         if no_A_conv:
@@ -333,7 +376,9 @@ class PredNet(nn.Module):
             kernel_size = R_kernel_sizes[l]
             cell = RCell(in_channels,out_channels,kernel_size,
                          LSTM_act,LSTM_c_act,
-                         is_last,self.bias,use_1x1_out,FC,no_ER,dropout_p)
+                         is_last,self.bias,use_1x1_out,FC,no_ER,dropout_p,
+                         fused_gates,R_cell_type,R_cell_groups,
+                         R_cell_reduction)
             R_layers.append(cell)
         self.R_layers = nn.ModuleList(R_layers)
 
@@ -376,93 +421,155 @@ class PredNet(nn.Module):
         # E cells: subtract, ReLU, cat
         self.E_layer = ECell(error_act) # general: same for all layers
 
-    def forward(self,X):
-        # Get initial states
-        (H_tm1,C_tm1),E_tm1 = self.initialize(X)
-
-        outputs = []
-
-        # Loop through image sequence
+        # Conv weights (here) and states (in initialize) are converted to the
+        # memory format once. All intermediates then stay in that format.
+        self.to(memory_format=self.memory_format)
+
+    @property
+    def output(self):
+        return self._output
+
+    @output.setter
+    def output(self,output):
+        # One of 'error','pred','rep', or a collection of them (forward then
+        # returns a dict of all of them from one pass). What the time loop
+        # records is resolved once here, rather than every step.
+        self._output = output
+        outputs = get_outputs(output)
+        self.record_errors = 'error' in outputs
+        self.record_preds = 'pred' in outputs
+        self.record_reps = 'rep' in outputs
+
+    def forward(self,X,hidden=None,return_hidden=False):
+        # Get initial states, or continue from states carried over from the
+        # previous chunk of the same sequence (truncated BPTT)
+        X = sequence_to_memory_format(X,self.memory_format)
+        continued = hidden is not None
+        if not continued:
+            hidden = self.initialize(X)
+
+        # Loop through image sequence in segments. With grad_checkpoint > 0,
+        # each segment of that many time steps only keeps its input states
+        # for backward, and its activations are recomputed.
         seq_len = X.shape[1]
-        for t in range(seq_len):
-            A_t = X[:,t,:,:,:] # X dims: (batch,len,channels,height,width)
-            # Initialize list of states with consistent indexing
-            R_t = [None] * self.nb_layers
-            H_t = [None] * self.nb_layers
-            C_t = [None] * self.nb_layers
-            E_t = [None] * self.nb_layers
+        use_checkpoint = self.grad_checkpoint > 0 and torch.is_grad_enabled()
+        seg_len = self.grad_checkpoint if use_checkpoint else seq_len
+        errors = []
+        preds = []
+        for t0 in range(0,seq_len,seg_len):
+            X_seg = X[:,t0:t0+seg_len] # X dims: (batch,len,channels,H,W)
+            record_first = continued or t0 > 0 # first time step doesn't count
+            if use_checkpoint:
+                segment = torch.utils.checkpoint.checkpoint(self.run_steps,
+                                                            X_seg,hidden,
+                                                            record_first,
+                                                            use_reentrant=False)
+            else:
+                segment = self.run_steps(X_seg,hidden,record_first)
+            seg_errors,seg_preds,reps,hidden = segment
+            errors += seg_errors
+            preds += seg_preds
 
-            # Update R units starting from the top
-            for l in reversed(range(self.nb_layers)):
-                R_layer = self.R_layers[l] # cell
-                if l == self.nb_layers-1:
-                    R_t[l],(H_t[l],C_t[l]) = R_layer(E_tm1[l],None,
-                                                     (H_tm1[l],C_tm1[l]))
-                else:
-                    if not self.local_grad:
-                        R_t[l],(H_t[l],C_t[l]) = R_layer(E_tm1[l],
-                                                         R_t[l+1],
-                                                         (H_tm1[l],C_tm1[l]))
-                    else:
-                        R_t[l],(H_t[l],C_t[l]) = R_layer(E_tm1[l],
-                                                         R_t[l+1].detach(),
-                                                         (H_tm1[l],C_tm1[l]))
-            if self.output == 'rep':
-                if t == seq_len - 1: # only return reps for last time step
-                    outputs = R_t
-
-            # Update feedforward path starting from the bottom
-            for l in range(self.nb_layers):
-                # Compute Ahat
-                Ahat_layer = self.Ahat_layers[l]
-                if self.RAhat and (l != (self.nb_layers-1)):
-                    target_size = (R_t[l].shape[2],R_t[l].shape[3])
-                    R_up = F.interpolate(R_t[l+1],target_size)
-                    Ahat_input = torch.cat((R_t[l],R_up),dim=1)
-                else:
-                    Ahat_input = R_t[l]
-                Ahat_t = Ahat_layer(Ahat_input)
-                if self.output == 'pred':
-                    if l == 0 and t > 0:
-                        outputs.append(Ahat_t)
-
-                # Compute E
-                E_t[l] = self.E_layer(A_t,Ahat_t)
-
-                # Compute A of next layer
-                if l < self.nb_layers-1:
-                    A_layer = self.A_layers[l+1]
-                    if not self.send_acts:
-                        if not self.local_grad:
-                            A_t = A_layer(E_t[l])
-                        else:
-                            A_t = A_layer(E_t[l].detach())
-                    else:
-                        # Send activations rather than errors
-                        if not self.local_grad:
-                            A_t = A_layer(A_t)
-                        else:
-                            A_t = A_layer(A_t.detach())
-
-            # Update
-            (H_tm1,C_tm1),E_tm1 = (H_t,C_t),E_t
-            if self.output == 'error':
-                if t > 0:
-                    outputs.append(E_t) # First time step doesn't count
         # errors and preds returned as tensors
-        if self.output == 'error':
-            outputs_t = torch.zeros(seq_len,self.nb_layers)
-            for t in range(seq_len-1):
-                for l in range(self.nb_layers):
-                    outputs_t[t,l] = torch.mean(outputs[t][l])
-        elif self.output == 'pred':
-            outputs_t = [output.unsqueeze(1) for output in outputs]
-            outputs_t = torch.cat(outputs_t,dim=1) # (batch,len,in_channels,H,W)
-        # reps returned as list of tensors
-        elif self.output == 'rep':
-            outputs_t = outputs
+        outputs = {}
+        if self.record_errors:
+            errors_t = torch.stack(errors) # (recorded steps,nb_layers)
+            n_missing = seq_len - len(errors) # rows of zeros up to seq_len
+            outputs['error'] = F.pad(errors_t,(0,0,0,n_missing))
+        if self.record_preds:
+            preds_t = torch.stack(preds,dim=1) # (batch,len,in_channels,H,W)
+            outputs['pred'] = preds_t.contiguous()
+        # reps returned as list of tensors (last time step only)
+        if self.record_reps:
+            outputs['rep'] = [R_l.contiguous() for R_l in reps]
+        outputs_t = select_outputs(outputs,self.output)
+        if return_hidden:
+            return outputs_t, hidden
         return outputs_t
 
+    def run_steps(self,X,hidden,record_first=True):
+        # Run consecutive time steps, keeping only what the output needs:
+        # mean errors for each step and layer, layer 0 predictions and the
+        # reps of the last step
+        errors = []
+        preds = []
+        static_input = self.static_input
+        if not input_cache_exact(self):
+            static_input = 'never'
+        input_cache = None
+        for t in range(X.shape[1]):
+            if static_input != 'never' and not reuse_input(X,t,static_input):
+                input_cache = {} # new input: recompute and cache
+            (R_t,E_t,Ahat_0),hidden = self.step(X[:,t],hidden,input_cache)
+            if t > 0 or record_first:
+                if self.record_errors:
+                    E_means = [torch.mean(E_l,dtype=torch.float32)
+                               for E_l in E_t]
+                    errors.append(torch.stack(E_means))
+                if self.record_preds:
+                    preds.append(Ahat_0)
+        return errors,preds,R_t,hidden
+
+    def step(self,A_t,hidden,input_cache=None):
+        # Single time step: update R units from the top, then Ahat, E and A
+        # from the bottom. With send_acts, A only depends on the input, and
+        # is reused from input_cache if it has it.
+        (H_tm1,C_tm1),E_tm1 = hidden
+        cache_A = self.send_acts and input_cache is not None
+        A_cached = input_cache.get('A') if cache_A else None
+        A_all = [A_t]
+
+        # Update R units starting from the top (lists built top-down)
+        R_t = []
+        H_t = []
+        C_t = []
+        R_lp1 = None
+        for l in reversed(range(self.nb_layers)):
+            if R_lp1 is not None and self.local_grad:
+                R_lp1 = R_lp1.detach()
+            R_l,(H_l,C_l) = self.R_layers[l](E_tm1[l],R_lp1,
+                                             (H_tm1[l],C_tm1[l]))
+            R_t.append(R_l)
+            H_t.append(H_l)
+            C_t.append(C_l)
+            R_lp1 = R_l
+        R_t.reverse()
+        H_t.reverse()
+        C_t.reverse()
+
+        # Update feedforward path starting from the bottom
+        E_t = []
+        for l in range(self.nb_layers):
+            # Compute Ahat
+            if self.RAhat and l < self.nb_layers-1:
+                R_up = F.interpolate(R_t[l+1],R_t[l].shape[2:])
+                Ahat_input = torch.cat((R_t[l],R_up),dim=1)
+            else:
+                Ahat_input = R_t[l]
+            Ahat_t = self.Ahat_layers[l](Ahat_input)
+            if l == 0:
+                Ahat_0 = Ahat_t # prediction of the input image
+
+            # Compute E
+            E_l = self.E_layer(A_t,Ahat_t)
+            E_t.append(E_l)
+
+            # Compute A of next layer (from activations rather than errors
+            # if send_acts)
+            if l < self.nb_layers-1:
+                if A_cached is not None:
+                    A_t = A_cached[l+1]
+                else:
+                    A_input = A_t if self.send_acts else E_l
+                    if self.local_grad:
+                        A_input = A_input.detach()
+                    A_t = self.A_layers[l+1](A_input)
+                A_all.append(A_t)
+        if cache_A:
+            input_cache['A'] = A_all
+
+        return (R_t,E_t,Ahat_0),((H_t,C_t),E_t)
+
     def initialize(self,X):
         # input dimensions
         batch_size = X.shape[0]
@@ -475,10 +582,14 @@ class PredNet(nn.Module):
         for l in range(self.nb_layers):
             channels = self.stack_sizes[l]
             R_channels = self.R_stack_sizes[l]
-            # All hidden states initialized with zeros
-            Hl = torch.zeros(batch_size,R_channels,height,width).to(self.device)
-            Cl = torch.zeros(batch_size,R_channels,height,width).to(self.device)
-            El = torch.zeros(batch_size,2*channels,height,width).to(self.device)
+            # All hidden states initialized with zeros (on the device of X,
+            # in the memory format of the model)
+            Hl = zeros_state(X,(batch_size,R_channels,height,width),
+                             self.memory_format)
+            Cl = zeros_state(X,(batch_size,R_channels,height,width),
+                             self.memory_format)
+            El = zeros_state(X,(batch_size,2*channels,height,width),
+                             self.memory_format)
             H_0.append(Hl)
             C_0.append(Cl)
             E_0.append(El)
@@ -562,12 +673,27 @@ class MultiConvLSTM(nn.Module):
         # E cells: subtract, ReLU, cat
         self.E_layer = ECell(error_act) # general: same for all layers
 
+    @property
+    def output(self):
+        return self._output
+
+    @output.setter
+    def output(self,output):
+        # One of 'error','pred','rep', or a collection of them (forward then
+        # returns a dict of all of them from one pass)
+        self._output = output
+        outputs = get_outputs(output)
+        self.record_errors = 'error' in outputs
+        self.record_preds = 'pred' in outputs
+        self.record_reps = 'rep' in outputs
+
     def forward(self,X):
 
         # Get initial states
         (H_tm1,C_tm1),R_tm1 = self.initialize(X)
 
-        outputs = []
+        errors = []
+        preds = []
         Ahat_t = [None] * self.nb_layers
 
         # Loop through image sequence
@@ -621,31 +747,29 @@ class MultiConvLSTM(nn.Module):
             # Update hidden states
             (H_tm1,C_tm1),R_tm1 = (H_t,C_t),R_t
             # Output pixel-level predictions
-            if self.output == 'pred':
+            if self.record_preds:
                 if t < seq_len-1:
-                    outputs.append(Ahat_t[0])
-            # Output representations
-            elif self.output == 'rep':
-                if t == seq_len - 1: # only return reps for last time step
-                    outputs = R_t
+                    preds.append(Ahat_t[0])
             # Output errors
-            elif self.output == 'error':
+            if self.record_errors:
                 if t > 0:
-                    outputs.append(E_t) # First time step doesn't count
+                    errors.append(E_t) # First time step doesn't count
 
         # errors and preds returned as tensors
-        if self.output == 'error':
-            outputs_t = torch.zeros(seq_len,self.nb_layers)
-            for t in range(seq_len-1):
-                for l in range(self.nb_layers):
-                    outputs_t[t,l] = torch.mean(outputs[t][l])
-        elif self.output == 'pred':
-            outputs_t = [output.unsqueeze(1) for output in outputs]
-            outputs_t = torch.cat(outputs_t,dim=1) # (batch,len,in_channels,H,W)
-        # reps returned as list of tensors
-        elif self.output == 'rep':
-            outputs_t = outputs
-        return outputs_t
+        outputs = {}
+        if self.record_errors:
+            # Mean of each layer's errors, on the device of the errors
+            errors_t = [torch.stack([torch.mean(E_l,dtype=torch.float32)
+                                     for E_l in E_t]) for E_t in errors]
+            errors_t = torch.stack(errors_t) # (len-1,nb_layers)
+            outputs['error'] = F.pad(errors_t,(0,0,0,1)) # zeros at last step
+        if self.record_preds:
+            preds_t = [pred.unsqueeze(1) for pred in preds]
+            outputs['pred'] = torch.cat(preds_t,dim=1) # (batch,len,C,H,W)
+        # reps returned as list of tensors (last time step only)
+        if self.record_reps:
+            outputs['rep'] = R_t
+        return select_outputs(outputs,self.output)
 
     def initialize(self,X):
         # input dimensions
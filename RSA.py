@@ -1,5 +1,6 @@
 # Script for doing RSA
 import os
+import time
 import argparse
 import numpy as np
 import hickle as hkl
@@ -15,6 +16,8 @@ from ConvLSTM import *
 from Ladder import *
 from StackedConvLSTM import *
 from utils import *
+from quantize import quantize_model, get_calibration_batches
+from tiling import tiled_forward
 
 parser = argparse.ArgumentParser()
 # RSA
@@ -134,6 +137,52 @@ parser.add_argument('--dropout_p', type=float, default=0.0,
                     help='Proportion dropout for inputs to R cells')
 parser.add_argument('--load_weights_from', default=None,
                     help='Path to saved weights')
+parser.add_argument('--bf16', type=str2bool, default=False,
+                    help='Run model forward under bfloat16 autocast')
+parser.add_argument('--memory_format', default='contiguous',
+                    choices=['contiguous','channels_last'],
+                    help='Memory format of conv weights, states and ' +
+                         'activations (PredNet and LadderNet only)')
+parser.add_argument('--R_cell_type', default='dense', choices=cell_types,
+                    help='Gate convs of R cells (ConvLSTM cell for ' +
+                         'ConvLSTM): dense, depthwise-separable, grouped, ' +
+                         'or bottleneck (1x1 reduce before k x k conv)')
+parser.add_argument('--R_cell_groups', type=int, default=4,
+                    help='Groups of gate convs with R_cell_type grouped')
+parser.add_argument('--R_cell_reduction', type=int, default=4,
+                    help='Channel reduction of the 1x1 conv with ' +
+                         'R_cell_type bottleneck')
+parser.add_argument('--static_input', default='never',
+                    choices=['never','detect','always'],
+                    help='Reuse input-side results (A with send_acts, ' +
+                         'LadderNet encoder, ConvLSTM input convs) when the ' +
+                         'input is bit-identical to the previous step: ' +
+                         'detect checks each step, always assumes it ' +
+                         '(e.g. CCN with last_only). Outputs are unchanged.')
+parser.add_argument('--compile', type=str2bool, default=False,
+                    help='Compile the model with torch.compile ' +
+                         '(first iterations are slower while compiling)')
+parser.add_argument('--quantize', type=str2bool, default=False,
+                    help='Run an int8 quantized copy of the model on CPU, ' +
+                         'calibrated on a subset of CCN sequences')
+parser.add_argument('--calib_data_path', default='../data/ccn_images/train/',
+                    help='Path to ccn image directory used for calibration')
+parser.add_argument('--calib_batches', type=int, default=10,
+                    help='Number of batches used for calibration')
+parser.add_argument('--calib_batch_size', type=int, default=4,
+                    help='Samples per calibration batch')
+parser.add_argument('--tile_size', type=int, default=None,
+                    help='Run the model on overlapping tiles of this size ' +
+                         '(multiple of 2**(nb_layers-1)) and stitch the ' +
+                         'results, to bound memory on large frames')
+parser.add_argument('--tile_halo', type=int, default=None,
+                    help='Context around each tile. Default covers the ' +
+                         'receptive field of the model over the sequence ' +
+                         '(exact results), which grows with seq_len and ' +
+                         'for 10 KITTI steps is larger than the frame (no ' +
+                         'memory saving); smaller is cheaper but approximate')
+parser.add_argument('--tile_workers', type=int, default=1,
+                    help='Number of tiles run in parallel')
 # Hyperparameters unique to LadderNet
 parser.add_argument('--no_R0', type=str2bool, default=True,
                     help='Boolean indicating whether not to include' +
@@ -272,7 +321,12 @@ def main(args):
                         args.use_1x1_out,args.FC,args.dropout_p,
                         args.send_acts,args.no_ER,args.RAhat,args.no_A_conv,
                         args.higher_satlu,args.local_grad,args.conv_dilation,
-                        args.use_BN,model_out,device)
+                        args.use_BN,model_out,device,
+                        memory_format=args.memory_format,
+                        static_input=args.static_input,
+                        R_cell_type=args.R_cell_type,
+                        R_cell_groups=args.R_cell_groups,
+                        R_cell_reduction=args.R_cell_reduction)
     elif args.model_type == 'MultiConvLSTM':
         model = MultiConvLSTM(args.in_channels,args.R_stack_sizes,
                               args.R_kernel_sizes,args.use_satlu,args.pixel_max,
@@ -283,7 +337,11 @@ def main(args):
     elif args.model_type == 'ConvLSTM':
         model = ConvLSTM(args.in_channels,args.hidden_channels,args.kernel_size,
                          args.LSTM_act,args.LSTM_c_act,args.out_act,
-                         args.bias,args.FC,device)
+                         args.bias,args.FC,device,
+                         static_input=args.static_input,
+                         R_cell_type=args.R_cell_type,
+                         R_cell_groups=args.R_cell_groups,
+                         R_cell_reduction=args.R_cell_reduction)
     elif args.model_type == 'LadderNet':
         model = LadderNet(args.in_channels,args.stack_sizes,args.R_stack_sizes,
                           args.A_kernel_sizes,args.Ahat_kernel_sizes,
@@ -293,7 +351,11 @@ def main(args):
                           args.LSTM_act,args.LSTM_c_act,args.bias,
                           args.use_1x1_out,args.FC,args.no_R0,args.no_skip0,
                           args.no_A_conv,args.higher_satlu,args.local_grad,
-                          model_out,device)
+                          model_out,device,memory_format=args.memory_format,
+                          static_input=args.static_input,
+                          R_cell_type=args.R_cell_type,
+                          R_cell_groups=args.R_cell_groups,
+                          R_cell_reduction=args.R_cell_reduction)
     elif args.model_type == 'StackedConvLSTM':
         model = StackedConvLSTM(args.in_channels,args.R_stack_sizes,
                                 args.R_kernel_sizes,args.use_1x1_out,
@@ -301,7 +363,18 @@ def main(args):
                                 model_out,device)
     if args.load_weights_from is not None:
         model.load_state_dict(torch.load(args.load_weights_from))
+    if args.quantize:
+        device = torch.device("cpu") # quantized convs run on CPU
+        calib_batches = get_calibration_batches(args.calib_data_path,
+                                                args.seq_len,
+                                                args.downsample_size,
+                                                args.calib_batch_size,
+                                                args.calib_batches,
+                                                args.last_only)
+        model = quantize_model(model,calib_batches)
     model.to(device)
+    if args.compile:
+        model = compile_model(model)
     model.eval()
     if args.model_type == 'LadderNet' and args.no_R0:
         nb_reps = model.nb_layers - 1
@@ -318,6 +391,7 @@ def main(args):
     n_labels = len(labels)
     print("There are %d labels in the dataset" % n_labels)
 
+    start_t = time.time()
     with torch.no_grad():
         # Get list of layer representations for each label
         label_reps = []
@@ -330,9 +404,18 @@ def main(args):
             # Run model, keeping running sum of representations
             layer_reps = [[] for l in range(nb_reps+1)] # nb_reps + pixels
             for batch_i,batch in enumerate(dataloader):
-                X = batch[0].to(device)
+                X = batch[0]
                 # Get representations
-                reps = model(X) # list of reps, one for each layer
+                if args.tile_size is not None:
+                    # Frames stay on CPU, tiles are run on device
+                    reps = tiled_forward(model,X,args.tile_size,args.tile_halo,
+                                         args.tile_workers,device,
+                                         args.bf16)['rep']
+                else:
+                    X = X.to(device)
+                    with bf16_autocast(device,args.bf16):
+                        reps = model(X) # list of reps, one for each layer
+                reps = [rep.float() for rep in reps]
                 pixels = X[:,-1,:,:,:] # Use last image to compare to RGB reps
                 # Aggregate across space
                 agg_pixels = aggregate_space(pixels,args.aggregate_method)
@@ -361,11 +444,16 @@ def main(args):
         for l in range(nb_reps+1):
             layer_tensor = torch.cat(layer_lists[l],dim=0)
             layer_tensors.append(layer_tensor)
+    extraction_time = time.time() - start_t
+    print("Extracted representations in %.1fs" % extraction_time)
 
     # Set up data for saving similarity matrices
     info = {'aggregate_method':args.aggregate_method,
-            'similarity_measure':args.similarity_measure}
+            'similarity_measure':args.similarity_measure,
+            'quantize':args.quantize,
+            'extraction_time':extraction_time}
     RSA_data = {'info':info}
+    RSA_data['unsorted'] = {'labels':labels} # same order for every model
     if args.cat_dict_json is None:
         cats = set([l.split('_')[0] for l in labels])
         cat_dict = {cat:cat for cat in cats}
@@ -377,10 +465,11 @@ def main(args):
         # Get similarity matrix
         S = get_similarity_matrix(layer_tensor,args.similarity_measure)
         S = S.cpu().numpy()
+        layer_name = 'layer%d' % (l-1) if l > 0 else 'pixels'
+        RSA_data['unsorted'][layer_name] = S
         # Sort similarity matrix
         sorted_S,sorted_labels = sort_similarity_matrix(S,cat_dict,labels)
         # Save matrices
-        layer_name = 'layer%d' % (l-1) if l > 0 else 'pixels'
         RSA_data[layer_name] = sorted_S
     RSA_data['labels'] = sorted_labels # all sorted labels should be the same
 
@@ -395,4 +484,6 @@ def main(args):
 if __name__ == '__main__':
     args = parser.parse_args()
     print(args)
+    msg = "Quantized models run in fp32 between int8 convs: don't use bf16"
+    assert not (args.quantize and args.bf16), msg
     main(args)
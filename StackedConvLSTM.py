@@ -6,11 +6,12 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from utils import *
+from fused_lstm import fused_lstm_update, stacked_conv
 from PredNet import ECell
 
 class ConvLSTMCell(nn.Module):
     def __init__(self, in_channels, hidden_channels, kernel_size,
-                 use_out=True, FC=False):
+                 use_out=True, FC=False, fused_gates=False):
         super(ConvLSTMCell, self).__init__()
         self.in_channels = in_channels
         self.hidden_channels = hidden_channels
@@ -22,11 +23,18 @@ class ConvLSTMCell(nn.Module):
         self.sigmoid = nn.Sigmoid()
         self.tanh = nn.Tanh()
 
+        # Fused gate update (C-dependent gates of FC cells can't be fused)
+        self.fused_gates = fused_gates and not FC
+        if self.fused_gates:
+            self.fused_acts = ('sigmoid','tanh','tanh') # gate,cell,out
+
         bias = True
         self.stride = 1 # Stride always 1 for simplicity
         self.dilation = 1 # Dilation always 1 for simplicity
-        _pad = 0 # Padding done manually in forward()
         self.groups = 1 # Groups always 1 for simplicity
+        # Padding done by the convs if symmetric, otherwise manually in
+        # forward() (same H,W)
+        _pad,self.padding = get_conv_pad(kernel_size)
 
         # Convolutional layers
         self.Wxi = nn.Conv2d(in_channels,hidden_channels,kernel_size,
@@ -73,15 +81,20 @@ class ConvLSTMCell(nn.Module):
         H_tm1, C_tm1 = hidden
 
         # Manual zero-padding to make H,W same
-        in_height = X_t.shape[-2]
-        in_width = X_t.shape[-1]
-        padding = get_pad_same(in_height,in_width,self.kernel_size)
-        X_t_pad = F.pad(X_t,padding)
-        H_tm1_pad = F.pad(H_tm1,padding)
-        C_tm1_pad = F.pad(C_tm1,padding)
+        padding = self.padding
+        X_t_pad = pad_same(X_t,padding)
+        H_tm1_pad = pad_same(H_tm1,padding)
+        C_tm1_pad = pad_same(C_tm1,padding)
 
         # No dependence on C for i,f,o?
-        if not self.FC:
+        if self.fused_gates:
+            # Pre-activations of all gates from two convs, then one fused
+            # elementwise update
+            W_x = (self.Wxi,self.Wxf,self.Wxc,self.Wxo)
+            W_h = (self.Whi,self.Whf,self.Whc,self.Who)
+            gates = stacked_conv(X_t_pad,W_x) + stacked_conv(H_tm1_pad,W_h)
+            H_t,C_t = fused_lstm_update(gates,C_tm1,*self.fused_acts)
+        elif not self.FC:
             i_t = self.sigmoid(self.Wxi(X_t_pad) + self.Whi(H_tm1_pad))
             f_t = self.sigmoid(self.Wxf(X_t_pad) + self.Whf(H_tm1_pad))
             C_t = f_t*C_tm1 + i_t*self.tanh(self.Wxc(X_t_pad) + \
@@ -97,7 +110,7 @@ class ConvLSTMCell(nn.Module):
 
             C_t = self.Wxc(X_t_pad) + self.Whc(H_tm1_pad)
             C_t = f_t*C_tm1 + i_t*self.tanh(C_t)
-            C_t_pad = F.pad(C_t,padding)
+            C_t_pad = pad_same(C_t,padding)
 
             o_t = self.Wxo(X_t_pad) + self.Who(H_tm1_pad) + self.Wco(C_t_pad)
             o_t = self.sigmoid(o_t)
@@ -114,7 +127,7 @@ class ConvLSTMCell(nn.Module):
 class StackedConvLSTM(nn.Module):
     def __init__(self,in_channels,stack_sizes,kernel_sizes,use_1x1_out=False,
                  FC=True,local_grad=False,forward_conv=False,
-                 output='error',device='cpu'):
+                 output='error',device='cpu',fused_gates=False):
         super(StackedConvLSTM,self).__init__()
         self.in_channels = in_channels
         self.stack_sizes = stack_sizes
@@ -125,9 +138,15 @@ class StackedConvLSTM(nn.Module):
         self.forward_conv = forward_conv
         self.output = output
         self.device = device
+        self.fused_gates = fused_gates
 
         self.nb_layers = len(stack_sizes)
 
+        # Padding for forward conv and Ahat conv layers: done by the convs if
+        # symmetric, otherwise manually in forward() (same H,W)
+        conv_pads = [get_conv_pad(k) for k in kernel_sizes]
+        self.paddings = [padding for _,padding in conv_pads]
+
         # Forward layers
         forward_layers = []
         for l in range(self.nb_layers):
@@ -138,10 +157,11 @@ class StackedConvLSTM(nn.Module):
             hidden_channels = stack_sizes[l]
             kernel_size = kernel_sizes[l]
             if self.forward_conv:
-                cell = nn.Conv2d(in_channels,hidden_channels,kernel_size)
+                cell = nn.Conv2d(in_channels,hidden_channels,kernel_size,
+                                 padding=conv_pads[l][0])
             else:
                 cell = ConvLSTMCell(in_channels,hidden_channels,kernel_size,
-                                    use_1x1_out,FC)
+                                    use_1x1_out,FC,fused_gates)
             forward_layers.append(cell)
         self.forward_layers = nn.ModuleList(forward_layers)
 
@@ -158,7 +178,7 @@ class StackedConvLSTM(nn.Module):
             hidden_channels = stack_sizes[l]
             kernel_size = kernel_sizes[l]
             cell = ConvLSTMCell(in_channels,hidden_channels,kernel_size,
-                            use_1x1_out,FC)
+                            use_1x1_out,FC,fused_gates)
             backward_layers.append(cell)
         self.backward_layers = nn.ModuleList(backward_layers)
 
@@ -171,7 +191,8 @@ class StackedConvLSTM(nn.Module):
             else:
                 out_channels = self.stack_sizes[l-1]
             kernel_size = kernel_sizes[l]
-            conv = nn.Conv2d(in_channels,out_channels,kernel_size)
+            conv = nn.Conv2d(in_channels,out_channels,kernel_size,
+                             padding=conv_pads[l][0])
             conv_layers.append(conv)
         self.conv_layers = nn.ModuleList(conv_layers)
 
@@ -187,112 +208,142 @@ class StackedConvLSTM(nn.Module):
             self.Ahat_act = nn.Tanh() # Ahat matches R output activation
         self.Ahat0_act = nn.Sigmoid() # layer 0 Ahat activation
 
+    @property
+    def output(self):
+        return self._output
+
+    @output.setter
+    def output(self,output):
+        # One of 'error','pred','rep', or a collection of them (forward then
+        # returns a dict of all of them from one pass). What the time loop
+        # records is resolved once here, rather than every step.
+        self._output = output
+        outputs = get_outputs(output)
+        self.record_errors = 'error' in outputs
+        self.record_preds = 'pred' in outputs
+        self.record_reps = 'rep' in outputs
+
     def forward(self,X):
         # Get initial states
-        (H_tm1_f,C_tm1_f,H_tm1_b,C_tm1_b) = self.initialize(X)
-
-        outputs = []
-        Ahat_t = [None] * self.nb_layers
+        hidden = self.initialize(X)
 
         # Loop through image sequence
-        seq_len = X.shape[1]
-        for t in range(seq_len):
-            # Initialize list of states with consistent indexing
-            A_t = [None] * self.nb_layers
-            R_t_f = [None] * self.nb_layers
-            R_t_b = [None] * self.nb_layers
-            H_t_f = [None] * self.nb_layers
-            C_t_f = [None] * self.nb_layers
-            H_t_b = [None] * self.nb_layers
-            C_t_b = [None] * self.nb_layers
-            E_t = [None] * self.nb_layers
-
-            # Forward path
-            for l in range(self.nb_layers):
-                # Compute A
-                if l == 0:
-                    A_t[l] = X[:,t,:,:,:] # (batch,len,channels,height,width)
-                else:
-                    if self.local_grad:
-                        A_t[l] = self.max_pool(R_t_f[l-1].detach())
-                    else:
-                        A_t[l] = self.max_pool(R_t_f[l-1])
-                # Compute R_t_f
-                forward_layer = self.forward_layers[l]
-                if self.forward_conv:
-                    in_height = A_t[l].shape[2]
-                    in_width = A_t[l].shape[3]
-                    padding = get_pad_same(in_height,in_width,
-                                           self.kernel_sizes[l])
-                    A_t_l_padded = F.pad(A_t[l],padding)
-                    R_t_f[l] = forward_layer(A_t_l_padded)
-                    R_t_f[l] = self.forward_act(R_t_f[l])
-                    H_t_f[l],C_t_f[l] = None,None
-                else:
-                    R_t_f[l], (H_t_f[l],C_t_f[l]) = forward_layer(A_t[l],
-                                                                  (H_tm1_f[l],
-                                                                   C_tm1_f[l]))
-
-            # Compute errors made on previous timestep
-            if t > 0:
-                for l in range(self.nb_layers):
-                    E_t[l] = self.E_layer(A_t[l],Ahat_t[l])
-
-            # Backward path
-            for l in reversed(range(self.nb_layers)):
-                # Compute R_t_b
-                backward_layer = self.backward_layers[l]
-                if l == self.nb_layers - 1:
-                    R_input = R_t_f[l]
-                else:
-                    target_size = (R_t_f[l].shape[2],R_t_f[l].shape[3])
-                    R_t_b_up = F.interpolate(R_t_b[l+1],target_size)
-                    if self.local_grad:
-                        R_t_b_up = R_t_b_up.detach()
-                    R_input = torch.cat((R_t_f[l],R_t_b_up),dim=1)
-                R_t_b[l], (H_t_b[l],C_t_b[l]) = backward_layer(R_input,
-                                                               (H_tm1_b[l],
-                                                                C_tm1_b[l]))
-                # Compute Ahat (prediction about the next time step)
-                in_height = R_t_b[l].shape[2]
-                in_width = R_t_b[l].shape[3]
-                padding = get_pad_same(in_height,in_width,self.kernel_sizes[l])
-                R_t_b_l_padded = F.pad(R_t_b[l],padding)
-                conv_layer = self.conv_layers[l]
-                Ahat_t[l] = conv_layer(R_t_b_l_padded)
-                if l == 0:
-                    Ahat_t[l] = self.Ahat0_act(Ahat_t[l])
-                else:
-                    Ahat_t[l] = self.Ahat_act(Ahat_t[l])
-
-            # Update hidden states
-            (H_tm1_f,C_tm1_f) = (H_t_f,C_t_f)
-            (H_tm1_b,C_tm1_b) = (H_t_b,C_t_b)
-
-            # Output
-            if self.output == 'pred':
-                if t < seq_len-1:
-                    outputs.append(Ahat_t[0])
-            elif self.output == 'rep':
-                if t == seq_len - 1: # only return reps for last time step
-                    outputs = R_t_b
-            elif self.output == 'error':
-                if t > 0: # first time step doesn't count
-                    outputs.append(E_t)
+        errors,preds,reps,hidden = self.run_steps(X,hidden)
 
         # Errors and Preds returned as tensors
-        if self.output == 'error':
-            outputs_t = torch.zeros(seq_len,self.nb_layers)
-            for t in range(seq_len-1):
-                for l in range(self.nb_layers):
-                    outputs_t[t,l] = torch.mean(outputs[t][l])
-        elif self.output == 'pred':
-            outputs_t = [output.unsqueeze(1) for output in outputs]
-            outputs_t = torch.cat(outputs_t,dim=1) # (batch,len,in_channels,H,W)
-        # reps returned as list of tensors
-        elif self.output == 'rep':
-            outputs_t = outputs
-        return outputs_t
+        outputs = {}
+        if self.record_errors:
+            errors_t = torch.stack(errors) # (seq_len-1,nb_layers)
+            outputs['error'] = F.pad(errors_t,(0,0,0,1)) # rows up to seq_len
+        if self.record_preds:
+            preds = preds[:-1] # last prediction is beyond the sequence
+            outputs['pred'] = torch.stack(preds,dim=1) # (batch,len,C,H,W)
+        # reps returned as list of tensors (last time step only)
+        if self.record_reps:
+            outputs['rep'] = reps
+        return select_outputs(outputs,self.output)
+
+    def run_steps(self,X,hidden):
+        # Run consecutive time steps, keeping only what the output needs:
+        # mean errors for each step and layer, layer 0 predictions and the
+        # reps of the last step
+        errors = []
+        preds = []
+        Ahat_tm1 = None
+        for t in range(X.shape[1]):
+            (R_t_b,E_t,Ahat_t),hidden = self.step(X[:,t],hidden,Ahat_tm1)
+            if self.record_errors and E_t is not None:
+                E_means = [torch.mean(E_l,dtype=torch.float32) for E_l in E_t]
+                errors.append(torch.stack(E_means))
+            if self.record_preds:
+                preds.append(Ahat_t[0])
+            Ahat_tm1 = Ahat_t
+        return errors,preds,R_t_b,hidden
+
+    def step(self,X_t,hidden,Ahat_tm1=None):
+        # Single time step: forward path from the bottom, errors on the
+        # predictions from the previous step, then backward path from the top
+        (H_tm1_f,C_tm1_f,H_tm1_b,C_tm1_b) = hidden
+
+        # Forward path
+        A_t = []
+        R_t_f = []
+        H_t_f = []
+        C_t_f = []
+        for l in range(self.nb_layers):
+            R_lm1 = X_t if l == 0 else R_t_f[l-1]
+            A_l,R_l,(H_l,C_l) = self.forward_step(l,R_lm1,
+                                                  (H_tm1_f[l],C_tm1_f[l]))
+            A_t.append(A_l)
+            R_t_f.append(R_l)
+            H_t_f.append(H_l)
+            C_t_f.append(C_l)
+
+        # Compute errors made on previous timestep
+        E_t = None
+        if Ahat_tm1 is not None:
+            E_t = [self.E_layer(A_t[l],Ahat_tm1[l])
+                   for l in range(self.nb_layers)]
+
+        # Backward path (lists built top-down)
+        R_t_b = []
+        H_t_b = []
+        C_t_b = []
+        Ahat_t = []
+        R_lp1 = None
+        for l in reversed(range(self.nb_layers)):
+            R_l,(H_l,C_l),Ahat_l = self.backward_step(l,R_t_f[l],R_lp1,
+                                                      (H_tm1_b[l],
+                                                       C_tm1_b[l]))
+            R_t_b.append(R_l)
+            H_t_b.append(H_l)
+            C_t_b.append(C_l)
+            Ahat_t.append(Ahat_l)
+            R_lp1 = R_l
+        R_t_b.reverse()
+        H_t_b.reverse()
+        C_t_b.reverse()
+        Ahat_t.reverse()
+
+        hidden = (H_t_f,C_t_f,H_t_b,C_t_b)
+        return (R_t_b,E_t,Ahat_t),hidden
+
+    def forward_step(self,l,R_lm1,hidden_l):
+        # Forward path of layer l: A from the forward R of the layer below
+        # (X_t in layer 0), then forward R
+        if l == 0:
+            A_l = R_lm1 # (batch,channels,height,width)
+        elif self.local_grad:
+            A_l = self.max_pool(R_lm1.detach())
+        else:
+            A_l = self.max_pool(R_lm1)
+        forward_layer = self.forward_layers[l]
+        if self.forward_conv:
+            A_l_padded = pad_same(A_l,self.paddings[l])
+            R_l = self.forward_act(forward_layer(A_l_padded))
+            H_l,C_l = None,None
+        else:
+            R_l,(H_l,C_l) = forward_layer(A_l,hidden_l)
+        return A_l,R_l,(H_l,C_l)
+
+    def backward_step(self,l,R_f_l,R_lp1,hidden_l):
+        # Backward path of layer l: backward R from the forward R of the
+        # layer and the backward R of the layer above, then Ahat
+        # (prediction about the next time step)
+        if R_lp1 is None:
+            R_input = R_f_l
+        else:
+            R_t_b_up = F.interpolate(R_lp1,R_f_l.shape[2:])
+            if self.local_grad:
+                R_t_b_up = R_t_b_up.detach()
+            R_input = torch.cat((R_f_l,R_t_b_up),dim=1)
+        R_l,(H_l,C_l) = self.backward_layers[l](R_input,hidden_l)
+        Ahat_l = self.conv_layers[l](pad_same(R_l,self.paddings[l]))
+        if l == 0:
+            Ahat_l = self.Ahat0_act(Ahat_l)
+        else:
+            Ahat_l = self.Ahat_act(Ahat_l)
+        return R_l,(H_l,C_l),Ahat_l
 
     def initialize(self,X):
         # input dimensions
@@ -304,9 +355,9 @@ class StackedConvLSTM(nn.Module):
         C_0 = []
         for l in range(self.nb_layers):
             channels = self.stack_sizes[l]
-            # All hidden states initialized with zeros
-            Hl = torch.zeros(batch_size,channels,height,width).to(self.device)
-            Cl = torch.zeros(batch_size,channels,height,width).to(self.device)
+            # All hidden states initialized with zeros (on the device of X)
+            Hl = X.new_zeros(batch_size,channels,height,width)
+            Cl = X.new_zeros(batch_size,channels,height,width)
             H_0.append(Hl)
             C_0.append(Cl)
             # Update dims
@@ -0,0 +1,102 @@
+# Gradient accumulation: each batch is split into micro-batches that are run
+# forward and backward one at a time (losses weighted by their share of the
+# batch) before one optimizer step, and a probe of the largest micro-batch
+# whose forward and backward fit a memory budget
+import torch
+
+def split_batch(X,micro_batch_size):
+    # Micro-batches of X, each with its weight in the mean over the batch
+    return [(X_m,X_m.shape[0] / X.shape[0])
+            for X_m in X.split(micro_batch_size)]
+
+def split_hidden(hidden,n,micro_batch_size):
+    # Recurrent states split along the batch like split_batch: list of n
+    # structures, one per micro-batch (None kept)
+    if isinstance(hidden,torch.Tensor):
+        return list(hidden.split(micro_batch_size))
+    elif isinstance(hidden,(list,tuple)):
+        parts = [split_hidden(h,n,micro_batch_size) for h in hidden]
+        return [type(hidden)(part[i] for part in parts) for i in range(n)]
+    return [hidden]*n
+
+def cat_hidden(hiddens):
+    # Inverse of split_hidden
+    first = hiddens[0]
+    if isinstance(first,torch.Tensor):
+        return torch.cat(hiddens)
+    elif isinstance(first,(list,tuple)):
+        return type(first)(cat_hidden(list(h)) for h in zip(*hiddens))
+    return first
+
+def tensor_bytes(tensors):
+    # Bytes of the distinct storages of tensors
+    storages = {}
+    for t in tensors:
+        storage = t.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values())
+
+def step_memory(model,run,X,device,extra_bytes=0):
+    """
+    Memory (bytes) used by run(X), the forward and backward pass of one
+    micro-batch X, plus extra_bytes (e.g. optimizer state not allocated yet).
+    On CUDA this is the allocator's peak (inf when out of memory). Otherwise
+    it is the parameters and their gradients plus the tensors saved for
+    backward (activations), which dominate the peak of a recurrent model.
+    """
+    model.zero_grad(set_to_none=True)
+    if torch.device(device).type == 'cuda':
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        try:
+            run(X)
+            peak = torch.cuda.max_memory_allocated(device)
+        except torch.cuda.OutOfMemoryError:
+            peak = float('inf')
+    else:
+        params = list(model.parameters())
+        param_ptrs = set(p.untyped_storage().data_ptr() for p in params)
+        saved = []
+        def pack(t):
+            if t.untyped_storage().data_ptr() not in param_ptrs:
+                saved.append(t)
+            return t
+        with torch.autograd.graph.saved_tensors_hooks(pack,lambda t: t):
+            run(X)
+        peak = 2*tensor_bytes(params) + tensor_bytes(saved)
+    model.zero_grad(set_to_none=True)
+    return peak + extra_bytes
+
+def probe_micro_batch(model,run,get_batch,budget_bytes,max_batch,device,
+                      extra_bytes=0):
+    """
+    Largest micro-batch size up to max_batch for which step_memory fits in
+    budget_bytes: sizes are doubled from 1 until one doesn't fit, then
+    bisected. get_batch(b) returns a batch of b samples on device. Buffers
+    (batch norm statistics) are restored afterwards. Returns 1 (with a
+    warning) if even 1 sample doesn't fit.
+    """
+    buffers = {name:b.clone() for name,b in model.named_buffers()}
+    def fits(b):
+        peak = step_memory(model,run,get_batch(b),device,extra_bytes)
+        print("Micro-batch %d: %.1f MB" % (b,peak / 2**20))
+        return peak <= budget_bytes
+    good = 0 # largest size that fits
+    b = 1
+    while b <= max_batch and fits(b):
+        good = b
+        b *= 2
+    bad = min(b,max_batch + 1) # smallest size that doesn't fit
+    while bad - good > 1:
+        mid = (good + bad) // 2
+        if fits(mid):
+            good = mid
+        else:
+            bad = mid
+    with torch.no_grad():
+        for name,b in model.named_buffers():
+            b.copy_(buffers[name])
+    if good == 0:
+        print("Warning: a micro-batch of 1 doesn't fit the memory budget")
+        good = 1
+    return good
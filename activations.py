@@ -28,7 +28,12 @@ class SatLU(nn.Module):
         elif act == 'sigmoid':
             self.activation = nn.Sigmoid()
     def forward(self,input):
-        if self.act in ['hardtanh','sigmoid']:
-            return self.activation(input)
-        elif self.act == 'logsigmoid':
-            return self.activation(input) + torch.tensor(self.pixel_max)
+        # Saturation is numerically sensitive: computed in fp32 or better
+        # (half precision inputs are upcast, fp32 and fp64 are kept)
+        with torch.autocast(device_type=input.device.type,enabled=False):
+            if input.dtype in (torch.float16,torch.bfloat16):
+                input = input.float()
+            if self.act in ['hardtanh','sigmoid']:
+                return self.activation(input)
+            elif self.act == 'logsigmoid':
+                return self.activation(input) + torch.tensor(self.pixel_max)
@@ -0,0 +1,400 @@
+# Script for benchmarking memory and compute trade-offs of model options
+import copy
+import time
+import resource
+import numpy as np
+
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+
+from data import *
+from custom_losses import *
+from utils import *
+from train import parser as train_parser
+from train import get_model
+
+# Model and training options are the same as in train.py
+parser = child_parser(train_parser)
+parser.add_argument('--benchmark', choices=['grad_checkpoint','bf16','compile',
+                                         'memory_format','fused_gates',
+                                         'static_input','R_cell_type'],
+                    default='grad_checkpoint',
+                    help='Which option to benchmark')
+parser.add_argument('--seed', type=int, default=0,
+                    help='Random seed for model initialization and inputs')
+parser.add_argument('--bench_height', type=int, default=128,
+                    help='Height of random input images')
+parser.add_argument('--bench_width', type=int, default=160,
+                    help='Width of random input images')
+parser.add_argument('--bench_iters', type=int, default=5,
+                    help='Number of timed iterations for each setting')
+parser.add_argument('--bench_real_data', type=str2bool, default=False,
+                    help='Use batches from the training set rather than ' +
+                         'random inputs')
+parser.add_argument('--bench_grad_checkpoints', type=int, nargs='+',
+                    default=[0,1,2,5],
+                    help='Values of grad_checkpoint to compare')
+
+def peak_memory_mb(device):
+    # Peak memory of this process (each setting runs in its own process)
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+def random_input(args,device):
+    torch.manual_seed(args.seed)
+    X = torch.rand(args.batch_size,args.seq_len,args.in_channels,
+                   args.bench_height,args.bench_width)
+    return X.to(device)
+
+def get_batches(args,device):
+    # Fixed list of bench_iters batches, shared by all settings
+    if not args.bench_real_data:
+        torch.manual_seed(args.seed)
+        size = (args.batch_size,args.seq_len,args.in_channels,
+                args.bench_height,args.bench_width)
+        return [torch.rand(size).to(device) for i in range(args.bench_iters)]
+    if args.dataset == 'KITTI':
+        train_data = KITTI(args.train_data_path,args.train_sources_path,
+                           args.seq_len)
+    elif args.dataset == 'CCN':
+        downsample_size = (args.downsample_size,args.downsample_size)
+        train_data = CCN(args.train_data_path,args.seq_len,
+                         downsample_size=downsample_size,
+                         last_only=args.last_only)
+    train_loader = DataLoader(train_data,args.batch_size,shuffle=False)
+    batches = []
+    for X in train_loader:
+        batches.append(X.to(device))
+        if len(batches) == args.bench_iters:
+            break
+    return batches
+
+def time_train_iters(model,X,args):
+    # Average time of forward + backward over bench_iters iterations
+    loss_fn = get_loss_fn(args.loss,args.layer_lambdas).to(X.device)
+    times = []
+    for i in range(args.bench_iters + 1): # first iteration is warm-up
+        start_t = time.time()
+        output = model(X)
+        if args.loss == 'E':
+            loss = loss_fn(output)
+        else:
+            loss = loss_fn(output,X[:,1:,:,:,:])
+        loss.backward()
+        model.zero_grad()
+        if i > 0:
+            times.append(time.time() - start_t)
+    return np.mean(times)
+
+def train_iters_worker(args,queue):
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda:0" if use_cuda else "cpu")
+    torch.manual_seed(args.seed)
+    model_out = 'error' if args.loss == 'E' else 'pred'
+    model = get_model(args,model_out,device)
+    model.to(device)
+    model.train()
+    X = random_input(args,device)
+    ave_time = time_train_iters(model,X,args)
+    queue.put((ave_time,peak_memory_mb(device)))
+
+def benchmark_grad_checkpoint(args):
+    msg = "grad_checkpoint is only available for PredNet and LadderNet"
+    assert args.model_type in ['PredNet','LadderNet'], msg
+    # Each setting runs in a fresh process so peak memory is not shared
+    ctx = mp.get_context('spawn')
+    results = []
+    for grad_checkpoint in args.bench_grad_checkpoints:
+        bench_args = copy.deepcopy(args)
+        bench_args.grad_checkpoint = grad_checkpoint
+        queue = ctx.Queue()
+        p = ctx.Process(target=train_iters_worker,args=(bench_args,queue))
+        p.start()
+        ave_time,peak_mb = queue.get()
+        p.join()
+        results.append((grad_checkpoint,ave_time,peak_mb))
+        print("grad_checkpoint: %d, ave iter time: %.3fs, peak memory: %.1fMB"
+              % (grad_checkpoint,ave_time,peak_mb))
+
+    # Report relative to no checkpointing
+    base_time = results[0][1]
+    base_mb = results[0][2]
+    print("%-16s %-12s %-10s %-14s %-10s" % ('grad_checkpoint','time (s)',
+                                             'x time','peak mem (MB)','x mem'))
+    for grad_checkpoint,ave_time,peak_mb in results:
+        print("%-16d %-12.3f %-10.2f %-14.1f %-10.2f" % (grad_checkpoint,
+                                                         ave_time,
+                                                         ave_time/base_time,
+                                                         peak_mb,
+                                                         peak_mb/base_mb))
+
+def train_loss_curve(args,batches,device,bf16):
+    # Short training run from a fixed initialization
+    torch.manual_seed(args.seed)
+    model_out = 'error' if args.loss == 'E' else 'pred'
+    model = get_model(args,model_out,device)
+    model.to(device)
+    model.train()
+    loss_fn = get_loss_fn(args.loss,args.layer_lambdas).to(device)
+    optimizer = optim.Adam(model.parameters(),lr=args.learning_rate)
+    losses = []
+    start_t = time.time()
+    for X in batches:
+        optimizer.zero_grad()
+        with bf16_autocast(device,bf16):
+            output = model(X)
+        if args.loss == 'E':
+            loss = loss_fn(output)
+        else:
+            loss = loss_fn(output.float(),X[:,1:,:,:,:])
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.data.item())
+    ave_time = (time.time() - start_t) / len(batches)
+    return np.array(losses),ave_time
+
+def benchmark_bf16(args):
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda:0" if use_cuda else "cpu")
+    batches = get_batches(args,device)
+    fp32_losses,fp32_time = train_loss_curve(args,batches,device,False)
+    bf16_losses,bf16_time = train_loss_curve(args,batches,device,True)
+
+    print("%-6s %-14s %-14s %-10s" % ('iter','fp32 loss','bf16 loss',
+                                      'rel diff'))
+    rel_diffs = np.abs(bf16_losses - fp32_losses) / np.abs(fp32_losses)
+    for i in range(len(batches)):
+        print("%-6d %-14.6f %-14.6f %-10.4f" % (i+1,fp32_losses[i],
+                                                bf16_losses[i],rel_diffs[i]))
+    print("Mean relative loss difference: %.4f" % np.mean(rel_diffs))
+    print("Max relative loss difference: %.4f" % np.max(rel_diffs))
+    print("Ave iter time fp32: %.3fs, bf16: %.3fs (speedup %.2fx)" % (
+          fp32_time,bf16_time,fp32_time/bf16_time))
+
+def count_graph_breaks(model,X):
+    # Trace the whole forward (all time steps) with dynamo
+    import torch._dynamo
+    torch._dynamo.reset()
+    explanation = torch._dynamo.explain(model)(X)
+    torch._dynamo.reset()
+    return explanation.graph_break_count,explanation.break_reasons
+
+def benchmark_compile(args):
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda:0" if use_cuda else "cpu")
+    torch.manual_seed(args.seed)
+    model_out = 'error' if args.loss == 'E' else 'pred'
+    model = get_model(args,model_out,device)
+    model.to(device)
+    model.train()
+    X = random_input(args,device)
+
+    n_breaks,reasons = count_graph_breaks(model,X)
+    print("Graph breaks in forward: %d" % n_breaks)
+    for reason in reasons:
+        print("  %s" % reason.reason)
+
+    eager_time = time_train_iters(model,X,args)
+    compile_model(model)
+    start_t = time.time()
+    time_train_iters(model,X,args) # includes compilation
+    compile_time = time.time() - start_t
+    compiled_time = time_train_iters(model,X,args)
+    print("%-10s %-12s" % ('mode','time (s)'))
+    print("%-10s %-12.3f" % ('eager',eager_time))
+    print("%-10s %-12.3f" % ('compiled',compiled_time))
+    print("Speedup: %.2fx (compilation and warm-up took %.1fs)" % (
+          eager_time/compiled_time,compile_time))
+
+def time_eval_iters(model,X,args):
+    # Average time of forward only (e.g. extracting representations)
+    times = []
+    with torch.no_grad():
+        for i in range(args.bench_iters + 1): # first iteration is warm-up
+            start_t = time.time()
+            model(X)
+            if i > 0:
+                times.append(time.time() - start_t)
+    return np.mean(times)
+
+def benchmark_memory_format(args):
+    msg = "memory_format is only available for PredNet and LadderNet"
+    assert args.model_type in ['PredNet','LadderNet'], msg
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda:0" if use_cuda else "cpu")
+    X = random_input(args,device)
+    results = []
+    for memory_format in ['contiguous','channels_last']:
+        bench_args = copy.deepcopy(args)
+        bench_args.memory_format = memory_format
+        torch.manual_seed(args.seed)
+        model_out = 'error' if args.loss == 'E' else 'pred'
+        model = get_model(bench_args,model_out,device)
+        model.to(device)
+        model.train()
+        train_time = time_train_iters(model,X,args)
+        model.eval()
+        model.output = 'rep'
+        eval_time = time_eval_iters(model,X,args)
+        results.append((memory_format,train_time,eval_time))
+
+    base_train = results[0][1]
+    base_eval = results[0][2]
+    print("%-16s %-14s %-10s %-14s %-10s" % ('memory_format','train (s)',
+                                             'speedup','forward (s)',
+                                             'speedup'))
+    for memory_format,train_time,eval_time in results:
+        print("%-16s %-14.3f %-10.2f %-14.3f %-10.2f" % (memory_format,
+                                                         train_time,
+                                                         base_train/train_time,
+                                                         eval_time,
+                                                         base_eval/eval_time))
+
+def benchmark_fused_gates(args):
+    msg = "fused_gates is not available for MultiConvLSTM"
+    assert args.model_type != 'MultiConvLSTM', msg
+    # Each setting runs in a fresh process so peak memory is not shared
+    ctx = mp.get_context('spawn')
+    results = []
+    for fused_gates in [False,True]:
+        bench_args = copy.deepcopy(args)
+        bench_args.fused_gates = fused_gates
+        queue = ctx.Queue()
+        p = ctx.Process(target=train_iters_worker,args=(bench_args,queue))
+        p.start()
+        ave_time,peak_mb = queue.get()
+        p.join()
+        results.append((fused_gates,ave_time,peak_mb))
+
+    base_time = results[0][1]
+    base_mb = results[0][2]
+    print("%-12s %-12s %-10s %-14s %-10s" % ('fused_gates','time (s)',
+                                             'x time','peak mem (MB)','x mem'))
+    for fused_gates,ave_time,peak_mb in results:
+        print("%-12s %-12.3f %-10.2f %-14.1f %-10.2f" % (fused_gates,ave_time,
+                                                         ave_time/base_time,
+                                                         peak_mb,
+                                                         peak_mb/base_mb))
+
+def benchmark_static_input(args):
+    msg = "static_input is available for PredNet, LadderNet and ConvLSTM"
+    assert args.model_type in ['PredNet','LadderNet','ConvLSTM'], msg
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda:0" if use_cuda else "cpu")
+    # Same image at every time step (as in CCN with last_only)
+    X = random_input(args,device)
+    X = X[:,-1:].expand_as(X).contiguous()
+    model_out = 'pred' if args.model_type == 'ConvLSTM' else 'rep'
+    torch.manual_seed(args.seed)
+    model = get_model(args,model_out,device)
+    model.to(device)
+    model.eval()
+    results = []
+    outputs = []
+    for static_input in ['never','detect','always']:
+        model.static_input = static_input
+        eval_time = time_eval_iters(model,X,args)
+        with torch.no_grad():
+            outputs.append(model(X))
+        results.append((static_input,eval_time))
+
+    base_time = results[0][1]
+    print("%-14s %-14s %-10s %-10s" % ('static_input','forward (s)','speedup',
+                                       'same out'))
+    for (static_input,eval_time),output in zip(results,outputs):
+        if model_out == 'rep':
+            same = all(torch.equal(a,b) for a,b in zip(output,outputs[0]))
+        else:
+            same = torch.equal(output,outputs[0])
+        print("%-14s %-14.3f %-10.2f %-10s" % (static_input,eval_time,
+                                               base_time/eval_time,same))
+    if args.model_type == 'PredNet' and not args.send_acts:
+        print("Note: PredNet without send_acts has no input-side results to "
+              "reuse (A above layer 0 comes from errors, which change every "
+              "step), so no speedup is expected; use send_acts")
+
+def count_conv_flops(model,X):
+    # FLOPs (2 x multiply-adds) of all convs in one forward pass, from the
+    # output size of each conv call
+    flops = [0]
+    def hook(conv,inputs,output):
+        k_h,k_w = conv.kernel_size
+        in_per_group = conv.in_channels // conv.groups
+        flops[0] += 2 * output.numel() * in_per_group * k_h * k_w
+    handles = [m.register_forward_hook(hook) for m in model.modules()
+               if isinstance(m,nn.Conv2d)]
+    with torch.no_grad():
+        model(X)
+    for handle in handles:
+        handle.remove()
+    return flops[0]
+
+def R_cell_params(model):
+    # Parameters in the gate convs of R cells (the cell of ConvLSTM)
+    if hasattr(model,'R_layers'):
+        cells = [cell for cell in model.R_layers if cell is not None]
+    else:
+        cells = [model.cell]
+    return sum(p.numel() for cell in cells for p in cell.parameters())
+
+def benchmark_R_cell_type(args):
+    msg = "R_cell_type is available for PredNet, LadderNet and ConvLSTM"
+    assert args.model_type in ['PredNet','LadderNet','ConvLSTM'], msg
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda:0" if use_cuda else "cpu")
+    X = random_input(args,device)
+    results = []
+    for R_cell_type in cell_types:
+        bench_args = copy.deepcopy(args)
+        bench_args.R_cell_type = R_cell_type
+        bench_args.fused_gates = False
+        torch.manual_seed(args.seed)
+        model_out = 'error' if args.loss == 'E' else 'pred'
+        model = get_model(bench_args,model_out,device)
+        model.to(device)
+        model.eval()
+        gflops = count_conv_flops(model,X) / 1e9
+        eval_time = time_eval_iters(model,X,args)
+        model.train()
+        train_time = time_train_iters(model,X,args)
+        results.append((R_cell_type,R_cell_params(model),gflops,eval_time,
+                        train_time))
+
+    base_gflops = results[0][2]
+    base_eval = results[0][3]
+    print("%-12s %-12s %-10s %-8s %-12s %-8s %-12s" % ('R_cell_type',
+                                                       'R params','GFLOPs',
+                                                       'x FLOPs','forward (s)',
+                                                       'speedup','train (s)'))
+    for R_cell_type,params,gflops,eval_time,train_time in results:
+        print("%-12s %-12d %-10.2f %-8.2f %-12.3f %-8.2f %-12.3f" % (
+              R_cell_type,params,gflops,gflops/base_gflops,eval_time,
+              base_eval/eval_time,train_time))
+
+def main(args):
+    print("Input size: (%d,%d,%d,%d,%d)" % (args.batch_size,args.seq_len,
+                                            args.in_channels,args.bench_height,
+                                            args.bench_width))
+    if args.benchmark == 'grad_checkpoint':
+        benchmark_grad_checkpoint(args)
+    elif args.benchmark == 'bf16':
+        benchmark_bf16(args)
+    elif args.benchmark == 'compile':
+        benchmark_compile(args)
+    elif args.benchmark == 'memory_format':
+        benchmark_memory_format(args)
+    elif args.benchmark == 'fused_gates':
+        benchmark_fused_gates(args)
+    elif args.benchmark == 'static_input':
+        benchmark_static_input(args)
+    elif args.benchmark == 'R_cell_type':
+        benchmark_R_cell_type(args)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print(args)
+    main(args)
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 # Custom error loss function for PredNet
 class ELoss(nn.Module):
@@ -7,10 +8,13 @@ class ELoss(nn.Module):
         super(ELoss,self).__init__()
         nb_layers = len(layer_lambdas)
         layer_lambdas = torch.tensor(layer_lambdas)
-        self.layer_lambdas = layer_lambdas.view(1,nb_layers)
+        # Buffer so it moves with .to(device) along with the errors
+        self.register_buffer('layer_lambdas',layer_lambdas.view(1,nb_layers))
     def forward(self,errors):
-        weighted_errors = errors*self.layer_lambdas
-        total_error = torch.sum(weighted_errors)
+        # Reduction always computed in fp32
+        with torch.autocast(device_type=errors.device.type,enabled=False):
+            weighted_errors = errors.float()*self.layer_lambdas
+            total_error = torch.sum(weighted_errors)
         return total_error
 
 def get_loss_fn(loss,layer_lambdas):
@@ -23,3 +27,44 @@ def get_loss_fn(loss,layer_lambdas):
     elif loss == 'BCE':
         loss_fn = nn.BCELoss()
     return loss_fn
+
+# Distillation loss: student predictions and reps matched to a teacher's
+class DistillLoss(nn.Module):
+    def __init__(self,student_channels,teacher_channels,pred_weight,
+                 rep_weight):
+        super(DistillLoss,self).__init__()
+        self.pred_weight = pred_weight
+        self.rep_weight = rep_weight
+        # Student rep layers matched to teacher layers spread over the same
+        # depth, through 1x1 convs to the teacher's channels
+        n_student = len(student_channels)
+        n_teacher = len(teacher_channels)
+        self.layer_map = [round(l*(n_teacher-1)/max(n_student-1,1))
+                          for l in range(n_student)]
+        adapters = []
+        for l,channels in enumerate(student_channels):
+            out_channels = teacher_channels[self.layer_map[l]]
+            adapters.append(nn.Conv2d(channels,out_channels,1))
+        self.adapters = nn.ModuleList(adapters)
+    def forward(self,outputs,teacher_outputs):
+        # Computed in fp32
+        any_output = next(iter(outputs.values()))
+        if isinstance(any_output,list):
+            any_output = any_output[0]
+        with torch.autocast(device_type=any_output.device.type,enabled=False):
+            loss = 0.0
+            if self.pred_weight > 0:
+                preds = outputs['pred'].float()
+                teacher_preds = teacher_outputs['pred'].float()
+                pred_loss = F.mse_loss(preds,teacher_preds)
+                loss = loss + self.pred_weight*pred_loss
+            if self.rep_weight > 0:
+                rep_loss = 0.0
+                for l,rep in enumerate(outputs['rep']):
+                    teacher_rep = teacher_outputs['rep'][self.layer_map[l]]
+                    rep = self.adapters[l](rep.float())
+                    if rep.shape[2:] != teacher_rep.shape[2:]:
+                        rep = F.interpolate(rep,teacher_rep.shape[2:])
+                    rep_loss = rep_loss + F.mse_loss(rep,teacher_rep.float())
+                loss = loss + self.rep_weight*rep_loss/len(self.adapters)
+        return loss
@@ -3,15 +3,17 @@ import numpy as np
 import hickle as hkl
 import torch
 import torch.nn.functional as F
-from torch.utils.data import Dataset,DataLoader
+from torch.utils.data import Dataset,DataLoader,Sampler
 from PIL import Image
 
 class KITTI(Dataset):
-    def __init__(self,X_hkl,sources_hkl,seq_len,norm=True):
+    def __init__(self,X_hkl,sources_hkl,seq_len,norm=True,stride=None):
         self.X_hkl = X_hkl
         self.sources_hkl = sources_hkl
         self.seq_len = seq_len
         self.norm = norm # normalize pixel values to [0,1]
+        # Windows start every stride images (overlapping if < seq_len)
+        self.stride = seq_len if stride is None else stride
         # Load source data
         print("Loading sources data from ", sources_hkl)
         self.sources = hkl.load(sources_hkl)
@@ -30,13 +32,17 @@ class KITTI(Dataset):
             end_source = self.sources[end_loc]
             if cur_source == end_source:
                 self.start_end_idxs.append((cur_loc,end_loc))
-                cur_loc += seq_len
+                cur_loc += self.stride
             else:
                 cur_loc += 1
         print("Dataset contains %d sequences" % len(self.start_end_idxs))
 
     def __getitem__(self,index):
         start,end = self.start_end_idxs[index]
+        return self.get_frames(start,end)
+
+    def get_frames(self,start,end):
+        # Images start to end (inclusive) as a tensor
         img_seq = self.X[start:end+1]
         img_tensor = torch.tensor(img_seq,dtype=torch.float)
         img_tensor = img_tensor.permute(0,3,1,2) # (len,channels,height,width)
@@ -47,6 +53,127 @@ class KITTI(Dataset):
     def __len__(self):
         return len(self.start_end_idxs)
 
+class CachedSubset(Dataset):
+    # Fixed random subset of n sequences of a dataset, loaded once and kept
+    # in memory (e.g. for cheap repeated evaluation)
+    def __init__(self,dataset,n,seed=0):
+        rng = np.random.RandomState(seed)
+        n = min(n,len(dataset))
+        self.ids = rng.choice(len(dataset),size=n,replace=False)
+        self.data = [dataset[i] for i in self.ids]
+
+    def __getitem__(self,index):
+        return self.data[index]
+
+    def __len__(self):
+        return len(self.data)
+
+def drive_windows(dataset,overlap=False):
+    # Group KITTI windows into drives: lists of indices of windows from the
+    # same source that follow each other without a gap (or overlap)
+    drives = []
+    drive = []
+    prev_start,prev_end = None,None
+    for i,(start,end) in enumerate(dataset.start_end_idxs):
+        if drive:
+            if overlap:
+                contiguous = prev_start < start <= prev_end + 1
+            else:
+                contiguous = start == prev_end + 1
+            same_source = dataset.sources[start] == dataset.sources[prev_end]
+            if not (contiguous and same_source):
+                drives.append(drive)
+                drive = []
+        drive.append(i)
+        prev_start,prev_end = start,end
+    if drive:
+        drives.append(drive)
+    return drives
+
+class DriveSampler(Sampler):
+    """
+    Batch sampler for truncated BPTT on KITTI. Each drive is cut into runs of
+    run_len consecutive seq_len windows, and each position in the batch walks
+    through one run in order, so the recurrent state at the end of one batch
+    can be carried over to the next. A new group of runs starts every run_len
+    batches, which is where the state should be reset.
+    """
+    def __init__(self,dataset,batch_size,run_len,shuffle=True,seed=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.run_len = run_len
+        self.shuffle = shuffle
+        self.seed = seed # order of each epoch from seed + epoch if given
+        self.epoch = 0
+        self.start = 0 # batches to skip (resuming mid-epoch)
+        drives = drive_windows(dataset)
+        # Cut drives into runs of run_len consecutive windows
+        self.runs = []
+        for drive in drives:
+            for r in range(len(drive) // run_len):
+                self.runs.append(drive[r*run_len:(r+1)*run_len])
+        print("Drive sampler has %d runs of %d windows" % (len(self.runs),
+                                                          run_len))
+
+    def set_epoch(self,epoch,start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        if self.shuffle and self.seed is not None:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            order = rng.permutation(len(self.runs))
+        elif self.shuffle:
+            order = np.random.permutation(len(self.runs))
+        else:
+            order = np.arange(len(self.runs))
+        start = self.start
+        self.start = 0
+        n_groups = len(self.runs) // self.batch_size
+        for g in range(n_groups):
+            group_ids = order[g*self.batch_size:(g+1)*self.batch_size]
+            group = [self.runs[i] for i in group_ids]
+            for c in range(self.run_len):
+                if g*self.run_len + c >= start:
+                    yield [run[c] for run in group]
+
+    def __len__(self):
+        return (len(self.runs) // self.batch_size) * self.run_len
+
+class ResumableSampler(Sampler):
+    """
+    Batch sampler over a shuffled order of the dataset that is the same
+    for a given seed and epoch, so that after a restart the order of the
+    current epoch can be rebuilt and iteration can resume from the batch
+    where it stopped (set_epoch(epoch,start)).
+    """
+    def __init__(self,dataset,batch_size,shuffle=True,seed=0):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0 # batches to skip
+
+    def set_epoch(self,epoch,start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        n = len(self.dataset)
+        if self.shuffle:
+            rng = np.random.RandomState(self.seed + self.epoch)
+            order = rng.permutation(n)
+        else:
+            order = np.arange(n)
+        start = self.start
+        self.start = 0
+        for b in range(start,len(self)):
+            yield order[b*self.batch_size:(b+1)*self.batch_size].tolist()
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
 class CCN(Dataset):
     def __init__(self,img_dir,seq_len,norm=True,
                  return_labels=False,return_cats=False,
@@ -0,0 +1,262 @@
+# Script for exporting a single recurrent time step of a model to ONNX
+import numpy as np
+
+import torch
+import torch.nn as nn
+
+from data import *
+from PredNet import *
+from ConvLSTM import *
+from Ladder import *
+from utils import *
+from train import parser as train_parser
+from train import get_model
+
+# Model options are the same as in train.py
+parser = child_parser(train_parser)
+parser.add_argument('--model_type', choices=['PredNet','LadderNet','ConvLSTM'],
+                    default='PredNet', help='Type of model to export.')
+parser.add_argument('--onnx_path', default='../model_weights/prednet_step.onnx',
+                    help='Path to save the exported ONNX graph')
+parser.add_argument('--export_height', type=int, default=128,
+                    help='Height of example input used for tracing ' +
+                         '(height is a dynamic axis in the exported graph)')
+parser.add_argument('--export_width', type=int, default=160,
+                    help='Width of example input used for tracing ' +
+                         '(width is a dynamic axis in the exported graph)')
+parser.add_argument('--opset', type=int, default=17,
+                    help='ONNX opset version')
+parser.add_argument('--check_parity', type=str2bool, default=True,
+                    help='Compare ONNX Runtime predictions with the eager ' +
+                         'model over a full sequence')
+parser.add_argument('--parity_real_data', type=str2bool, default=False,
+                    help='Check parity on a sequence from the test set ' +
+                         'rather than a random input')
+parser.add_argument('--parity_height', type=int, default=None,
+                    help='Height of parity check input (different from ' +
+                         'export_height to exercise the dynamic axes)')
+parser.add_argument('--parity_width', type=int, default=None,
+                    help='Width of parity check input')
+parser.add_argument('--parity_batch_size', type=int, default=2,
+                    help='Batch size of parity check input')
+parser.add_argument('--seed', type=int, default=0,
+                    help='Random seed for example and parity inputs')
+parser.add_argument('--parity_atol', type=float, default=1e-4,
+                    help='Max absolute difference allowed by parity check')
+
+class PredNetStep(nn.Module):
+    """
+    One time step of PredNet with states as explicit tensors:
+        inputs: A_t, H_0..H_L-1, C_0..C_L-1, E_0..E_L-1
+        outputs: pred (prediction of A_t), new H, C and E
+    States at the start of a sequence are zeros (PredNet.initialize) and
+    the prediction made on the first step is usually ignored.
+    """
+    def __init__(self,model):
+        super(PredNetStep,self).__init__()
+        self.model = model
+        self.nb_layers = model.nb_layers
+
+    def forward(self,A_t,*states):
+        L = self.nb_layers
+        H_tm1 = list(states[:L])
+        C_tm1 = list(states[L:2*L])
+        E_tm1 = list(states[2*L:])
+        (R_t,E_t,Ahat_0),((H_t,C_t),E_t) = self.model.step(A_t,((H_tm1,C_tm1),
+                                                                 E_tm1))
+        return tuple([Ahat_0] + H_t + C_t + E_t)
+
+    def state_names(self):
+        L = self.nb_layers
+        return (['H_%d' % l for l in range(L)] +
+                ['C_%d' % l for l in range(L)] +
+                ['E_%d' % l for l in range(L)])
+
+    def state_layers(self):
+        # Layer of each state (for naming its spatial axes)
+        return list(range(self.nb_layers)) * 3
+
+    def initial_states(self,X):
+        (H_0,C_0),E_0 = self.model.initialize(X)
+        return H_0 + C_0 + E_0
+
+class LadderNetStep(nn.Module):
+    """
+    One time step of LadderNet with states as explicit tensors:
+        inputs: X_t, H and C of each R cell, Ahat_0..Ahat_L-1
+        outputs: pred (prediction of X_tp1), new H, C and Ahat
+    With no_R0 there is no R cell (and no state) in layer 0. Initial
+    Ahat states are zeros: they only affect errors, which are not exported.
+    """
+    def __init__(self,model):
+        super(LadderNetStep,self).__init__()
+        self.model = model
+        self.nb_layers = model.nb_layers
+        self.R_ids = [l for l in range(model.nb_layers)
+                      if not (l == 0 and model.no_R0)]
+
+    def forward(self,X_t,*states):
+        n_R = len(self.R_ids)
+        H_tm1 = [None] * self.nb_layers
+        C_tm1 = [None] * self.nb_layers
+        for i,l in enumerate(self.R_ids):
+            H_tm1[l] = states[i]
+            C_tm1[l] = states[n_R+i]
+        Ahat_tm1 = list(states[2*n_R:])
+        _,((H_t,C_t),Ahat_t) = self.model.step(X_t,((H_tm1,C_tm1),Ahat_tm1))
+        H_t = [H_t[l] for l in self.R_ids]
+        C_t = [C_t[l] for l in self.R_ids]
+        return tuple([Ahat_t[0]] + H_t + C_t + Ahat_t)
+
+    def state_names(self):
+        return (['H_%d' % l for l in self.R_ids] +
+                ['C_%d' % l for l in self.R_ids] +
+                ['Ahat_%d' % l for l in range(self.nb_layers)])
+
+    def state_layers(self):
+        return self.R_ids + self.R_ids + list(range(self.nb_layers))
+
+    def initial_states(self,X):
+        H_0,C_0 = self.model.initialize(X)
+        H_0 = [H_0[l] for l in self.R_ids]
+        C_0 = [C_0[l] for l in self.R_ids]
+        # Ahat has the shape of A in each layer: get it from one step
+        _,(_,Ahat_t) = self.model.step(X[:,0],(self.model.initialize(X),None))
+        Ahat_0 = [torch.zeros_like(Ahat_l) for Ahat_l in Ahat_t]
+        return H_0 + C_0 + Ahat_0
+
+class ConvLSTMStep(nn.Module):
+    """
+    One time step of ConvLSTM with states as explicit tensors:
+        inputs: X_t, H, C
+        outputs: pred (prediction of X_tp1), new H and C
+    """
+    def __init__(self,model):
+        super(ConvLSTMStep,self).__init__()
+        self.model = model
+
+    def forward(self,X_t,H_tm1,C_tm1):
+        R_t,(H_t,C_t) = self.model.cell(X_t,(H_tm1,C_tm1))
+        return R_t,H_t,C_t
+
+    def state_names(self):
+        return ['H_0','C_0']
+
+    def state_layers(self):
+        return [0,0]
+
+    def initial_states(self,X):
+        H_0,C_0 = self.model.initialize(X)
+        return [H_0,C_0]
+
+def get_step_model(model):
+    if isinstance(model,PredNet):
+        return PredNetStep(model)
+    elif isinstance(model,LadderNet):
+        return LadderNetStep(model)
+    elif isinstance(model,ConvLSTM):
+        return ConvLSTMStep(model)
+    raise ValueError("ONNX export not supported for %s" % type(model).__name__)
+
+def pred_steps(step_model,X):
+    # Predictions from running the step model, aligned with model(X) when
+    # model.output == 'pred': PredNet predicts the current input (first
+    # step ignored), LadderNet and ConvLSTM predict the next input (last
+    # step ignored)
+    if isinstance(step_model,PredNetStep):
+        return slice(1,None)
+    return slice(0,X.shape[1]-1)
+
+def export(step_model,X,args):
+    X_t = X[:,0]
+    states = step_model.initial_states(X)
+    state_names = step_model.state_names()
+    state_layers = step_model.state_layers()
+    input_names = ['input'] + state_names
+    output_names = ['pred'] + [name + '_out' for name in state_names]
+
+    # Batch and spatial dims are dynamic. Each layer has its own spatial
+    # dims (halved by max pooling in each layer).
+    dynamic_axes = {'input':{0:'batch',2:'height_0',3:'width_0'},
+                    'pred':{0:'batch',2:'height_0',3:'width_0'}}
+    for name,l in zip(state_names,state_layers):
+        axes = {0:'batch',2:'height_%d' % l,3:'width_%d' % l}
+        dynamic_axes[name] = axes
+        dynamic_axes[name + '_out'] = axes
+
+    torch.onnx.export(step_model,tuple([X_t] + states),args.onnx_path,
+                      input_names=input_names,output_names=output_names,
+                      dynamic_axes=dynamic_axes,opset_version=args.opset)
+    print("Saved ONNX graph of one time step at %s" % args.onnx_path)
+
+def check_parity(step_model,X,args):
+    # Run the exported step over the full sequence in ONNX Runtime, feeding
+    # back its state outputs, and compare with the eager model
+    import onnxruntime as ort
+    session = ort.InferenceSession(args.onnx_path,
+                                   providers=['CPUExecutionProvider'])
+    state_names = step_model.state_names()
+    states = [s.numpy() for s in step_model.initial_states(X)]
+    X_np = X.numpy()
+    onnx_preds = []
+    for t in range(X.shape[1]):
+        feed = {'input':X_np[:,t]}
+        feed.update(zip(state_names,states))
+        outputs = session.run(None,feed)
+        onnx_preds.append(outputs[0])
+        states = outputs[1:]
+    onnx_preds = np.stack(onnx_preds,axis=1)[:,pred_steps(step_model,X)]
+
+    step_model.model.output = 'pred'
+    eager_preds = step_model.model(X).numpy()
+    max_diff = np.max(np.abs(onnx_preds - eager_preds))
+    print("Parity check on input of size %s" % (tuple(X.shape),))
+    print("Max abs difference over %d predictions: %.3e" % (
+          eager_preds.shape[1],max_diff))
+    passed = max_diff <= args.parity_atol
+    print("Parity check %s (atol = %.1e)" % ('passed' if passed else 'FAILED',
+                                            args.parity_atol))
+    return passed
+
+def get_parity_input(args):
+    if args.parity_real_data:
+        if args.dataset == 'KITTI':
+            test_data = KITTI(args.test_data_path,args.test_sources_path,
+                              args.seq_len)
+        elif args.dataset == 'CCN':
+            downsample_size = (args.downsample_size,args.downsample_size)
+            test_data = CCN(args.test_data_path,args.seq_len,
+                            downsample_size=downsample_size,
+                            last_only=args.last_only)
+        X = [test_data[i] for i in range(args.parity_batch_size)]
+        return torch.stack(X)
+    height = args.parity_height or args.export_height
+    width = args.parity_width or args.export_width
+    torch.manual_seed(args.seed)
+    return torch.rand(args.parity_batch_size,args.seq_len,args.in_channels,
+                      height,width)
+
+def main(args):
+    # Export and check on CPU
+    device = torch.device("cpu")
+    args.fused_gates = False # same weights, fused update can't be exported
+    model = get_model(args,'pred',device)
+    if args.load_weights_from is not None:
+        model.load_state_dict(torch.load(args.load_weights_from,
+                                         map_location=device))
+    model.eval()
+    step_model = get_step_model(model)
+
+    with torch.no_grad():
+        torch.manual_seed(args.seed)
+        X = torch.rand(1,args.seq_len,args.in_channels,args.export_height,
+                       args.export_width)
+        export(step_model,X,args)
+        if args.check_parity:
+            X = get_parity_input(args)
+            check_parity(step_model,X,args)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print(args)
+    main(args)
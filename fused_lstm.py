@@ -0,0 +1,120 @@
+# Fused gate update for convolutional LSTM cells
+import weakref
+import torch
+import torch.nn.functional as F
+
+# Activations supported by the fused update (same as utils.get_activation)
+fused_acts = ['sigmoid','tanh','relu','hardsigmoid']
+
+def activate(x,act):
+    if act == 'sigmoid':
+        return torch.sigmoid(x)
+    elif act == 'tanh':
+        return torch.tanh(x)
+    elif act == 'relu':
+        return torch.relu(x)
+    elif act == 'hardsigmoid':
+        # Same as activations.Hardsigmoid
+        return (torch.clamp(x,-2.5,2.5) + 2.5) / 5.0
+
+def activate_grad(x,y,act):
+    # Derivative of act at x, given y = act(x)
+    if act == 'sigmoid':
+        return y*(1 - y)
+    elif act == 'tanh':
+        return 1 - y*y
+    elif act == 'relu':
+        return (x > 0).to(y.dtype)
+    elif act == 'hardsigmoid':
+        return ((x > -2.5) & (x < 2.5)).to(y.dtype) / 5.0
+
+class FusedLSTMUpdate(torch.autograd.Function):
+    """
+    Elementwise part of a ConvLSTM step, from pre-activation gates to new
+    states:
+        i,f,o = gate_act(gates_i,gates_f,gates_o), g = cell_act(gates_c)
+        C_t = f*C_tm1 + i*g
+        H_t = o*out_act(C_t)
+    gates has the pre-activations of i,f,c,o stacked on the channel dim.
+    Only gates, C_tm1 and C_t are saved: gate activations are recomputed in
+    backward rather than stored.
+    """
+    @staticmethod
+    def forward(ctx,gates,C_tm1,gate_act,cell_act,out_act):
+        gates_i,gates_f,gates_c,gates_o = gates.chunk(4,dim=1)
+        i_t = activate(gates_i,gate_act)
+        f_t = activate(gates_f,gate_act)
+        g_t = activate(gates_c,cell_act)
+        o_t = activate(gates_o,gate_act)
+        C_t = f_t*C_tm1 + i_t*g_t
+        H_t = o_t*activate(C_t,out_act)
+        ctx.save_for_backward(gates,C_tm1,C_t)
+        ctx.acts = (gate_act,cell_act,out_act)
+        return H_t, C_t
+
+    @staticmethod
+    def backward(ctx,dH_t,dC_t):
+        gates,C_tm1,C_t = ctx.saved_tensors
+        gate_act,cell_act,out_act = ctx.acts
+        gates_i,gates_f,gates_c,gates_o = gates.chunk(4,dim=1)
+        i_t = activate(gates_i,gate_act)
+        f_t = activate(gates_f,gate_act)
+        g_t = activate(gates_c,cell_act)
+        o_t = activate(gates_o,gate_act)
+        a_t = activate(C_t,out_act)
+
+        # Gradient on C_t from both outputs
+        dC = dC_t + dH_t*o_t*activate_grad(C_t,a_t,out_act)
+        di = dC*g_t*activate_grad(gates_i,i_t,gate_act)
+        df = dC*C_tm1*activate_grad(gates_f,f_t,gate_act)
+        dg = dC*i_t*activate_grad(gates_c,g_t,cell_act)
+        do = dH_t*a_t*activate_grad(gates_o,o_t,gate_act)
+        dgates = torch.cat((di,df,dg,do),dim=1).to(gates.dtype)
+        dC_tm1 = (dC*f_t).to(C_tm1.dtype)
+        return dgates, dC_tm1, None, None, None
+
+def fused_lstm_update(gates,C_tm1,gate_act,cell_act,out_act):
+    return FusedLSTMUpdate.apply(gates,C_tm1,gate_act,cell_act,out_act)
+
+def compiling():
+    # True while torch.compile traces (torch.compiler needs torch >= 2.3)
+    is_compiling = getattr(getattr(torch,'compiler',None),'is_compiling',None)
+    return is_compiling is not None and is_compiling()
+
+# first conv: (key,weight,bias), kept out of the modules so that copying or
+# pickling a model never copies tensors of a graph
+stacked_cache = weakref.WeakKeyDictionary()
+
+def stacked_params(convs):
+    """
+    Weights and biases of convs stacked on the output channels. They are
+    cached (per first conv) and only concatenated again when a parameter
+    changes (optimizer step, load_state_dict, .to()) or grad mode changes,
+    rather than at every time step of every layer. When compiling, they are
+    stacked in the traced graph instead.
+    """
+    bias = convs[0].bias is not None
+    if compiling():
+        return (torch.cat([c.weight for c in convs],dim=0),
+                torch.cat([c.bias for c in convs],dim=0) if bias else None)
+    params = [p for c in convs for p in (c.weight,c.bias) if p is not None]
+    key = tuple((p.data_ptr(),p._version) for p in params)
+    key += (torch.is_grad_enabled(),)
+    cache = stacked_cache.get(convs[0])
+    if cache is None or cache[0] != key:
+        weight = torch.cat([c.weight for c in convs],dim=0)
+        if bias:
+            bias = torch.cat([c.bias for c in convs],dim=0)
+        else:
+            bias = None
+        cache = (key,weight,bias)
+        stacked_cache[convs[0]] = cache
+    return cache[1],cache[2]
+
+def stacked_conv(x,convs):
+    # One conv with the weights of several convs stacked on the output
+    # channels (same stride, padding, etc.), e.g. all gates of a ConvLSTM
+    conv = convs[0]
+    weight,bias = stacked_params(convs)
+    return F.conv2d(x,weight,bias,conv.stride,conv.padding,conv.dilation,
+                    conv.groups)
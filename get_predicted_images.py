@@ -14,6 +14,9 @@ from ConvLSTM import *
 from Ladder import *
 from StackedConvLSTM import *
 from utils import *
+from quantize import quantize_model, get_calibration_batches
+from tiling import tiled_forward
+from stream_eval import stream_windows
 
 parser = argparse.ArgumentParser()
 # Training data
@@ -35,6 +38,13 @@ parser.add_argument('--last_only',type=str2bool,default=False,
                     help='Test on sequences of static (final) images.')
 parser.add_argument('--num_seqs', type=int, default=5,
                     help='Number of (random) sequences of predictions to save')
+parser.add_argument('--eval_stride', type=int, default=None,
+                    help='Start a KITTI window every eval_stride images ' +
+                         '(overlapping windows if < seq_len). Default: seq_len')
+parser.add_argument('--stream_eval', type=str2bool, default=False,
+                    help='Predict KITTI windows from one stream per drive ' +
+                         '(PredNet or LadderNet), rather than each window ' +
+                         'from zero states')
 
 # Models
 parser.add_argument('--model_type', choices=['PredNet','ConvLSTM',
@@ -127,6 +137,52 @@ parser.add_argument('--dropout_p', type=float, default=0.0,
                     help='Proportion dropout for inputs to R cells')
 parser.add_argument('--load_weights_from', default=None,
                     help='Path to saved weights')
+parser.add_argument('--bf16', type=str2bool, default=False,
+                    help='Run model forward under bfloat16 autocast')
+parser.add_argument('--memory_format', default='contiguous',
+                    choices=['contiguous','channels_last'],
+                    help='Memory format of conv weights, states and ' +
+                         'activations (PredNet and LadderNet only)')
+parser.add_argument('--R_cell_type', default='dense', choices=cell_types,
+                    help='Gate convs of R cells (ConvLSTM cell for ' +
+                         'ConvLSTM): dense, depthwise-separable, grouped, ' +
+                         'or bottleneck (1x1 reduce before k x k conv)')
+parser.add_argument('--R_cell_groups', type=int, default=4,
+                    help='Groups of gate convs with R_cell_type grouped')
+parser.add_argument('--R_cell_reduction', type=int, default=4,
+                    help='Channel reduction of the 1x1 conv with ' +
+                         'R_cell_type bottleneck')
+parser.add_argument('--static_input', default='never',
+                    choices=['never','detect','always'],
+                    help='Reuse input-side results (A with send_acts, ' +
+                         'LadderNet encoder, ConvLSTM input convs) when the ' +
+                         'input is bit-identical to the previous step: ' +
+                         'detect checks each step, always assumes it ' +
+                         '(e.g. CCN with last_only). Outputs are unchanged.')
+parser.add_argument('--compile', type=str2bool, default=False,
+                    help='Compile the model with torch.compile ' +
+                         '(first iterations are slower while compiling)')
+parser.add_argument('--quantize', type=str2bool, default=False,
+                    help='Run an int8 quantized copy of the model on CPU, ' +
+                         'calibrated on a subset of CCN sequences')
+parser.add_argument('--calib_data_path', default='../data/ccn_images/train/',
+                    help='Path to ccn image directory used for calibration')
+parser.add_argument('--calib_batches', type=int, default=10,
+                    help='Number of batches used for calibration')
+parser.add_argument('--calib_batch_size', type=int, default=4,
+                    help='Samples per calibration batch')
+parser.add_argument('--tile_size', type=int, default=None,
+                    help='Run the model on overlapping tiles of this size ' +
+                         '(multiple of 2**(nb_layers-1)) and stitch the ' +
+                         'results, to bound memory on large frames')
+parser.add_argument('--tile_halo', type=int, default=None,
+                    help='Context around each tile. Default covers the ' +
+                         'receptive field of the model over the sequence ' +
+                         '(exact results), which grows with seq_len and ' +
+                         'for 10 KITTI steps is larger than the frame (no ' +
+                         'memory saving); smaller is cheaper but approximate')
+parser.add_argument('--tile_workers', type=int, default=1,
+                    help='Number of tiles run in parallel')
 # Hyperparameters unique to LadderNet
 parser.add_argument('--no_R0', type=str2bool, default=True,
                     help='Boolean indicating whether not to include' +
@@ -149,7 +205,7 @@ def main(args):
     # Data: Don't shuffle to keep indexes consistent
     if args.dataset == 'KITTI':
         test_data = KITTI(args.test_data_path,args.test_sources_path,
-                          args.seq_len)
+                          args.seq_len,stride=args.eval_stride)
     elif args.dataset == 'CCN':
         downsample_size = (args.downsample_size,args.downsample_size)
         test_data = CCN(args.test_data_path,args.seq_len,
@@ -167,7 +223,12 @@ def main(args):
                         args.use_1x1_out,args.FC,args.dropout_p,
                         args.send_acts,args.no_ER,args.RAhat,args.no_A_conv,
                         args.higher_satlu,args.local_grad,args.conv_dilation,
-                        args.use_BN,model_out,device)
+                        args.use_BN,model_out,device,
+                        memory_format=args.memory_format,
+                        static_input=args.static_input,
+                        R_cell_type=args.R_cell_type,
+                        R_cell_groups=args.R_cell_groups,
+                        R_cell_reduction=args.R_cell_reduction)
     elif args.model_type == 'MultiConvLSTM':
         model = MultiConvLSTM(args.in_channels,args.R_stack_sizes,
                               args.R_kernel_sizes,args.use_satlu,args.pixel_max,
@@ -178,7 +239,11 @@ def main(args):
     elif args.model_type == 'ConvLSTM':
         model = ConvLSTM(args.in_channels,args.hidden_channels,args.kernel_size,
                          args.LSTM_act,args.LSTM_c_act,args.out_act,
-                         args.bias,args.FC,device)
+                         args.bias,args.FC,device,
+                         static_input=args.static_input,
+                         R_cell_type=args.R_cell_type,
+                         R_cell_groups=args.R_cell_groups,
+                         R_cell_reduction=args.R_cell_reduction)
     elif args.model_type == 'LadderNet':
         model = LadderNet(args.in_channels,args.stack_sizes,args.R_stack_sizes,
                           args.A_kernel_sizes,args.Ahat_kernel_sizes,
@@ -188,7 +253,11 @@ def main(args):
                           args.LSTM_act,args.LSTM_c_act,args.bias,
                           args.use_1x1_out,args.FC,args.no_R0,args.no_skip0,
                           args.no_A_conv,args.higher_satlu,args.local_grad,
-                          model_out,device)
+                          model_out,device,memory_format=args.memory_format,
+                          static_input=args.static_input,
+                          R_cell_type=args.R_cell_type,
+                          R_cell_groups=args.R_cell_groups,
+                          R_cell_reduction=args.R_cell_reduction)
     elif args.model_type == 'StackedConvLSTM':
         model = StackedConvLSTM(args.in_channels,args.R_stack_sizes,
                                 args.R_kernel_sizes,args.use_1x1_out,
@@ -197,7 +266,18 @@ def main(args):
 
     if args.load_weights_from is not None:
         model.load_state_dict(torch.load(args.load_weights_from))
+    if args.quantize:
+        device = torch.device("cpu") # quantized convs run on CPU
+        calib_batches = get_calibration_batches(args.calib_data_path,
+                                                args.seq_len,
+                                                args.downsample_size,
+                                                args.calib_batch_size,
+                                                args.calib_batches,
+                                                args.last_only)
+        model = quantize_model(model,calib_batches)
     model.to(device)
+    if args.compile:
+        model = compile_model(model)
 
     # Get random indices of sequences to save
     total_seqs = len(test_data)
@@ -211,6 +291,11 @@ def main(args):
     # Get predicted images
     model.eval()
     with torch.no_grad():
+        if args.stream_eval:
+            # Drives are streamed up to the last selected window
+            streamed = {i:preds for i,_,preds in
+                        stream_windows(model,test_data,device,args.bf16,
+                                       seq_ids)}
         for num,i in enumerate(seq_ids):
             if args.sanity_check: # Get first part of seq i, second part of i+1
                 X_i = test_data[i]
@@ -218,13 +303,22 @@ def main(args):
                 X_ip1 = test_data[next_i]
                 halfway = args.seq_len//2
                 X = torch.cat((X_i[:halfway],X_ip1[halfway:]),dim=0)
-                X = X.to(device)
             else:
-                X = test_data[i].to(device)
+                X = test_data[i]
             X = X.unsqueeze(0) # Add batch dim
             seq_len = X.shape[1]
-            preds = model(X)
-            preds = preds.squeeze(0).permute(0,2,3,1) # (len,H,W,channels)
+            if args.stream_eval:
+                preds = streamed[i].unsqueeze(0)
+            elif args.tile_size is not None:
+                # Frames stay on CPU, tiles are run on device
+                preds = tiled_forward(model,X,args.tile_size,args.tile_halo,
+                                      args.tile_workers,device,
+                                      args.bf16)['pred']
+            else:
+                X = X.to(device)
+                with bf16_autocast(device,args.bf16):
+                    preds = model(X)
+            preds = preds.float().squeeze(0).permute(0,2,3,1) # (len,H,W,channels)
             preds = preds.cpu().numpy()
             X = X.squeeze(0).permute(0,2,3,1) # (len,H,W,channels)
             X = X.cpu().numpy()
@@ -249,4 +343,12 @@ def main(args):
 if __name__ == '__main__':
     args = parser.parse_args()
     print(args)
+    msg = "Quantized models run in fp32 between int8 convs: don't use bf16"
+    assert not (args.quantize and args.bf16), msg
+    if args.stream_eval:
+        msg = "Streamed evaluation requires KITTI with PredNet or LadderNet"
+        model_has_state = args.model_type in ['PredNet','LadderNet']
+        assert model_has_state and args.dataset == 'KITTI', msg
+        msg = "Streamed evaluation can't be used with sanity_check or tiling"
+        assert not args.sanity_check and args.tile_size is None, msg
     main(args)
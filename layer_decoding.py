@@ -16,6 +16,7 @@ from ConvLSTM import *
 from Ladder import *
 from StackedConvLSTM import *
 from utils import *
+from quantize import quantize_model, get_calibration_batches
 
 parser = argparse.ArgumentParser()
 # Layer decoding
@@ -137,6 +138,48 @@ parser.add_argument('--dropout_p', type=float, default=0.0,
                     help='Proportion dropout for inputs to R cells')
 parser.add_argument('--load_weights_from', default=None,
                     help='Path to saved weights')
+parser.add_argument('--bf16', type=str2bool, default=False,
+                    help='Run model forward under bfloat16 autocast')
+parser.add_argument('--memory_format', default='contiguous',
+                    choices=['contiguous','channels_last'],
+                    help='Memory format of conv weights, states and ' +
+                         'activations (PredNet and LadderNet only)')
+parser.add_argument('--R_cell_type', default='dense', choices=cell_types,
+                    help='Gate convs of R cells (ConvLSTM cell for ' +
+                         'ConvLSTM): dense, depthwise-separable, grouped, ' +
+                         'or bottleneck (1x1 reduce before k x k conv)')
+parser.add_argument('--R_cell_groups', type=int, default=4,
+                    help='Groups of gate convs with R_cell_type grouped')
+parser.add_argument('--R_cell_reduction', type=int, default=4,
+                    help='Channel reduction of the 1x1 conv with ' +
+                         'R_cell_type bottleneck')
+parser.add_argument('--static_input', default='never',
+                    choices=['never','detect','always'],
+                    help='Reuse input-side results (A with send_acts, ' +
+                         'LadderNet encoder, ConvLSTM input convs) when the ' +
+                         'input is bit-identical to the previous step: ' +
+                         'detect checks each step, always assumes it ' +
+                         '(e.g. CCN with last_only). Outputs are unchanged.')
+parser.add_argument('--compile', type=str2bool, default=False,
+                    help='Compile the model with torch.compile ' +
+                         '(first iterations are slower while compiling)')
+parser.add_argument('--quantize', type=str2bool, default=False,
+                    help='Run an int8 quantized copy of the model on CPU, ' +
+                         'calibrated on a subset of CCN sequences')
+parser.add_argument('--quantize_eval', type=str2bool, default=False,
+                    help='Train decoders on reps of the fp32 model and also ' +
+                         'evaluate them on reps of an int8 quantized copy ' +
+                         'at each checkpoint (test_acc_int8_data), so the ' +
+                         'accuracy drop in quantize.py is quantization only')
+parser.add_argument('--seed', type=int, default=None,
+                    help='Seed of decoder initialization and data order ' +
+                         '(use the same seed in runs that are compared)')
+parser.add_argument('--calib_data_path', default='../data/ccn_images/train/',
+                    help='Path to ccn image directory used for calibration')
+parser.add_argument('--calib_batches', type=int, default=10,
+                    help='Number of batches used for calibration')
+parser.add_argument('--calib_batch_size', type=int, default=4,
+                    help='Samples per calibration batch')
 # Hyperparameters unique to LadderNet
 parser.add_argument('--no_R0', type=str2bool, default=True,
                     help='Boolean indicating whether not to include' +
@@ -176,6 +219,8 @@ def main(args):
     # CUDA
     use_cuda = torch.cuda.is_available()
     device = torch.device("cuda:0" if use_cuda else "cpu")
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
 
     # Load model
     model_out = 'rep' # Always rep to get representations
@@ -188,7 +233,12 @@ def main(args):
                         args.use_1x1_out,args.FC,args.dropout_p,
                         args.send_acts,args.no_ER,args.RAhat,args.no_A_conv,
                         args.higher_satlu,args.local_grad,args.conv_dilation,
-                        args.use_BN,model_out,device)
+                        args.use_BN,model_out,device,
+                        memory_format=args.memory_format,
+                        static_input=args.static_input,
+                        R_cell_type=args.R_cell_type,
+                        R_cell_groups=args.R_cell_groups,
+                        R_cell_reduction=args.R_cell_reduction)
     elif args.model_type == 'MultiConvLSTM':
         model = MultiConvLSTM(args.in_channels,args.R_stack_sizes,
                               args.R_kernel_sizes,args.use_satlu,args.pixel_max,
@@ -199,7 +249,11 @@ def main(args):
     elif args.model_type == 'ConvLSTM':
         model = ConvLSTM(args.in_channels,args.hidden_channels,args.kernel_size,
                          args.LSTM_act,args.LSTM_c_act,args.out_act,
-                         args.bias,args.FC,device)
+                         args.bias,args.FC,device,
+                         static_input=args.static_input,
+                         R_cell_type=args.R_cell_type,
+                         R_cell_groups=args.R_cell_groups,
+                         R_cell_reduction=args.R_cell_reduction)
     elif args.model_type == 'LadderNet':
         model = LadderNet(args.in_channels,args.stack_sizes,args.R_stack_sizes,
                           args.A_kernel_sizes,args.Ahat_kernel_sizes,
@@ -209,7 +263,11 @@ def main(args):
                           args.LSTM_act,args.LSTM_c_act,args.bias,
                           args.use_1x1_out,args.FC,args.no_R0,args.no_skip0,
                           args.no_A_conv,args.higher_satlu,args.local_grad,
-                          model_out,device)
+                          model_out,device,memory_format=args.memory_format,
+                          static_input=args.static_input,
+                          R_cell_type=args.R_cell_type,
+                          R_cell_groups=args.R_cell_groups,
+                          R_cell_reduction=args.R_cell_reduction)
     elif args.model_type == 'StackedConvLSTM':
         model = StackedConvLSTM(args.in_channels,args.R_stack_sizes,
                                 args.R_kernel_sizes,args.use_1x1_out,
@@ -217,7 +275,28 @@ def main(args):
                                 model_out,device)
     if args.load_weights_from is not None:
         model.load_state_dict(torch.load(args.load_weights_from))
+    if args.quantize:
+        device = torch.device("cpu") # quantized convs run on CPU
+        calib_batches = get_calibration_batches(args.calib_data_path,
+                                                args.seq_len,
+                                                args.downsample_size,
+                                                args.calib_batch_size,
+                                                args.calib_batches,
+                                                False)
+        model = quantize_model(model,calib_batches)
+    q_model = None
+    if args.quantize_eval:
+        # Int8 copy (on CPU) only used to evaluate the decoders
+        calib_batches = get_calibration_batches(args.calib_data_path,
+                                                args.seq_len,
+                                                args.downsample_size,
+                                                args.calib_batch_size,
+                                                args.calib_batches,
+                                                False)
+        q_model = quantize_model(model,calib_batches)
     model.to(device)
+    if args.compile:
+        model = compile_model(model)
     model.eval()
     if args.model_type == 'LadderNet' and args.no_R0:
         nb_reps = model.nb_layers - 1
@@ -246,7 +325,9 @@ def main(args):
     # Dummy test to get dimension of each decoder
     X,_ = train_data[0] # don't need the cat right now
     X = X.unsqueeze(0).to(device) # batch size is 1
-    reps = model(X)
+    with bf16_autocast(device,args.bf16):
+        reps = model(X)
+    reps = [rep.float() for rep in reps]
     reps.insert(0,X[:,-1,:,:,:]) # insert last image to get dim of pixels
     layer_dims = []
     for rep in reps:
@@ -294,6 +375,7 @@ def main(args):
     train_acc_data = [[] for i in range(n_decoders)] # mean train losses
     val_acc_data = [[] for i in range(n_decoders)] # mean val losses
     test_acc_data = [[] for i in range(n_decoders)] # mean test losses
+    test_acc_int8_data = [[] for i in range(n_decoders)] # with quantize_eval
     best_val_accs = [0.0 for i in range(n_decoders)] # early stopping
     while iter < args.num_iters:
         epoch_count += 1
@@ -308,7 +390,9 @@ def main(args):
             # Get representations
             optimizer.zero_grad()
             with torch.no_grad():
-                reps = model(X)
+                with bf16_autocast(device,args.bf16):
+                    reps = model(X)
+                reps = [rep.float() for rep in reps]
                 reps.insert(0,X[:,-1,:,:,:])
             agg_reps = []
             for rep in reps:
@@ -359,13 +443,25 @@ def main(args):
             print("Test accuracies are ", test_accs)
             for l,test_acc in enumerate(test_accs):
                 test_acc_data[l].append(test_acc)
+            if q_model is not None:
+                print("Checking test accuracy on int8 reps ...")
+                test_accs = checkpoint(test_loader,token_to_idx,
+                                       q_model,decoders,device,args,
+                                       torch.device("cpu"))
+                print("Int8 test accuracies are ", test_accs)
+                for l,test_acc in enumerate(test_accs):
+                    test_acc_int8_data[l].append(test_acc)
             # Write stats file
             if not os.path.isdir(args.results_dir):
                 os.mkdir(args.results_dir)
             stats = {'loss_data':loss_data,
                      'train_acc_data':train_acc_data,
                      'val_acc_data':val_acc_data,
-                     'test_acc_data':test_acc_data}
+                     'test_acc_data':test_acc_data,
+                     'quantize':args.quantize,
+                     'seed':args.seed}
+            if q_model is not None:
+                stats['test_acc_int8_data'] = test_acc_int8_data
             results_file_name = '%s/%s' % (args.results_dir,args.out_data_file)
             with open(results_file_name, 'w') as f:
                 json.dump(stats, f)
@@ -384,7 +480,12 @@ def main(args):
                         print("Saving weights to %s" % pt_path)
                         torch.save(decoders[l].state_dict(),pt_path)
 
-def checkpoint(dataloader, token_to_idx, model, decoders, device, args):
+def checkpoint(dataloader, token_to_idx, model, decoders, device, args,
+               model_device=None):
+    # model_device: where the model runs if not on device (e.g. int8 on
+    # CPU); reps are moved to the decoders on device
+    if model_device is None:
+        model_device = device
     for decoder in decoders:
         decoder.eval()
     with torch.no_grad():
@@ -392,13 +493,15 @@ def checkpoint(dataloader, token_to_idx, model, decoders, device, args):
         for batch in dataloader:
             # Split sample
             X = batch[0]
-            X = X.to(device)
+            X = X.to(model_device)
             cats = batch[1]
             target = torch.tensor([token_to_idx[t] for t in cats])
             target = target.to(device)
             # Forward
-            reps = model(X)
-            reps.insert(0,X[:,-1,:,:,:])
+            with bf16_autocast(model_device,args.bf16):
+                reps = model(X)
+            reps = [rep.float().to(device) for rep in reps]
+            reps.insert(0,X[:,-1,:,:,:].to(device))
             # Aggregate
             agg_reps = []
             for rep in reps:
@@ -425,4 +528,8 @@ def checkpoint(dataloader, token_to_idx, model, decoders, device, args):
 if __name__ == '__main__':
     args = parser.parse_args()
     print(args)
+    msg = "Quantized models run in fp32 between int8 convs: don't use bf16"
+    assert not (args.quantize and args.bf16), msg
+    msg = "quantize_eval compares with the fp32 model: don't use quantize"
+    assert not (args.quantize and args.quantize_eval), msg
     main(args)
@@ -16,8 +16,10 @@ from mp_train import train, test
 #       -Include option for pin_memory if using cuda
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--seed',type=int, default=0,
-                    help='Manual seed for torch random number generator')
+parser.add_argument('--seed',type=int, default=None,
+                    help='Manual seed for torch random number generator ' +
+                         'and the order of training batches (random by ' +
+                         'default, kept in training states)')
 # Training data
 parser.add_argument('--dataset',choices=['KITTI','CCN'],default='KITTI',
                     help='Dataset to use')
@@ -42,7 +44,19 @@ parser.add_argument('--test_sources_path',
 parser.add_argument('--seq_len',type=int,default=10,
                     help='Number of images in each kitti sequence')
 parser.add_argument('--batch_size', type=int, default=4,
-                    help='Samples per batch')
+                    help='Samples per batch of each rank (per optimizer ' +
+                         'step)')
+parser.add_argument('--micro_batch_size', type=int, default=0,
+                    help='Samples per forward/backward pass: gradients are ' +
+                         'accumulated over the micro-batches of each ' +
+                         'batch before they are averaged across ranks. ' +
+                         '0: batch_size, or probed with memory_budget')
+parser.add_argument('--memory_budget', type=float, default=0.0,
+                    help='GB for training in each process: the largest ' +
+                         'micro_batch_size (up to batch_size) whose ' +
+                         'forward and backward, with weights, gradients ' +
+                         'and Adam state, fit is probed before training. ' +
+                         '0: no probe')
 parser.add_argument('--num_iters', type=int, default=75000,
                     help='Number of optimizer steps before stopping')
 
@@ -119,6 +133,9 @@ parser.add_argument('--FC', type=str2bool, default=False,
                          'convolutional LSTM cell')
 parser.add_argument('--load_weights_from', default=None,
                     help='Path to saved weights')
+parser.add_argument('--bf16', type=str2bool, default=False,
+                    help='Run model forward under bfloat16 autocast ' +
+                         '(losses and SatLU stay in fp32)')
 
 # Optimization
 parser.add_argument('--loss', default='E',choices=['E','MSE','L1'])
@@ -140,15 +157,95 @@ parser.add_argument('--checkpoint_path',default=None,
                     help='Path to output saved weights.')
 parser.add_argument('--record_loss_every', type=int, default=20,
                     help='iters before printing and recording loss')
+parser.add_argument('--eval_every', type=int, default=5,
+                    help='Epochs between distributed val/test evaluations ' +
+                         '(best val weights saved). 0: no evaluation, ' +
+                         'weights saved every epoch')
+parser.add_argument('--final_test', type=str2bool, default=False,
+                    help='Evaluate the saved weights on val and test ' +
+                         'after training')
+
+# Resumable training
+parser.add_argument('--state_dir', default=None,
+                    help='Directory of full training states (one ' +
+                         'subdirectory per rank). Training resumes from ' +
+                         'the latest state, and a state is written on ' +
+                         'SIGTERM before exiting')
+parser.add_argument('--save_state_every', type=int, default=1000,
+                    help='Iters between training states')
+parser.add_argument('--keep_states', type=int, default=2,
+                    help='Number of most recent training states kept')
+
+# Distributed
+parser.add_argument('--backend', default='mpi', choices=['mpi','gloo'],
+                    help='Backend of torch.distributed. With gloo, ranks ' +
+                         'rendezvous at MASTER_ADDR:MASTER_PORT')
+parser.add_argument('--local_procs', type=int, default=0,
+                    help='Spawn this many processes on this machine ' +
+                         '(e.g. to test with gloo) instead of reading ' +
+                         'ranks from mpirun')
+parser.add_argument('--master_port', type=int, default=29500,
+                    help='Port for gloo rendezvous if MASTER_PORT is not set')
+parser.add_argument('--grad_sync', default='bucketed',
+                    choices=['bucketed','per_param','local_sgd'],
+                    help='Average gradients with bucketed all-reduces ' +
+                         'started during backward, or with one blocking ' +
+                         'all-reduce per parameter after backward, or ' +
+                         'take local steps and average models (local_sgd)')
+parser.add_argument('--bucket_mb', type=float, default=25.0,
+                    help='Size of gradient buckets in MB')
+parser.add_argument('--local_steps', type=int, default=8,
+                    help='Local optimizer steps between model averaging ' +
+                         'with local_sgd (initial value if adaptive)')
+parser.add_argument('--adaptive_local_steps', type=str2bool, default=False,
+                    help='Reduce local steps as the loss decreases: ' +
+                         'ceil(sqrt(loss/initial loss) * local_steps)')
+parser.add_argument('--average_moments', type=str2bool, default=False,
+                    help='Also average Adam moments with local_sgd')
+parser.add_argument('--grad_compress', default='none',
+                    choices=['none','fp16','bf16','topk','powersgd'],
+                    help='Compression of gradient buckets (bucketed ' +
+                         'grad_sync only): fp16/bf16 casting, top-k ' +
+                         'sparsification or PowerSGD low-rank, both with ' +
+                         'error feedback')
+parser.add_argument('--topk_ratio', type=float, default=0.01,
+                    help='Fraction of gradient entries sent with topk')
+parser.add_argument('--powersgd_rank', type=int, default=4,
+                    help='Rank of the approximations with powersgd')
 
 def init_process(rank, world_size, fn, args, backend='mpi'):
     """ Initialize the distributed environment. """
+    if backend == 'gloo':
+        os.environ.setdefault('MASTER_ADDR','127.0.0.1')
+        os.environ.setdefault('MASTER_PORT',str(args.master_port))
     dist.init_process_group(backend, rank=rank, world_size=world_size)
     fn(rank, world_size, args)
 
+def run_local(rank, world_size, args):
+    # Entry point of processes spawned on this machine
+    start_train_time = time.time()
+    init_process(rank,world_size,train,args,args.backend)
+    if rank == 0:
+        print("Total training time: ", time.time() - start_train_time)
+    dist.barrier()
+    if args.final_test:
+        test(rank,world_size,args)
+
 if __name__ == '__main__':
     args = parser.parse_args()
 
+    if args.grad_compress != 'none':
+        msg = "Gradient compression requires bucketed grad_sync"
+        assert args.grad_sync == 'bucketed', msg
+
+    if args.local_procs > 0:
+        msg = "Local processes use the gloo backend"
+        assert args.backend == 'gloo', msg
+        print(args)
+        mp.spawn(run_local,args=(args.local_procs,args),
+                 nprocs=args.local_procs)
+        exit()
+
     # Get environment variables from mpi
     world_size = int(os.environ['OMPI_COMM_WORLD_SIZE'])
     world_rank = int(os.environ['OMPI_COMM_WORLD_RANK'])
@@ -162,11 +259,12 @@ if __name__ == '__main__':
 
     # Train
     start_train_time = time.time()
-    init_process(world_rank,world_size,train,args)
+    init_process(world_rank,world_size,train,args,args.backend)
     print("Total training time: ", time.time() - start_train_time)
     dist.barrier()
 
-    # Test
-    #start_test_time = time.time()
-    #init_process(world_rank,world_size,test,args)
-    #print("Total testing time: ", time.time() - start_test_time)
+    # Test (process group already initialized)
+    if args.final_test:
+        start_test_time = time.time()
+        test(world_rank,world_size,args)
+        print("Total testing time: ", time.time() - start_test_time)
@@ -1,4 +1,5 @@
 import os
+import sys
 import socket
 import json
 import numpy as np
@@ -6,7 +7,6 @@ import time
 from random import Random
 
 import torch
-import torch.nn as nn
 import torch.optim as optim
 
 import torch.distributed as dist
@@ -15,6 +15,10 @@ from data import *
 from custom_losses import *
 from PredNet import *
 from ConvLSTM import *
+from utils import *
+from train import correlations, batch_loss, get_micro_batch_size
+from resume import *
+from accumulation import *
 
 class Partition(object):
     def __init__(self, data, index):
@@ -29,7 +33,7 @@ class Partition(object):
         return self.data[data_idx]
 
 class DataPartitioner(object):
-    def __init__(self, dataset, world_size):
+    def __init__(self, dataset, world_size, drop_last=True):
         self.dataset = dataset
         self.partitions = []
 
@@ -40,6 +44,11 @@ class DataPartitioner(object):
         ids = [i for i in range(data_len)]
         rng.shuffle(ids)
 
+        if not drop_last:
+            # Every sample in some partition (sizes differ by at most one)
+            for i in range(world_size):
+                self.partitions.append(ids[i::world_size])
+            return
         for i in range(world_size):
             part_len = int(data_len/world_size)
             self.partitions.append(ids[0:part_len])
@@ -49,31 +58,17 @@ class DataPartitioner(object):
         partition = Partition(self.dataset, self.partitions[rank])
         return partition
 
-def average_gradients(model):
-    """ Gradient averaging. """
-    size = float(dist.get_world_size())
-    for param in model.parameters():
-        dist.all_reduce(param.grad.data, op=dist.ReduceOp.SUM)
-        param.grad.data /= size
-
-def train(rank, world_size, args):
-
-    # Info
-    hostname = socket.gethostname().split('.')[0] # for printing
-    print("Started process on node: ", hostname)
-
-    # Model
-    model_out = 'error' if args.loss == 'E' else 'pred'
-    device = 'cpu' # cpu only
-    torch.manual_seed(args.seed) # all processes start with the same model
+def get_model(args,model_out,device):
     if args.model_type == 'PredNet':
         model = PredNet(args.in_channels,args.stack_sizes,args.R_stack_sizes,
                         args.A_kernel_sizes,args.Ahat_kernel_sizes,
                         args.R_kernel_sizes,args.use_satlu,args.pixel_max,
                         args.Ahat_act,args.satlu_act,args.error_act,
                         args.LSTM_act,args.LSTM_c_act,args.bias,
-                        args.use_1x1_out,args.FC,args.send_acts,args.no_ER,
-                        args.RAhat,args.local_grad,model_out,device)
+                        args.use_1x1_out,args.FC,send_acts=args.send_acts,
+                        no_ER=args.no_ER,RAhat=args.RAhat,
+                        local_grad=args.local_grad,output=model_out,
+                        device=device)
     elif args.model_type == 'MultiConvLSTM':
         model = MultiConvLSTM(args.in_channels,args.R_stack_sizes,
                               args.R_kernel_sizes,args.use_satlu,args.pixel_max,
@@ -86,6 +81,390 @@ def train(rank, world_size, args):
                          args.LSTM_act,args.LSTM_c_act,args.out_act,
                          args.bias,args.FC,device)
 
+    return model
+
+def get_eval_loader(args,split,rank,world_size):
+    # Shard of the val or test set of this rank (all samples over ranks)
+    if args.dataset == 'KITTI':
+        data_path = getattr(args,'%s_data_path' % split)
+        sources_path = getattr(args,'%s_sources_path' % split)
+        dataset = KITTI(data_path,sources_path,args.seq_len)
+    elif args.dataset == 'CCN':
+        dataset = CCN(getattr(args,'%s_data_path' % split),args.seq_len)
+    partitioner = DataPartitioner(dataset, world_size, drop_last=False)
+    partition = partitioner.get_partition(rank)
+    return DataLoader(partition, args.batch_size,
+                      shuffle=False,num_workers=1,pin_memory=False)
+
+def evaluate(model,loader,device,args):
+    """
+    Global MSE (over all pixels of all predicted frames) and mean correlation
+    (over sequences) of the model on the shards of all ranks: sums and
+    counts of each rank are all-reduced, so every rank gets the same exact
+    values.
+    """
+    model.eval()
+    model_output = model.output
+    model.output = 'pred'
+    sums = torch.zeros(4,dtype=torch.float64) # sq error, pixels, corr, seqs
+    with torch.no_grad():
+        for X in loader:
+            X = X.to(device)
+            with bf16_autocast(device,args.bf16):
+                output = model(X)
+            output = output.float()
+            X_no_t0 = X[:,1:,:,:,:]
+            sums[0] += torch.sum((output - X_no_t0)**2).double()
+            sums[1] += X_no_t0.numel()
+            sums[2] += correlations(output,X_no_t0).sum().double()
+            sums[3] += X.shape[0]
+    dist.all_reduce(sums, op=dist.ReduceOp.SUM)
+    model.train()
+    model.output = model_output
+    return (sums[0] / sums[1]).item(), (sums[2] / sums[3]).item()
+
+def average_gradients(model):
+    """ Gradient averaging. """
+    size = float(dist.get_world_size())
+    for param in model.parameters():
+        dist.all_reduce(param.grad.data, op=dist.ReduceOp.SUM)
+        param.grad.data /= size
+
+class AllReduce(object):
+    # Uncompressed bucket reduction. Compressors below have the same
+    # interface: launch() starts reducing a bucket's flat gradient buffer
+    # and finish() waits and writes the average back into the buffer.
+    # bytes_sent counts the bytes each rank contributes per iteration.
+    def __init__(self):
+        self.world_size = dist.get_world_size()
+        self.bytes_sent = 0
+
+    def launch(self,b,buffer,params):
+        self.bytes_sent += buffer.numel() * buffer.element_size()
+        return dist.all_reduce(buffer,op=dist.ReduceOp.SUM,async_op=True)
+
+    def finish(self,b,buffer,params,work):
+        work.wait()
+        buffer /= self.world_size
+
+    def state_dict(self):
+        # Compression state carried across iterations (saved with the
+        # training state)
+        return {}
+
+    def load_state_dict(self,state,device):
+        pass
+
+class CastAllReduce(AllReduce):
+    # All-reduce in fp16 or bf16 (scaled before the sum to avoid overflow)
+    def __init__(self,dtype):
+        super(CastAllReduce,self).__init__()
+        self.dtype = dtype
+
+    def launch(self,b,buffer,params):
+        cast = (buffer / self.world_size).to(self.dtype)
+        self.bytes_sent += cast.numel() * cast.element_size()
+        return cast,dist.all_reduce(cast,op=dist.ReduceOp.SUM,async_op=True)
+
+    def finish(self,b,buffer,params,work):
+        cast,work = work
+        work.wait()
+        buffer.copy_(cast)
+
+class TopKAllReduce(AllReduce):
+    # Top-k sparsification with error feedback: each rank sends its ratio
+    # largest entries (gradient plus what it didn't send before), gathered
+    # from all ranks and summed
+    def __init__(self,ratio):
+        super(TopKAllReduce,self).__init__()
+        self.ratio = ratio
+        self.residuals = {} # bucket: entries not sent yet
+
+    def launch(self,b,buffer,params):
+        acc = buffer + self.residuals.get(b,0)
+        k = max(1,int(self.ratio * acc.numel()))
+        _,idx = acc.abs().topk(k)
+        values = acc[idx]
+        acc[idx] = 0
+        self.residuals[b] = acc
+        idx = idx.int()
+        all_values = [torch.empty_like(values)
+                      for r in range(self.world_size)]
+        all_idx = [torch.empty_like(idx) for r in range(self.world_size)]
+        works = [dist.all_gather(all_values,values,async_op=True),
+                 dist.all_gather(all_idx,idx,async_op=True)]
+        self.bytes_sent += values.numel() * values.element_size()
+        self.bytes_sent += idx.numel() * idx.element_size()
+        return all_values,all_idx,works
+
+    def finish(self,b,buffer,params,work):
+        all_values,all_idx,works = work
+        for w in works:
+            w.wait()
+        buffer.zero_()
+        for values,idx in zip(all_values,all_idx):
+            buffer.index_add_(0,idx.long(),values)
+        buffer /= self.world_size
+
+    def state_dict(self):
+        return {'residuals':self.residuals}
+
+    def load_state_dict(self,state,device):
+        self.residuals = {b:r.to(device)
+                          for b,r in state['residuals'].items()}
+
+class PowerSGDAllReduce(AllReduce):
+    """
+    PowerSGD-style rank-r compression with error feedback. The gradient M
+    of each weight (as a matrix of shape[0] rows) is approximated by P Q^T:
+    P = M Q is all-reduced and orthogonalized, then Q = M^T P is
+    all-reduced, with Q kept as the warm start of the next iteration.
+    Biases and other vectors are all-reduced with the first round.
+    """
+    def __init__(self,rank):
+        super(PowerSGDAllReduce,self).__init__()
+        self.rank = rank
+        self.residuals = {} # bucket: error of the approximations
+        self.Qs = {} # (bucket, index of the param in the bucket): Q
+        # Same initial Qs on every rank
+        self.generator = torch.Generator().manual_seed(1234)
+
+    def matrices(self,acc,params):
+        # (index of the param, matrix view of its gradient in acc) for
+        # weights, and slices of acc for vectors
+        matrices = []
+        vectors = []
+        offset = 0
+        for i,param in enumerate(params):
+            flat = acc[offset:offset + param.numel()]
+            if param.dim() > 1:
+                matrices.append((i,flat.view(param.shape[0],-1)))
+            else:
+                vectors.append(flat)
+            offset += param.numel()
+        return matrices,vectors
+
+    def launch(self,b,buffer,params):
+        acc = buffer + self.residuals.get(b,0)
+        matrices,vectors = self.matrices(acc,params)
+        Ps = []
+        for i,M in matrices:
+            if (b,i) not in self.Qs:
+                rank = min(self.rank,*M.shape)
+                Q = torch.randn(M.shape[1],rank,generator=self.generator)
+                self.Qs[(b,i)] = Q.to(M.device)
+            Ps.append(M @ self.Qs[(b,i)])
+        flat = torch.cat([P.reshape(-1) for P in Ps] + vectors)
+        self.bytes_sent += flat.numel() * flat.element_size()
+        work = dist.all_reduce(flat,op=dist.ReduceOp.SUM,async_op=True)
+        return acc,Ps,flat,work
+
+    def finish(self,b,buffer,params,work):
+        acc,Ps,flat,work = work
+        work.wait()
+        flat /= self.world_size
+        matrices,_ = self.matrices(acc,params)
+        # Orthogonalized P (the same on every rank), then Q = M^T P
+        offset = 0
+        for i in range(len(Ps)):
+            P = flat[offset:offset + Ps[i].numel()].view_as(Ps[i])
+            offset += P.numel()
+            Ps[i] = torch.linalg.qr(P)[0]
+        Qs = [M.t() @ P for (_,M),P in zip(matrices,Ps)]
+        if Qs:
+            flat_Q = torch.cat([Q.reshape(-1) for Q in Qs])
+            self.bytes_sent += flat_Q.numel() * flat_Q.element_size()
+            dist.all_reduce(flat_Q,op=dist.ReduceOp.SUM)
+            flat_Q /= self.world_size
+        # Approximations and reduced vectors into the buffer
+        buffer_matrices,buffer_vectors = self.matrices(buffer,params)
+        Q_offset = 0
+        for (i,M),P,Q in zip(buffer_matrices,Ps,Qs):
+            Q = flat_Q[Q_offset:Q_offset + Q.numel()].view_as(Q)
+            Q_offset += Q.numel()
+            self.Qs[(b,i)] = Q.clone()
+            M.copy_(P @ Q.t())
+        for vector in buffer_vectors:
+            vector.copy_(flat[offset:offset + vector.numel()])
+            offset += vector.numel()
+        # Error feedback: what the approximations missed (vectors are exact)
+        residual = acc - buffer
+        _,residual_vectors = self.matrices(residual,params)
+        for vector in residual_vectors:
+            vector.zero_()
+        self.residuals[b] = residual
+
+    def state_dict(self):
+        return {'residuals':self.residuals,
+                'Qs':self.Qs,
+                'generator':self.generator.get_state()}
+
+    def load_state_dict(self,state,device):
+        self.residuals = {b:r.to(device)
+                          for b,r in state['residuals'].items()}
+        self.Qs = {key:Q.to(device) for key,Q in state['Qs'].items()}
+        self.generator.set_state(state['generator'])
+
+def get_grad_compression(args):
+    if args.grad_compress == 'none':
+        return AllReduce()
+    elif args.grad_compress == 'fp16':
+        return CastAllReduce(torch.float16)
+    elif args.grad_compress == 'bf16':
+        return CastAllReduce(torch.bfloat16)
+    elif args.grad_compress == 'topk':
+        return TopKAllReduce(args.topk_ratio)
+    elif args.grad_compress == 'powersgd':
+        return PowerSGDAllReduce(args.powersgd_rank)
+
+class BucketedAllReduce(object):
+    """
+    Gradient averaging in buckets of about bucket_mb MB, overlapped with
+    backward. Parameters are bucketed in reverse order (about the order their
+    gradients are ready in backward). A hook copies each gradient into the
+    flat buffer of its bucket once it is accumulated, and when a bucket is
+    full its all-reduce starts asynchronously while backward goes on.
+    Buckets are always launched in the same order on every rank. wait()
+    launches buckets with unused parameters (zero gradients), waits for all
+    reductions and writes the averaged gradients back. Buckets are reduced
+    by compression (default AllReduce, uncompressed), and bytes_sent is the
+    number of bytes this rank sent in the last iteration. With gradient
+    accumulation, enabled is False for all but the last micro-batch, so
+    gradients are only reduced once they are fully accumulated.
+    """
+    def __init__(self,model,bucket_mb=25.0,compression=None):
+        self.world_size = dist.get_world_size()
+        if compression is None:
+            compression = AllReduce()
+        self.compression = compression
+        params = [p for p in model.parameters() if p.requires_grad]
+        bucket_bytes = bucket_mb * 2**20
+        self.buckets = [[]] # lists of params
+        size = 0
+        for param in reversed(params):
+            nbytes = param.numel() * param.element_size()
+            if size > 0 and size + nbytes > bucket_bytes:
+                self.buckets.append([])
+                size = 0
+            self.buckets[-1].append(param)
+            size += nbytes
+        self.buffers = []
+        self.slots = {} # param: (bucket, offset)
+        for b,bucket in enumerate(self.buckets):
+            offset = 0
+            for param in bucket:
+                self.slots[param] = (b,offset)
+                offset += param.numel()
+            self.buffers.append(bucket[0].new_zeros(offset))
+        for param in params:
+            param.register_post_accumulate_grad_hook(self.grad_ready)
+        self.enabled = True
+        self.reset()
+
+    def reset(self):
+        self.ready = [set() for bucket in self.buckets]
+        self.works = []
+        self.compression.bytes_sent = 0
+
+    def grad_ready(self,param):
+        if not self.enabled:
+            return
+        b,offset = self.slots[param]
+        self.copy_grad(param,b,offset)
+        self.ready[b].add(param)
+        self.launch_ready()
+
+    def copy_grad(self,param,b,offset):
+        flat = self.buffers[b][offset:offset + param.numel()]
+        if param.grad is None:
+            flat.zero_()
+        else:
+            flat.copy_(param.grad.reshape(-1))
+
+    def launch_ready(self):
+        # Launch full buckets in bucket order
+        while len(self.works) < len(self.buckets):
+            b = len(self.works)
+            if len(self.ready[b]) < len(self.buckets[b]):
+                break
+            self.works.append(self.compression.launch(b,self.buffers[b],
+                                                      self.buckets[b]))
+
+    def wait(self):
+        # Parameters without gradients this iteration count as zeros
+        for b,bucket in enumerate(self.buckets):
+            for param in bucket:
+                if param not in self.ready[b]:
+                    self.copy_grad(param,b,self.slots[param][1])
+                    self.ready[b].add(param)
+        self.launch_ready()
+        for b,work in enumerate(self.works):
+            buffer = self.buffers[b]
+            self.compression.finish(b,buffer,self.buckets[b],work)
+            for param in self.buckets[b]:
+                offset = self.slots[param][1]
+                grad = buffer[offset:offset + param.numel()]
+                grad = grad.view_as(param)
+                if param.grad is None:
+                    param.grad = grad.clone()
+                else:
+                    param.grad.copy_(grad)
+        self.bytes_sent = self.compression.bytes_sent
+        self.reset()
+
+def average_model(model,optimizer,average_moments=False,extra=None):
+    """
+    Average parameters (and Adam moments if average_moments) across ranks
+    in one all-reduce, for Local SGD. extra: tensor averaged along with them
+    (e.g. the loss), returned averaged. Also returns the bytes sent.
+    """
+    size = float(dist.get_world_size())
+    tensors = [param.data for param in model.parameters()]
+    if average_moments:
+        for param in model.parameters():
+            state = optimizer.state.get(param,{})
+            for name in ['exp_avg','exp_avg_sq']:
+                if name in state:
+                    tensors.append(state[name])
+    flat = [t.reshape(-1) for t in tensors]
+    if extra is not None:
+        flat.append(extra.reshape(-1).float())
+    flat = torch.cat(flat)
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= size
+    offset = 0
+    for t in tensors:
+        t.copy_(flat[offset:offset + t.numel()].view_as(t))
+        offset += t.numel()
+    if extra is not None:
+        extra = flat[offset:].view_as(extra)
+    return extra, flat.numel() * flat.element_size()
+
+def local_steps(args,ave_loss,initial_loss):
+    # Local steps until the next averaging. Adaptive: shrink from
+    # local_steps as the loss decreases, ceil(sqrt(loss/initial) * H)
+    if not args.adaptive_local_steps or initial_loss is None:
+        return args.local_steps
+    ratio = max(ave_loss / initial_loss,0.0)
+    return max(1,int(np.ceil(np.sqrt(ratio) * args.local_steps)))
+
+def train(rank, world_size, args):
+
+    # Info
+    hostname = socket.gethostname().split('.')[0] # for printing
+    print("Started process on node: ", hostname)
+
+    # Model
+    model_out = 'error' if args.loss == 'E' else 'pred'
+    device = 'cpu' # cpu only
+    if args.seed is None:
+        # Random seed drawn by rank 0, the same on all ranks
+        seed_t = torch.tensor(random_seed())
+        dist.broadcast(seed_t,0)
+        args.seed = seed_t.item()
+    torch.manual_seed(args.seed) # all processes start with the same model
+    model = get_model(args,model_out,device)
+
     if args.load_weights_from is not None:
         model.load_state_dict(torch.load(args.load_weights_from))
     model.train()
@@ -98,12 +477,29 @@ def train(rank, world_size, args):
         dataset = CCN(args.train_data_path,args.seq_len)
     partitioner = DataPartitioner(dataset, world_size)
     partition = partitioner.get_partition(rank)
-    train_loader = DataLoader(partition, args.batch_size,
-                              shuffle=True,num_workers=1,pin_memory=False)
+    # Order of each epoch from seed and epoch, to resume mid-epoch
+    train_sampler = ResumableSampler(partition,args.batch_size,
+                                     seed=args.seed + rank)
+    train_loader = DataLoader(partition,batch_sampler=train_sampler,
+                              num_workers=1,pin_memory=False)
     if rank == 0:
         print("Train dataset has %d samples total" % len(dataset))
     print("%s: Partition of train dataset has %d samples" % (hostname,
                                                              len(partition)))
+    # Micro-batches (probed before the all-reduce hooks are registered)
+    micro_batch_size = get_micro_batch_size(model,partition,device,args)
+    if rank == 0:
+        print("Batch size %d per rank (%d total) in micro-batches of %d" %
+              (args.batch_size,args.batch_size*world_size,micro_batch_size))
+
+    # Gradient averaging: bucketed all-reduce started from backward hooks,
+    # or one blocking all-reduce per parameter after backward. With
+    # local_sgd, gradients stay local and the models are averaged every
+    # sync_every steps instead.
+    if args.grad_sync == 'bucketed':
+        compression = get_grad_compression(args)
+        grad_sync = BucketedAllReduce(model,args.bucket_mb,compression)
+
 
     # Loss function
     loss_fn = get_loss_fn(args.loss,args.layer_lambdas)
@@ -121,36 +517,128 @@ def train(rank, world_size, args):
     results_fn = 'r%d_' % rank + args.out_data_file
     results_path = os.path.join(args.results_dir,results_fn)
     loss_data = [] # records loss every args.record_loss_every iters
+    time_data = [] # wall-clock time since the start, at the same iters
+    bytes_data = [] # bytes sent in gradient averaging, at the same iters
+    val_losses = [] # global val/test MSE and correlation every eval_every
+    val_corrs = []
+    test_losses = []
+    test_corrs = []
+    best_val_loss = float("inf") # will only save best weights
+    if args.eval_every > 0:
+        val_loader = get_eval_loader(args,'val',rank,world_size)
+        test_loader = get_eval_loader(args,'test',rank,world_size)
 
     # Training loop:
     iter = 0
     epoch_count = 0
+    start_batch = 0 # batches of the first epoch already done
     ave_iter_time = 0.0
     ave_reduce_time = 0.0
+    start_time = time.time()
+    sync_every = args.local_steps # local_sgd
+    local_count = 0
+    local_loss = 0.0
+    initial_loss = None
+    stats = {'loss_data':loss_data,
+             'bytes_data':bytes_data,
+             'time_data':time_data,
+             'val_mse_losses':val_losses,
+             'val_corrs':val_corrs,
+             'test_mse_losses':test_losses,
+             'test_corrs':test_corrs}
+
+    # Resume from the latest training state of this rank
+    if args.state_dir is not None:
+        state_dir = os.path.join(args.state_dir,'rank%d' % rank)
+        writer = CheckpointWriter(state_dir,args.keep_states)
+        stop = StopRequest()
+        state = load_state(state_dir)
+        if state is not None:
+            model.load_state_dict(state['model'])
+            optimizer.load_state_dict(state['optimizer'])
+            scheduler.load_state_dict(state['scheduler'])
+            iter = state['iter']
+            epoch_count = state['epoch'] - 1 # epoch in progress
+            start_batch = state['batch']
+            ave_iter_time = state['ave_iter_time']
+            ave_reduce_time = state['ave_reduce_time']
+            start_time = time.time() - state['elapsed']
+            sync_every,local_count,local_loss,initial_loss = state['local']
+            best_val_loss = state['best_val_loss']
+            stats = state['stats']
+            loss_data = stats['loss_data']
+            bytes_data = stats['bytes_data']
+            time_data = stats['time_data']
+            val_losses = stats['val_mse_losses']
+            val_corrs = stats['val_corrs']
+            test_losses = stats['test_mse_losses']
+            test_corrs = stats['test_corrs']
+            args.seed = state['seed']
+            train_sampler.seed = args.seed + rank
+            set_rng_state(state['rng'])
+            if args.grad_sync == 'bucketed' and 'grad_compression' in state:
+                grad_sync.compression.load_state_dict(
+                    state['grad_compression'],device)
+
     while iter < args.num_iters:
         epoch_count += 1
+        train_sampler.set_epoch(epoch_count,start_batch)
+        batch_count = start_batch # batches seen this epoch
+        start_batch = 0
         for X in train_loader:
             iter += 1
+            batch_count += 1
             optimizer.zero_grad()
-            # Forward
+            # Forward and backward of each micro-batch, accumulating
+            # gradients (the bucketed all-reduce only runs on the last one)
             iter_tick = time.time()
-            output = model(X)
-            # Compute loss
-            if args.loss == 'E':
-                loss = loss_fn(output)
-            else:
-                X_no_t0 = X[:,1:,:,:,:]
-                loss = loss_fn(output,X_no_t0)
-            # Backward pass
-            loss.backward()
+            micro_batches = split_batch(X,micro_batch_size)
+            loss_sum = 0.0
+            for m,(X_m,w) in enumerate(micro_batches):
+                if args.grad_sync == 'bucketed':
+                    grad_sync.enabled = (m == len(micro_batches) - 1)
+                with bf16_autocast(device,args.bf16):
+                    output = model(X_m)
+                # Compute loss (in fp32)
+                loss = w*batch_loss(loss_fn,output,X_m,False,args)
+                # Backward pass
+                loss.backward()
+                loss_sum += loss.detach()
+            loss_sum = loss_sum.item()
             iter_tock = time.time()
-            # All reduce: average gradients
+            # All reduce: average gradients (with bucketed, only the time
+            # not overlapped with backward)
             reduce_tick = time.time()
-            average_gradients(model) # average gradients across all models
+            bytes_sent = 0
+            if args.grad_sync == 'bucketed':
+                grad_sync.wait()
+                bytes_sent = grad_sync.bytes_sent
+            elif args.grad_sync == 'per_param':
+                average_gradients(model) # average gradients across all models
+                bytes_sent = sum(p.grad.numel() * p.grad.element_size()
+                                 for p in model.parameters())
             reduce_tock = time.time()
             # Optimizer, scheduler
             optimizer.step()
             scheduler.step()
+            # Local SGD: average models every sync_every steps (and at the
+            # end), with the loss over the period to adapt sync_every
+            if args.grad_sync == 'local_sgd':
+                local_count += 1
+                local_loss += loss_sum
+                if local_count >= sync_every or iter >= args.num_iters:
+                    sync_tick = time.time()
+                    ave_loss = torch.tensor(local_loss / local_count)
+                    ave_loss,bytes_sent = average_model(model,optimizer,
+                                                        args.average_moments,
+                                                        ave_loss)
+                    ave_loss = ave_loss.item()
+                    if initial_loss is None:
+                        initial_loss = ave_loss
+                    sync_every = local_steps(args,ave_loss,initial_loss)
+                    local_count = 0
+                    local_loss = 0.0
+                    reduce_tick,reduce_tock = sync_tick,time.time()
             # Time stats
             iter_time = iter_tock - iter_tick
             reduce_time = reduce_tock - reduce_tick
@@ -158,23 +646,88 @@ def train(rank, world_size, args):
             ave_reduce_time = (ave_reduce_time*(iter-1) + reduce_time)/iter
             # Record loss
             if iter % args.record_loss_every == 0:
-                loss_datapoint = loss.data.item()
+                loss_datapoint = loss_sum
                 print(hostname,
                       'Rank:',rank,
                       'Epoch:', epoch_count,
                       'Iter:', iter,
+                      'Samples:', iter*args.batch_size*world_size,
                       'Ave iter time:',ave_iter_time,
                       'Ave reduce time:',ave_reduce_time,
+                      'Bytes sent:',bytes_sent,
                       'Loss:', loss_datapoint,
+                      'Time:', time.time() - start_time,
                       'lr:', scheduler.get_lr())
                 loss_data.append(loss_datapoint)
+                bytes_data.append(bytes_sent)
+                time_data.append(time.time() - start_time)
+            # Training state: every save_state_every iterations, or when any
+            # rank got SIGTERM (agreed on so all ranks stop at the same iter)
+            if args.state_dir is not None:
+                stop_t = torch.tensor(float(stop.requested))
+                dist.all_reduce(stop_t,op=dist.ReduceOp.MAX)
+                stopping = stop_t.item() > 0
+                if iter % args.save_state_every == 0 or stopping:
+                    state = {'model':model.state_dict(),
+                             'optimizer':optimizer.state_dict(),
+                             'scheduler':scheduler.state_dict(),
+                             'iter':iter,
+                             'epoch':epoch_count,
+                             'batch':batch_count,
+                             'ave_iter_time':ave_iter_time,
+                             'ave_reduce_time':ave_reduce_time,
+                             'elapsed':time.time() - start_time,
+                             'local':(sync_every,local_count,local_loss,
+                                      initial_loss),
+                             'best_val_loss':best_val_loss,
+                             'stats':stats,
+                             'seed':args.seed,
+                             'rng':get_rng_state()}
+                    if args.grad_sync == 'bucketed':
+                        state['grad_compression'] = \
+                            grad_sync.compression.state_dict()
+                    writer.save(state,iter)
+                if stopping:
+                    writer.close()
+                    print("Rank %d saved state at iter %d, exiting" %
+                          (rank,iter))
+                    sys.exit(0)
             if iter >= args.num_iters:
                 break
+        # Distributed evaluation on val and test (all ranks take part)
+        last_epoch = (iter >= args.num_iters)
+        evaluate_now = args.eval_every > 0 and \
+            (epoch_count % args.eval_every == 0 or last_epoch)
+        # Local SGD: average the models before they are evaluated or saved
+        # (every epoch without evaluation), so rank 0 never saves its local
+        # model
+        if args.grad_sync == 'local_sgd' and local_count > 0 and \
+                (evaluate_now or args.eval_every == 0):
+            average_model(model,optimizer,args.average_moments)
+            local_count = 0
+            local_loss = 0.0
+        if evaluate_now:
+            val_loss,val_corr = evaluate(model,val_loader,device,args)
+            test_loss,test_corr = evaluate(model,test_loader,device,args)
+            val_losses.append(val_loss)
+            val_corrs.append(val_corr)
+            test_losses.append(test_loss)
+            test_corrs.append(test_corr)
+            if rank == 0:
+                print("Validation loss is ", val_loss)
+                print("Validation average correlation is ",val_corr)
+                print("Test loss is ", test_loss)
+                print("Test average correlation is ", test_corr)
         # Write stats file
-        stats = {'loss_data':loss_data}
         with open(results_path, 'w') as f:
             json.dump(stats, f)
-        if rank == 0 and args.checkpoint_path is not None:
+        # Save weights: best val loss over all ranks' shards, or every epoch
+        # without evaluation
+        save = args.eval_every == 0
+        if evaluate_now and val_loss < best_val_loss:
+            best_val_loss = val_loss
+            save = True
+        if rank == 0 and save and args.checkpoint_path is not None:
             print("Saving weights to %s" % args.checkpoint_path)
             torch.save(model.state_dict(),
                        args.checkpoint_path)
@@ -187,53 +740,16 @@ def test(rank,world_size,args):
     # Model
     model_out = 'pred' # output is always pred for mse loss
     device = 'cpu' # cpu only
-    torch.manual_seed(args.seed) # all processes start with the same model
-    if args.model_type == 'PredNet':
-        model = PredNet(args.in_channels,args.stack_sizes,args.R_stack_sizes,
-                        args.A_kernel_sizes,args.Ahat_kernel_sizes,
-                        args.R_kernel_sizes,args.use_satlu,args.pixel_max,
-                        args.Ahat_act,args.satlu_act,args.error_act,
-                        args.LSTM_act,args.LSTM_c_act,args.bias,
-                        args.use_1x1_out,args.FC,model_out,device)
-    elif args.model_type == 'ConvLSTM':
-        model = ConvLSTM(args.in_channels,args.hidden_channels,args.kernel_size,
-                         args.LSTM_act,args.LSTM_c_act,args.out_act,
-                         args.bias,args.FC,device)
+    model = get_model(args,model_out,device)
     # Load from checkpoint
     if args.checkpoint_path is not None:
         model.load_state_dict(torch.load(args.checkpoint_path))
     else:
         print("Must include checkpoint_path argument to test")
-    model.eval()
 
-    # Data
-    if args.dataset == 'KITTI':
-        dataset = KITTI(args.val_data_path,args.val_sources_path,args.seq_len)
-    elif args.dataset == 'CCN':
-        dataset = CCN(args.val_data_path,args.seq_len)
-    partitioner = DataPartitioner(dataset, world_size)
-    partition = partitioner.get_partition(rank)
-    val_loader = DataLoader(partition, args.batch_size,
-                              shuffle=True,num_workers=1,pin_memory=False)
-    if rank == 0:
-        print("Val dataset has %d samples total" % len(dataset))
-    print("%s: Partition of val dataset has %d samples" % (hostname,
-                                                           len(partition)))
-
-    # Loss function: always use mse for testing
-    mse_loss = nn.MSELoss()
-
-    # Test model on partition
-    with torch.no_grad():
-        losses = []
-        for X in val_loader:
-            # Forward
-            X = X.to(device)
-            output = model(X)
-            # Compute loss
-            X_no_t0 = X[:,1:,:,:,:]
-            loss = mse_loss(output,X_no_t0)
-            # Record loss
-            loss_datapoint = loss.data.item()
-            losses.append(loss_datapoint)
-    print("Average MSE: ", np.mean(losses))
+    # Global MSE and correlation on val and test, sharded across ranks
+    for split in ['val','test']:
+        loader = get_eval_loader(args,split,rank,world_size)
+        mse,corr = evaluate(model,loader,device,args)
+        if rank == 0:
+            print("%s MSE: %f, correlation: %f" % (split,mse,corr))
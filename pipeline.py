@@ -0,0 +1,386 @@
+# Pipeline-parallel inference: groups of layers of LadderNet or
+# StackedConvLSTM run in separate processes (or threads) pinned to their
+# own cores, streaming per time step activations between stages
+import os
+import time
+import queue
+import threading
+import numpy as np
+
+import torch
+import torch.nn as nn
+import torch.multiprocessing as mp
+
+from Ladder import *
+from StackedConvLSTM import *
+from utils import *
+from train import parser as train_parser
+from train import get_model
+
+# Model options are the same as in train.py
+parser = child_parser(train_parser)
+parser.add_argument('--model_type', choices=['LadderNet','StackedConvLSTM'],
+                    default='LadderNet', help='Type of model to run.')
+parser.add_argument('--n_stages', type=int, default=2,
+                    help='Number of pipeline stages')
+parser.add_argument('--stage_starts', type=int, nargs='+', default=None,
+                    help='First layer of each stage (default: layers split ' +
+                         'to balance the conv FLOPs of stages)')
+parser.add_argument('--cores_per_stage', type=int, default=None,
+                    help='Cores each stage is pinned to (default: all ' +
+                         'cores split evenly between stages)')
+parser.add_argument('--pipeline_backend', choices=['process','thread'],
+                    default='process', help='Run stages in processes or ' +
+                                            'threads (threads share one ' +
+                                            'pool of intra-op threads)')
+parser.add_argument('--micro_batches', type=int, default=1,
+                    help='Number of micro-batches the batch is split into')
+parser.add_argument('--bench_height', type=int, default=128,
+                    help='Height of random input images')
+parser.add_argument('--bench_width', type=int, default=160,
+                    help='Width of random input images')
+parser.add_argument('--bench_iters', type=int, default=5,
+                    help='Number of timed iterations')
+parser.add_argument('--seed', type=int, default=0,
+                    help='Random seed for model initialization and inputs')
+
+class LadderNetLayers(object):
+    """
+    Per layer steps of LadderNet for pipeline stages. The encoder (A and R)
+    goes bottom-up, passing A to the stage above; the decoder (Ahat) goes
+    top-down, passing Ahat to the stage below.
+    """
+    def __init__(self,model):
+        self.model = model
+        self.R_reps = True # reps are encoder R
+
+    def init_hidden(self,X_meta,lo,hi):
+        H_0,C_0 = self.model.initialize(X_meta)
+        enc_hidden = [(H_0[l],C_0[l]) for l in range(lo,hi)]
+        return enc_hidden,[None]*(hi - lo)
+
+    def encode(self,l,A_lm1,hidden_l):
+        A_l,R_l,hidden_l = self.model.encoder_step(l,A_lm1,hidden_l)
+        return A_l,R_l,hidden_l,A_l # last: sent to the layer above
+
+    def decode(self,l,A_l,R_l,down,hidden_l):
+        Ahat_l = self.model.decoder_step(l,A_l,R_l,down)
+        return Ahat_l,hidden_l,Ahat_l,None # Ahat, hidden, sent below, rep
+
+class StackedConvLSTMLayers(object):
+    """
+    Per layer steps of StackedConvLSTM for pipeline stages. The forward path
+    goes bottom-up, passing forward R to the stage above; the backward path
+    goes top-down, passing backward R to the stage below.
+    """
+    def __init__(self,model):
+        self.model = model
+        self.R_reps = False # reps are backward R
+
+    def init_hidden(self,X_meta,lo,hi):
+        H_f,C_f,H_b,C_b = self.model.initialize(X_meta)
+        enc_hidden = [(H_f[l],C_f[l]) for l in range(lo,hi)]
+        dec_hidden = [(H_b[l],C_b[l]) for l in range(lo,hi)]
+        return enc_hidden,dec_hidden
+
+    def encode(self,l,R_lm1,hidden_l):
+        A_l,R_l,hidden_l = self.model.forward_step(l,R_lm1,hidden_l)
+        return A_l,R_l,hidden_l,R_l
+
+    def decode(self,l,A_l,R_l,down,hidden_l):
+        R_b,hidden_l,Ahat_l = self.model.backward_step(l,R_l,down,hidden_l)
+        return Ahat_l,hidden_l,R_b,R_b
+
+def get_layers(model):
+    if isinstance(model,LadderNet):
+        return LadderNetLayers(model)
+    elif isinstance(model,StackedConvLSTM):
+        return StackedConvLSTMLayers(model)
+    msg = "Pipeline not supported for %s" % type(model).__name__
+    raise ValueError(msg)
+
+def layer_costs(model):
+    # Relative cost of each layer: conv weights times spatial size (which
+    # is divided by 4 in each layer)
+    costs = [0.0]*model.nb_layers
+    for child in model.children():
+        if not isinstance(child,nn.ModuleList):
+            continue
+        for l,cell in enumerate(child):
+            if cell is None:
+                continue
+            n_weights = sum(m.weight.numel() for m in cell.modules()
+                            if isinstance(m,nn.Conv2d))
+            costs[l] += n_weights / 4**l
+    return costs
+
+def balance_stages(costs,n_stages):
+    # First layer of each of n_stages groups of consecutive layers, starting
+    # a new group once the previous ones reach their share of the total
+    # cost (leaving at least one layer for each remaining group)
+    total = sum(costs)
+    starts = [0]
+    cum_cost = 0.0
+    for l in range(1,len(costs)):
+        cum_cost += costs[l-1]
+        n_left = n_stages - len(starts)
+        if n_left == 0:
+            break
+        if cum_cost >= total*len(starts)/n_stages or len(costs) - l == n_left:
+            starts.append(l)
+    return starts
+
+def pin_thread(cores,set_threads=True):
+    # Pin the calling thread (and threads it starts) to cores, and with
+    # set_threads use as many intra-op threads as cores. The number of
+    # intra-op threads is process-wide, so it is only set in stage processes:
+    # stages running as threads share one intra-op pool.
+    if cores:
+        os.sched_setaffinity(0,cores)
+        if set_threads:
+            torch.set_num_threads(len(cores))
+
+def encoder_lane(layers,lo,hi,cores,up_in,up_out,local,own_process):
+    # Bottom-up path of layers lo..hi-1 for each (micro-batch, time step)
+    pin_thread(cores,own_process)
+    with torch.no_grad():
+        while True:
+            msg = up_in.get()
+            if msg is None:
+                local.put(None)
+                if up_out is not None:
+                    up_out.put(None)
+                return
+            m,t,seq_len,X_meta,x = msg
+            if t == 0:
+                enc_hidden,dec_hidden = layers.init_hidden(X_meta,lo,hi)
+            A = []
+            R = []
+            for i,l in enumerate(range(lo,hi)):
+                A_l,R_l,enc_hidden[i],x = layers.encode(l,x,enc_hidden[i])
+                A.append(A_l)
+                R.append(R_l)
+            if up_out is not None:
+                up_out.put((m,t,seq_len,X_meta,x))
+            hidden = dec_hidden if t == 0 else None
+            local.put((m,t,seq_len,A,R,hidden))
+
+def decoder_lane(layers,lo,hi,down_in,down_out,local,results):
+    # Top-down path of layers lo..hi-1, errors on the predictions of the
+    # previous step and outputs of the stage
+    model = layers.model
+    with torch.no_grad():
+        while True:
+            msg = local.get()
+            if msg is None:
+                return
+            m,t,seq_len,A,R,hidden = msg
+            if t == 0:
+                dec_hidden = hidden
+                Ahat_tm1 = None
+            down = None if down_in is None else down_in.get()
+            Ahat_t = [None]*(hi - lo)
+            reps = [None]*(hi - lo)
+            for i in reversed(range(hi - lo)):
+                l = lo + i
+                Ahat_t[i],dec_hidden[i],down,reps[i] = layers.decode(
+                    l,A[i],R[i],down,dec_hidden[i])
+            if down_out is not None:
+                down_out.put(down)
+
+            # Outputs: errors, layer 0 predictions and reps of the last step
+            if Ahat_tm1 is not None:
+                for i,l in enumerate(range(lo,hi)):
+                    E_l = model.E_layer(A[i],Ahat_tm1[i])
+                    E_mean = torch.mean(E_l,dtype=torch.float32).item()
+                    results.put(('error',m,t,l,E_mean))
+            if lo == 0:
+                results.put(('pred',m,t,Ahat_t[0]))
+            if t == seq_len - 1:
+                stage_reps = R if layers.R_reps else reps
+                for i,l in enumerate(range(lo,hi)):
+                    if stage_reps[i] is not None:
+                        results.put(('rep',m,l,stage_reps[i]))
+                results.put(('done',m))
+            Ahat_tm1 = Ahat_t
+
+def stage_main(model,lo,hi,cores,own_process,up_in,up_out,down_in,down_out,
+               results):
+    # One pipeline stage: encoder and decoder lanes run concurrently, so the
+    # stage works on the encoder of later time steps while waiting for the
+    # stage above to send its decoder output
+    pin_thread(cores,own_process)
+    model.eval()
+    layers = get_layers(model)
+    local = queue.Queue()
+    encoder = threading.Thread(target=encoder_lane,
+                               args=(layers,lo,hi,cores,up_in,up_out,local,
+                                     own_process))
+    encoder.start()
+    decoder_lane(layers,lo,hi,down_in,down_out,local,results)
+    encoder.join()
+
+class PipelineRunner(object):
+    """
+    Inference with LadderNet or StackedConvLSTM split into stages of
+    consecutive layers (stage_starts: first layer of each stage). Each
+    stage runs in its own process (or thread) pinned to its cores, so
+    different stages work on different time steps or micro-batches at the
+    same time. Stage processes use as many intra-op threads as cores; stage
+    threads share the intra-op pool of the calling process (its
+    torch.get_num_threads()). Calling the runner gives the same outputs as
+    model(X) for model.output.
+    """
+    def __init__(self,model,stage_starts,cores=None,backend='process'):
+        self.model = model
+        self.nb_layers = model.nb_layers
+        self.output = model.output
+        self.stage_ends = stage_starts[1:] + [model.nb_layers]
+        self.n_stages = len(stage_starts)
+        if cores is None:
+            cores = [None]*self.n_stages
+        if backend == 'process':
+            ctx = mp.get_context('spawn')
+            make_queue = ctx.Queue
+            make_worker = ctx.Process
+        else:
+            make_queue = queue.Queue
+            make_worker = threading.Thread
+        model.eval()
+        model.share_memory()
+
+        # up[s]: into stage s from below, down[s]: into stage s from above
+        self.up = [make_queue() for s in range(self.n_stages)]
+        self.down = [make_queue() for s in range(self.n_stages)]
+        self.results = make_queue()
+        self.workers = []
+        for s,(lo,hi) in enumerate(zip(stage_starts,self.stage_ends)):
+            up_out = self.up[s+1] if s < self.n_stages - 1 else None
+            down_in = self.down[s] if s < self.n_stages - 1 else None
+            down_out = self.down[s-1] if s > 0 else None
+            worker = make_worker(target=stage_main,
+                                 args=(model,lo,hi,cores[s],
+                                       backend == 'process',self.up[s],
+                                       up_out,down_in,down_out,self.results))
+            worker.start()
+            self.workers.append(worker)
+
+    def __call__(self,X,micro_batches=1):
+        X_micro = X.chunk(micro_batches,dim=0)
+        seq_len = X.shape[1]
+        for m,X_m in enumerate(X_micro):
+            # Only the size of X_meta is used (to initialize states)
+            X_meta = X_m.new_empty(X_m.shape[0],1,1,X.shape[3],X.shape[4])
+            for t in range(seq_len):
+                self.up[0].put((m,t,seq_len,X_meta,X_m[:,t].contiguous()))
+
+        preds = [[None]*seq_len for X_m in X_micro]
+        reps = [{} for X_m in X_micro]
+        errors = np.zeros((len(X_micro),seq_len,self.nb_layers))
+        n_done = 0
+        while n_done < len(X_micro)*self.n_stages:
+            msg = self.results.get()
+            if msg[0] == 'pred':
+                _,m,t,pred = msg
+                preds[m][t] = pred
+            elif msg[0] == 'rep':
+                _,m,l,rep = msg
+                reps[m][l] = rep
+            elif msg[0] == 'error':
+                _,m,t,l,E_mean = msg
+                errors[m,t-1,l] = E_mean # first step has no error
+            else:
+                n_done += 1
+        return self.gather(X_micro,preds,reps,errors)
+
+    def gather(self,X_micro,preds,reps,errors):
+        # Outputs as returned by model(X), from all micro-batches
+        outputs = {}
+        outputs_requested = get_outputs(self.output)
+        if 'error' in outputs_requested:
+            weights = np.array([X_m.shape[0] for X_m in X_micro],dtype=float)
+            weights = weights / weights.sum()
+            errors = np.tensordot(weights,errors,axes=1)
+            outputs['error'] = torch.tensor(errors,dtype=torch.float32)
+        if 'pred' in outputs_requested:
+            # last prediction is beyond the sequence
+            preds = [torch.stack(preds_m[:-1],dim=1) for preds_m in preds]
+            outputs['pred'] = torch.cat(preds,dim=0)
+        if 'rep' in outputs_requested:
+            layers = sorted(reps[0])
+            outputs['rep'] = [torch.cat([reps_m[l] for reps_m in reps],dim=0)
+                              for l in layers]
+        return select_outputs(outputs,self.output)
+
+    def close(self):
+        self.up[0].put(None) # passed up through the encoder lanes
+        for worker in self.workers:
+            worker.join()
+
+def get_stage_cores(n_stages,cores_per_stage=None):
+    # Consecutive blocks of cores for each stage
+    available = sorted(os.sched_getaffinity(0))
+    if cores_per_stage is None:
+        cores_per_stage = max(len(available) // n_stages,1)
+    return [available[s*cores_per_stage:(s+1)*cores_per_stage]
+            for s in range(n_stages)]
+
+def max_diff(output,reference):
+    # Max abs difference between (dicts/lists of) outputs
+    if isinstance(output,dict):
+        return max(max_diff(output[k],reference[k]) for k in output)
+    if isinstance(output,list):
+        return max(max_diff(o,r) for o,r in zip(output,reference))
+    return torch.max(torch.abs(output - reference)).item()
+
+def time_iters(fn,X,n_iters):
+    # Average time of fn(X) over n_iters iterations, after a warm-up
+    fn(X)
+    times = []
+    for i in range(n_iters):
+        start_t = time.time()
+        fn(X)
+        times.append(time.time() - start_t)
+    return np.mean(times)
+
+def main(args):
+    # Pipeline stages run on CPU cores
+    device = torch.device("cpu")
+    torch.manual_seed(args.seed)
+    model = get_model(args,('pred','rep','error'),device)
+    if args.load_weights_from is not None:
+        model.load_state_dict(torch.load(args.load_weights_from,
+                                         map_location=device))
+    model.eval()
+    torch.manual_seed(args.seed)
+    X = torch.rand(args.batch_size,args.seq_len,args.in_channels,
+                   args.bench_height,args.bench_width)
+
+    stage_starts = args.stage_starts
+    if stage_starts is None:
+        stage_starts = balance_stages(layer_costs(model),args.n_stages)
+    cores = get_stage_cores(len(stage_starts),args.cores_per_stage)
+    print("Stage first layers: %s, cores: %s" % (stage_starts,cores))
+
+    # Sequential baseline using all cores of the stages
+    torch.set_num_threads(sum(len(c) for c in cores))
+    with torch.no_grad():
+        reference = model(X)
+        seq_time = time_iters(model,X,args.bench_iters)
+
+    runner = PipelineRunner(model,stage_starts,cores,args.pipeline_backend)
+    pipeline_fn = lambda X: runner(X,args.micro_batches)
+    output = pipeline_fn(X)
+    pipe_time = time_iters(pipeline_fn,X,args.bench_iters)
+    runner.close()
+
+    print("Max abs difference from sequential outputs: %.3e" % (
+          max_diff(output,reference)))
+    print("%-12s %-12s %-10s" % ('run','time (s)','speedup'))
+    print("%-12s %-12.3f %-10.2f" % ('sequential',seq_time,1.0))
+    print("%-12s %-12.3f %-10.2f" % ('pipeline',pipe_time,seq_time/pipe_time))
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print(args)
+    main(args)
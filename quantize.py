@@ -0,0 +1,168 @@
+# Int8 quantization of frozen models for representation extraction, and a
+# report comparing quantized results with fp32 results
+import copy
+import json
+import argparse
+import numpy as np
+import hickle as hkl
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Subset
+from torch.ao.quantization import QuantWrapper, get_default_qconfig
+from torch.ao.quantization import prepare, convert
+
+from data import *
+from utils import *
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--fp32_rsa', default=None,
+                    help='RSA.py output (hkl) from the fp32 model')
+parser.add_argument('--int8_rsa', default=None,
+                    help='RSA.py output (hkl) from the quantized model')
+parser.add_argument('--fp32_decoding', default=None,
+                    help='layer_decoding.py output (json) from the fp32 ' +
+                         'model. With --quantize_eval it also has int8 ' +
+                         'accuracies of the same decoders (preferred)')
+parser.add_argument('--int8_decoding', default=None,
+                    help='layer_decoding.py output (json) from the ' +
+                         'quantized model, when decoders were trained on ' +
+                         'int8 reps (use the same --seed in both runs)')
+parser.add_argument('--min_rsa_corr', type=float, default=0.99,
+                    help='Min correlation between fp32 and int8 similarity ' +
+                         'matrices for quantization to be considered safe')
+parser.add_argument('--max_acc_drop', type=float, default=0.01,
+                    help='Max drop in decoding accuracy for quantization ' +
+                         'to be considered safe')
+
+def wrap_convs(module):
+    # Each conv becomes quantize -> int8 conv -> dequantize. Everything
+    # between convs (LSTM updates, errors, pooling, etc.) stays in fp32.
+    for name,child in module.named_children():
+        if isinstance(child,nn.Conv2d):
+            setattr(module,name,QuantWrapper(child))
+        else:
+            wrap_convs(child)
+
+def quantize_model(model,calibration_batches,backend='x86'):
+    """
+    Static int8 quantization of all convs of a model (on CPU). Activation
+    ranges are calibrated by running the model on calibration_batches.
+    Returns a quantized copy, with the same output options as the model.
+    """
+    msg = "fused_gates uses conv weights directly and can't be quantized"
+    assert not getattr(model,'fused_gates',False), msg
+    torch.backends.quantized.engine = backend
+    q_model = copy.deepcopy(model).cpu()
+    if hasattr(q_model,'device'):
+        q_model.device = 'cpu' # states allocated with the copy on CPU
+    q_model.eval()
+    wrap_convs(q_model)
+    qconfig = get_default_qconfig(backend)
+    for module in q_model.modules():
+        if isinstance(module,QuantWrapper):
+            module.qconfig = qconfig
+    prepare(q_model,inplace=True)
+    with torch.no_grad():
+        for X in calibration_batches:
+            q_model(X.cpu())
+    convert(q_model,inplace=True)
+    return q_model
+
+def get_calibration_batches(data_path,seq_len,downsample_size,batch_size,
+                            n_batches,last_only=False):
+    # Fixed random subset of CCN sequences used to calibrate activations
+    downsample_size = (downsample_size,downsample_size)
+    calib_data = CCN(data_path,seq_len,downsample_size=downsample_size,
+                     last_only=last_only)
+    n_seqs = min(n_batches*batch_size,len(calib_data))
+    rng = np.random.RandomState(0)
+    ids = rng.choice(len(calib_data),size=n_seqs,replace=False)
+    calib_loader = DataLoader(Subset(calib_data,ids.tolist()),batch_size)
+    return [X for X in calib_loader]
+
+def rsa_report(fp32_rsa,int8_rsa,min_rsa_corr):
+    # Compare unsorted similarity matrices (same label order in both)
+    fp32_data = hkl.load(fp32_rsa)
+    int8_data = hkl.load(int8_rsa)
+    fp32_S = fp32_data['unsorted']
+    int8_S = int8_data['unsorted']
+    msg = "RSA outputs have different labels"
+    assert list(fp32_S['labels']) == list(int8_S['labels']), msg
+    safe = True
+    print("%-10s %-12s %-12s" % ('layer','RSA corr','max |diff|'))
+    layer_names = [name for name in fp32_S if name != 'labels']
+    for name in layer_names:
+        S_fp32 = np.asarray(fp32_S[name])
+        S_int8 = np.asarray(int8_S[name])
+        upper = np.triu_indices_from(S_fp32,k=1) # off-diagonal entries
+        corr = np.corrcoef(S_fp32[upper],S_int8[upper])[0,1]
+        max_diff = np.max(np.abs(S_fp32 - S_int8))
+        print("%-10s %-12.4f %-12.4f" % (name,corr,max_diff))
+        safe = safe and corr >= min_rsa_corr
+    fp32_time = fp32_data['info'].get('extraction_time')
+    int8_time = int8_data['info'].get('extraction_time')
+    if fp32_time is not None and int8_time is not None:
+        print("Extraction time fp32: %.1fs, int8: %.1fs (speedup %.2fx)" % (
+              fp32_time,int8_time,fp32_time/int8_time))
+    return safe
+
+def best_test_accs(stats,test_key='test_acc_data'):
+    # Test accuracy of each decoder at its best validation accuracy
+    accs = []
+    for val_accs,test_accs in zip(stats['val_acc_data'],stats[test_key]):
+        accs.append(test_accs[int(np.argmax(val_accs))])
+    return accs
+
+def decoding_report(fp32_decoding,int8_decoding,max_acc_drop):
+    """
+    Decoding accuracy drop of each layer. Without int8_decoding, the same
+    decoders (trained on fp32 reps) are evaluated on fp32 and int8 reps
+    (layer_decoding.py --quantize_eval), so the drop is only quantization
+    error. Decoders trained in two separate runs also differ by training
+    noise, unless both runs used the same seed.
+    """
+    with open(fp32_decoding,'r') as f:
+        fp32_stats = json.load(f)
+    fp32_accs = best_test_accs(fp32_stats)
+    if int8_decoding is None:
+        msg = "fp32_decoding has no int8 accuracies: run layer_decoding.py " \
+              "with --quantize_eval, or give int8_decoding"
+        assert 'test_acc_int8_data' in fp32_stats, msg
+        int8_accs = best_test_accs(fp32_stats,'test_acc_int8_data')
+    else:
+        with open(int8_decoding,'r') as f:
+            int8_stats = json.load(f)
+        int8_accs = best_test_accs(int8_stats)
+        seeds = (fp32_stats.get('seed'),int8_stats.get('seed'))
+        if seeds[0] is None or seeds[0] != seeds[1]:
+            print("Warning: decoders were trained in separate runs without "
+                  "the same seed, so accuracy drops include decoder "
+                  "training noise")
+    safe = True
+    print("%-10s %-12s %-12s %-12s" % ('layer','fp32 acc','int8 acc','drop'))
+    for l,(fp32_acc,int8_acc) in enumerate(zip(fp32_accs,int8_accs)):
+        name = 'layer%d' % (l-1) if l > 0 else 'pixels'
+        drop = fp32_acc - int8_acc
+        print("%-10s %-12.4f %-12.4f %-12.4f" % (name,fp32_acc,int8_acc,drop))
+        safe = safe and drop <= max_acc_drop
+    return safe
+
+def main(args):
+    safe = True
+    if args.fp32_rsa is not None and args.int8_rsa is not None:
+        print("RSA: fp32 vs int8 similarity matrices")
+        safe = rsa_report(args.fp32_rsa,args.int8_rsa,args.min_rsa_corr)
+    if args.fp32_decoding is not None:
+        print("Layer decoding: test accuracy at best validation accuracy")
+        decoding_safe = decoding_report(args.fp32_decoding,args.int8_decoding,
+                                        args.max_acc_drop)
+        safe = safe and decoding_safe
+    print("Int8 quantization is %s (RSA corr >= %.3f, accuracy drop <= %.3f)"
+          % ('SAFE' if safe else 'NOT SAFE',args.min_rsa_corr,
+             args.max_acc_drop))
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print(args)
+    main(args)
@@ -0,0 +1,139 @@
+# Resumable training: full training states (model, optimizer, scheduler,
+# counters, RNG, data order) written from a background thread, resumed
+# from the latest one, and flushed when the job is told to stop (SIGTERM)
+import os
+import glob
+import queue
+import random
+import signal
+import threading
+import numpy as np
+
+import torch
+
+def cpu_snapshot(state):
+    # Copy of nested dicts/lists/tuples with tensors cloned to CPU
+    if isinstance(state,torch.Tensor):
+        return state.detach().cpu().clone()
+    elif isinstance(state,dict):
+        return {key:cpu_snapshot(value) for key,value in state.items()}
+    elif isinstance(state,(list,tuple)):
+        return type(state)(cpu_snapshot(value) for value in state)
+    return state
+
+def to_device(state,device):
+    # Nested tensors (e.g. recurrent states) moved to device
+    if isinstance(state,torch.Tensor):
+        return state.to(device)
+    elif isinstance(state,(list,tuple)):
+        return type(state)(to_device(value,device) for value in state)
+    return state
+
+def get_rng_state():
+    state = {'python':random.getstate(),
+             'numpy':np.random.get_state(),
+             'torch':torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def random_seed():
+    # Seed drawn from the OS (global RNGs may have been seeded), stored in
+    # training states so a resumed run keeps the same data order
+    return random.SystemRandom().randrange(2**31)
+
+def state_path(state_dir,iter):
+    return os.path.join(state_dir,'state_%09d.pt' % iter)
+
+def latest_state(state_dir):
+    # Path of the most recent training state in state_dir, or None
+    paths = sorted(glob.glob(os.path.join(state_dir,'state_*.pt')))
+    return paths[-1] if paths else None
+
+def load_state(state_dir):
+    # Most recent training state (on CPU), or None
+    path = latest_state(state_dir)
+    if path is None:
+        return None
+    print("Resuming from %s" % path)
+    return torch.load(path,map_location='cpu',weights_only=False)
+
+class CheckpointWriter(object):
+    """
+    Writes training states to state_dir from a background thread. save()
+    only takes a CPU snapshot (waiting for the previous write if it isn't
+    done); serialization and disk writes happen on the thread. Each state
+    is written to a temporary file and renamed, so the latest state is
+    never partially written, and only the last keep states are kept. If a
+    write fails (e.g. full disk), the thread stops and the error is raised
+    by the next save() or close().
+    """
+    def __init__(self,state_dir,keep=2):
+        self.state_dir = state_dir
+        self.keep = keep
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        self.error = None # exception that stopped the thread
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("Writing a training state to %s failed" %
+                               self.state_dir) from self.error
+
+    def put(self,task):
+        # Waits for room in the queue while the thread is alive
+        while self.thread.is_alive():
+            try:
+                self.queue.put(task,timeout=1)
+                return
+            except queue.Full:
+                pass
+        self.check()
+
+    def save(self,state,iter):
+        self.check()
+        self.put((iter,cpu_snapshot(state)))
+
+    def run(self):
+        try:
+            while True:
+                task = self.queue.get()
+                if task is None:
+                    break
+                iter,state = task
+                path = state_path(self.state_dir,iter)
+                torch.save(state,path + '.tmp')
+                os.replace(path + '.tmp',path)
+                paths = sorted(glob.glob(os.path.join(self.state_dir,
+                                                      'state_*.pt')))
+                for old_path in paths[:-self.keep]:
+                    os.remove(old_path)
+        except Exception as e:
+            self.error = e
+
+    def close(self):
+        # Returns once every saved state is on disk (raises if one failed)
+        self.put(None)
+        self.thread.join()
+        self.check()
+
+class StopRequest(object):
+    # Records SIGTERM (e.g. SLURM preemption or time limit) so the training
+    # loop can write a final state and stop at the end of the iteration
+    def __init__(self):
+        self.requested = False
+        signal.signal(signal.SIGTERM,self.handle)
+
+    def handle(self,signum,frame):
+        print("Received SIGTERM: stopping after this iteration")
+        self.requested = True
@@ -0,0 +1,375 @@
+# Local prediction service: keeps a loaded model in memory and serves
+# predictions and representations over localhost HTTP, gathering concurrent
+# requests into batches within a latency budget
+import io
+import json
+import time
+import queue
+import threading
+import collections
+from urllib.request import urlopen
+from urllib.parse import urlparse, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+import torch
+
+from PredNet import *
+from Ladder import *
+from utils import *
+from streams import StreamSlots
+from train import parser as train_parser
+from train import get_model
+
+# Model options are the same as in train.py
+parser = child_parser(train_parser)
+parser.add_argument('--host', default='127.0.0.1',
+                    help='Address to serve on (localhost only by default)')
+parser.add_argument('--port', type=int, default=8470,
+                    help='Port to serve on')
+parser.add_argument('--max_batch', type=int, default=8,
+                    help='Maximum number of requests run as one batch')
+parser.add_argument('--max_wait_ms', type=float, default=5.0,
+                    help='How long the first request of a batch waits for ' +
+                         'others to arrive')
+parser.add_argument('--n_slots', type=int, default=64,
+                    help='Maximum number of concurrent streams of each ' +
+                         'frame size (reset a stream to free its slot)')
+parser.add_argument('--n_latencies', type=int, default=1000,
+                    help='Number of recent request latencies kept for the ' +
+                         'latency percentiles in /stats')
+
+class Request(object):
+    # Sequence ('seq', X of (len,C,H,W)) or single frame of a stateful stream
+    # ('step', X of (C,H,W)), answered by the batcher thread
+    def __init__(self,kind,X,outputs,stream=None):
+        self.kind = kind
+        self.X = X
+        self.outputs = outputs
+        self.stream = stream
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class Stats(object):
+    # Throughput and latency counters, updated by the batcher thread
+    def __init__(self,n_latencies):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.n_requests = 0
+        self.n_errors = 0
+        self.n_batches = 0
+        self.n_frames = 0
+        self.latencies = collections.deque(maxlen=n_latencies)
+    def record(self,batch,n_frames,error=False):
+        now = time.time()
+        with self.lock:
+            self.n_batches += 1
+            self.n_requests += len(batch)
+            self.n_frames += n_frames
+            if error:
+                self.n_errors += len(batch)
+            for request in batch:
+                self.latencies.append(now - request.arrival)
+    def summary(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            latencies = np.array(self.latencies)
+            summary = {'uptime':elapsed,
+                       'requests':self.n_requests,
+                       'errors':self.n_errors,
+                       'batches':self.n_batches,
+                       'frames':self.n_frames,
+                       'requests_per_s':self.n_requests / elapsed,
+                       'frames_per_s':self.n_frames / elapsed}
+            if self.n_batches > 0:
+                summary['mean_batch_size'] = self.n_requests / self.n_batches
+        if len(latencies) > 0:
+            summary['latency_mean'] = float(np.mean(latencies))
+            for q in [50,95,99]:
+                value = float(np.percentile(latencies,q))
+                summary['latency_p%d' % q] = value
+        return summary
+
+class Batcher(object):
+    """
+    Runs the model on a single thread. Requests arriving within max_wait_ms
+    of the first one (up to max_batch) are grouped by kind and frame size
+    and each group runs as one batch: sequences of the same length through
+    model(X), stream frames through one StreamSlots.step per frame size.
+    """
+    def __init__(self,model,device,bf16,max_batch,max_wait_ms,stats,
+                 n_slots):
+        self.model = model
+        self.device = device
+        self.bf16 = bf16
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.stats = stats
+        self.queue = queue.Queue()
+        self.deferred = [] # requests of a stream already in the last batch
+        self.n_slots = n_slots
+        self.slots = {} # frame shape: StreamSlots
+        self.stream_shapes = {} # stream id: frame shape
+        # Models without outputs to select (ConvLSTM) only return 'pred'
+        self.selectable = hasattr(model,'output')
+        self.outputs = {'pred','rep'} if self.selectable else {'pred'}
+        self.thread = threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def submit(self,request):
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def reset(self,stream):
+        # Runs on the batcher thread so states are never reset mid-step
+        self.submit(Request('reset',None,None,stream))
+
+    def gather(self):
+        batch = self.deferred
+        self.deferred = []
+        if not batch:
+            batch.append(self.queue.get())
+        deadline = batch[0].arrival + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        # Only one frame or reset of each stream per batch, in order of
+        # arrival (later ones wait for the next batch)
+        groups = collections.OrderedDict()
+        streams = set()
+        for request in batch:
+            if request.stream is not None:
+                if request.stream in streams:
+                    self.deferred.append(request)
+                    continue
+                streams.add(request.stream)
+            if request.kind == 'reset':
+                key = ('reset',)
+            elif request.kind == 'step':
+                key = ('step',tuple(request.X.shape))
+            else:
+                key = ('seq',tuple(request.X.shape))
+            groups.setdefault(key,[]).append(request)
+        return list(groups.values())
+
+    def run(self):
+        while True:
+            for group in self.gather():
+                try:
+                    n_frames = self.run_group(group)
+                    error = False
+                except Exception as e:
+                    for request in group:
+                        request.error = e
+                    n_frames = 0
+                    error = True
+                if group[0].kind != 'reset':
+                    self.stats.record(group,n_frames,error)
+                for request in group:
+                    request.done.set()
+
+    def run_group(self,group):
+        kind = group[0].kind
+        if kind == 'reset':
+            for request in group:
+                self.evict(request.stream)
+            return 0
+        outputs = set()
+        for request in group:
+            outputs |= request.outputs
+        X = torch.stack([torch.from_numpy(request.X) for request in group])
+        X = X.to(self.device)
+        with torch.no_grad():
+            with bf16_autocast(self.device,self.bf16):
+                if kind == 'seq':
+                    results = self.run_seqs(X,outputs)
+                else:
+                    results = self.run_steps(group,X)
+        for i,request in enumerate(group):
+            request.result = {}
+            for name in request.outputs:
+                if name == 'rep':
+                    value = [R_l[i].float().cpu().numpy()
+                             for R_l in results['rep']]
+                else:
+                    value = results[name][i].float().cpu().numpy()
+                request.result[name] = value
+        return X.shape[0]*X.shape[1] if kind == 'seq' else X.shape[0]
+
+    def run_seqs(self,X,outputs):
+        if not self.selectable:
+            return {'pred':self.model(X)}
+        self.model.output = tuple(sorted(outputs))
+        return self.model(X)
+
+    def run_steps(self,group,X_t):
+        # One step of each stream, in the slots of streams of this frame size
+        shape = tuple(X_t.shape[1:])
+        if shape not in self.slots:
+            self.slots[shape] = StreamSlots(self.model,self.n_slots,shape,
+                                            self.device)
+        for request in group:
+            # A stream that changes frame size starts over
+            if self.stream_shapes.get(request.stream,shape) != shape:
+                self.evict(request.stream)
+            self.stream_shapes[request.stream] = shape
+        frames = {request.stream:X_t[i] for i,request in enumerate(group)}
+        results = self.slots[shape].step(frames)
+        results = [results[request.stream] for request in group]
+        preds = torch.stack([pred for pred,_ in results])
+        reps = [torch.stack(R_l) for R_l in zip(*[reps for _,reps in results])]
+        return {'pred':preds,'rep':reps}
+
+    def evict(self,stream):
+        shape = self.stream_shapes.pop(stream,None)
+        if shape is not None:
+            self.slots[shape].evict(stream)
+
+def to_npz(result):
+    # Outputs as .npz bytes: pred, and rep_0, rep_1, ... for reps
+    arrays = {}
+    for name,value in result.items():
+        if name == 'rep':
+            for l,R_l in enumerate(value):
+                arrays['rep_%d' % l] = R_l
+        else:
+            arrays[name] = value
+    buf = io.BytesIO()
+    np.savez(buf,**arrays)
+    return buf.getvalue()
+
+def from_npz(data):
+    # Inverse of to_npz
+    arrays = np.load(io.BytesIO(data))
+    result = {}
+    n_reps = len([name for name in arrays.files if name.startswith('rep_')])
+    if n_reps > 0:
+        result['rep'] = [arrays['rep_%d' % l] for l in range(n_reps)]
+    for name in arrays.files:
+        if not name.startswith('rep_'):
+            result[name] = arrays[name]
+    return result
+
+def make_handler(batcher,stats,stateful):
+    class Handler(BaseHTTPRequestHandler):
+        """
+        GET  /stats                          throughput and latency counters
+        POST /predict?outputs=pred,rep       body: .npy sequence (len,C,H,W)
+        POST /step?stream=ID&outputs=pred    body: .npy frame (C,H,W)
+        POST /reset?stream=ID                free the slot of a stream
+        Predictions and reps are returned as .npz (see to_npz). On a
+        stream, pred is the prediction of model.step (as in model(X) with
+        output 'pred'): PredNet predicts the frame sent from the previous
+        frames, LadderNet predicts the next frame.
+        """
+        def send(self,code,body,content_type):
+            self.send_response(code)
+            self.send_header('Content-Type',content_type)
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_error_message(self,code,message):
+            self.send(code,message.encode(),'text/plain')
+
+        def do_GET(self):
+            if urlparse(self.path).path != '/stats':
+                return self.send_error_message(404,'Unknown path')
+            body = json.dumps(stats.summary()).encode()
+            self.send(200,body,'application/json')
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            stream = query.get('stream',[None])[0]
+            outputs = set(query.get('outputs',['pred'])[0].split(','))
+            if not outputs <= batcher.outputs:
+                msg = "outputs: %s" % " and/or ".join(sorted(batcher.outputs))
+                return self.send_error_message(400,msg)
+            if url.path in ['/step','/reset']:
+                if not stateful:
+                    msg = "Streams need PredNet or LadderNet"
+                    return self.send_error_message(400,msg)
+                if stream is None:
+                    return self.send_error_message(400,"Missing stream id")
+            if url.path == '/reset':
+                batcher.reset(stream)
+                return self.send(200,b'','text/plain')
+            length = int(self.headers.get('Content-Length',0))
+            try:
+                X = np.load(io.BytesIO(self.rfile.read(length)))
+                X = X.astype(np.float32)
+            except Exception:
+                return self.send_error_message(400,"Body must be a .npy array")
+            if url.path == '/predict' and X.ndim == 4:
+                request = Request('seq',X,outputs)
+            elif url.path == '/step' and X.ndim == 3:
+                request = Request('step',X,outputs,stream)
+            elif url.path in ['/predict','/step']:
+                msg = "Expected (len,C,H,W) for /predict, (C,H,W) for /step"
+                return self.send_error_message(400,msg)
+            else:
+                return self.send_error_message(404,'Unknown path')
+            try:
+                result = batcher.submit(request)
+            except Exception as e:
+                return self.send_error_message(500,repr(e))
+            self.send(200,to_npz(result),'application/octet-stream')
+
+        def log_message(self,format,*args):
+            pass # counters are in /stats
+    return Handler
+
+def post(url,path,X=None,**query):
+    # Client side: POST an array to the service, returns a dict of outputs
+    data = b''
+    if X is not None:
+        buf = io.BytesIO()
+        np.save(buf,np.asarray(X,dtype=np.float32))
+        data = buf.getvalue()
+    with urlopen('%s%s?%s' % (url,path,urlencode(query)),data) as response:
+        body = response.read()
+    return from_npz(body) if body else None
+
+def predict(url,X,outputs='pred'):
+    # Predictions/reps of one sequence (len,C,H,W)
+    return post(url,'/predict',X,outputs=outputs)
+
+def predict_step(url,stream,X_t,outputs='pred'):
+    # Predictions/reps after one more frame (C,H,W) of a stream
+    return post(url,'/step',X_t,stream=stream,outputs=outputs)
+
+def main(args):
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda:0" if use_cuda else "cpu")
+    model = get_model(args,'pred',device)
+    if args.load_weights_from is not None:
+        model.load_state_dict(torch.load(args.load_weights_from,
+                                         map_location=device))
+    model.eval()
+    stateful = isinstance(model,(PredNet,LadderNet))
+    stats = Stats(args.n_latencies)
+    batcher = Batcher(model,device,args.bf16,args.max_batch,
+                      args.max_wait_ms,stats,args.n_slots)
+    server = ThreadingHTTPServer((args.host,args.port),
+                                 make_handler(batcher,stats,stateful))
+    print("Serving on http://%s:%d" % (args.host,args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print(args)
+    main(args)
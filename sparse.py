@@ -0,0 +1,195 @@
+# Change-gated sparse inference: on each time step, only spatial blocks
+# where the input changed are recomputed, and states and predictions are
+# carried over from the previous step elsewhere
+import time
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+from data import *
+from PredNet import *
+from Ladder import *
+from utils import *
+from tiling import get_alignment, get_halo, get_scale
+from train import parser as train_parser
+from train import get_model
+
+# Model options are the same as in train.py
+parser = child_parser(train_parser)
+parser.add_argument('--model_type', choices=['PredNet','LadderNet'],
+                    default='PredNet', help='Type of model to run.')
+parser.add_argument('--block_size', type=int, default=16,
+                    help='Size of blocks that are skipped or recomputed ' +
+                         '(multiple of 2**(nb_layers-1))')
+parser.add_argument('--tols', type=float, nargs='+',
+                    default=[0.0,0.01,0.02,0.05,0.1],
+                    help='Tolerances to compare: a block is recomputed if ' +
+                         'its max abs change is above the tolerance')
+parser.add_argument('--gate', choices=['frame','error'], default='frame',
+                    help='Detect changes from the frame difference or ' +
+                         'from the layer 0 error magnitude')
+parser.add_argument('--sparse_halo', type=int, default=None,
+                    help='Context around recomputed blocks. Default covers ' +
+                         'the receptive field of one time step.')
+parser.add_argument('--dilate', type=int, default=1,
+                    help='Also recompute blocks up to this many blocks ' +
+                         'away from a changed block')
+parser.add_argument('--n_batches', type=int, default=5,
+                    help='Number of test batches in the report')
+
+def crop(x,y0,y1,x0,x1,height):
+    # Crop of a frame-sized or downsampled tensor (scale found from height)
+    s = get_scale(height,x.shape[-2])
+    return x[...,y0//s:y1//s,x0//s:x1//s]
+
+def paste(full,part,core,tile,height):
+    # Copy the core of a cropped result into the full-size tensor
+    (cy0,cy1,cx0,cx1),(y0,x0) = core,tile
+    s = get_scale(height,full.shape[-2])
+    full[...,cy0//s:cy1//s,cx0//s:cx1//s] = \
+        part[...,(cy0 - y0)//s:(cy1 - y0)//s,(cx0 - x0)//s:(cx1 - x0)//s]
+
+def align_preds(model,preds):
+    # Same predictions as model(X) with output 'pred': PredNet predicts the
+    # current frame (first ignored), LadderNet the next (last ignored)
+    if isinstance(model,LadderNet):
+        return torch.stack(preds[:-1],dim=1)
+    return torch.stack(preds[1:],dim=1)
+
+def change_map(model,X_t,X_tm1,hidden,gate):
+    # Max abs change over batch and channels, (H,W)
+    if gate == 'frame':
+        change = X_t - X_tm1
+    elif isinstance(model,LadderNet):
+        change = X_t - hidden[1][0] # error on prediction of X_t
+    else:
+        change = hidden[1][0] # layer 0 error (E_tm1)
+    return change.abs().amax(dim=(0,1))
+
+def changed_blocks(change,block_size,tol,dilate):
+    # Boolean grid of blocks with change above tol, dilated by dilate blocks
+    change = change.float()[None,None]
+    blocks = F.max_pool2d(change,block_size,ceil_mode=True) > tol
+    if dilate > 0:
+        blocks = F.max_pool2d(blocks.float(),2*dilate + 1,stride=1,
+                              padding=dilate) > 0
+    return blocks[0,0]
+
+def sparse_forward(model,X,block_size,tol,gate='frame',halo=None,dilate=1):
+    """
+    Predictions of PredNet or LadderNet (as model(X) with output 'pred')
+    where each step after the first only recomputes changed blocks.
+    A block is recomputed on a crop with halo pixels of context (default:
+    exact for one step) and its core is pasted into the states; the rest
+    keeps the states and predictions of the previous step. When crops would
+    cover more than the frame, the step is run on the full frame.
+    Returns preds and the fraction of pixel updates skipped.
+    """
+    align = get_alignment(model)
+    msg = "block_size must be a multiple of %d" % align
+    assert block_size % align == 0, msg
+    if halo is None:
+        halo = get_halo(model,1)
+    halo = -(-halo // align) * align
+    X = sequence_to_memory_format(X,model.memory_format)
+    height,width = X.shape[3],X.shape[4]
+    hidden = initial_hidden(model,X)
+    preds = []
+    n_computed = 0
+    for t in range(X.shape[1]):
+        X_t = X[:,t]
+        if t > 0:
+            change = change_map(model,X_t,X[:,t-1],hidden,gate)
+            blocks = changed_blocks(change,block_size,tol,dilate)
+            cores = []
+            for i,j in blocks.nonzero().tolist():
+                cy0,cx0 = i*block_size,j*block_size
+                cy1 = min(cy0 + block_size,height)
+                cx1 = min(cx0 + block_size,width)
+                cores.append((cy0,cy1,cx0,cx1))
+            tiles = [(max(cy0 - halo,0),min(cy1 + halo,height),
+                      max(cx0 - halo,0),min(cx1 + halo,width))
+                     for cy0,cy1,cx0,cx1 in cores]
+            area = sum((y1 - y0)*(x1 - x0) for y0,y1,x0,x1 in tiles)
+        if t == 0 or area >= height*width:
+            outputs,hidden = model.step(X_t,hidden)
+            n_computed += height*width
+        else:
+            # Start from previous outputs and states, recompute changed blocks
+            new = map_structure(torch.clone,(outputs,hidden))
+            for core,(y0,y1,x0,x1) in zip(cores,tiles):
+                crop_t = lambda x: crop(x,y0,y1,x0,x1,height)
+                part = model.step(crop_t(X_t),map_structure(crop_t,hidden))
+                paste_t = lambda full,x: paste(full,x,core,(y0,x0),height)
+                map_structure(paste_t,new,part)
+            outputs,hidden = new
+            n_computed += area
+        preds.append(step_pred(model,outputs))
+    skipped = 1 - n_computed / (X.shape[1]*height*width)
+    return align_preds(model,preds), skipped
+
+def get_test_batches(args,device):
+    if args.dataset == 'KITTI':
+        test_data = KITTI(args.test_data_path,args.test_sources_path,
+                          args.seq_len)
+    elif args.dataset == 'CCN':
+        downsample_size = (args.downsample_size,args.downsample_size)
+        test_data = CCN(args.test_data_path,args.seq_len,
+                        downsample_size=downsample_size,
+                        last_only=args.last_only)
+    test_loader = DataLoader(test_data,args.batch_size,shuffle=False)
+    batches = []
+    for X in test_loader:
+        batches.append(X.to(device))
+        if len(batches) == args.n_batches:
+            break
+    return batches
+
+def report(model,batches,args):
+    # Work skipped vs change in predictions, for each tolerance
+    start_t = time.time()
+    dense_preds = [model(X) for X in batches]
+    dense_time = time.time() - start_t
+    dense_mse = np.mean([F.mse_loss(P,X[:,-P.shape[1]:]).item() for P,X in
+                         zip(dense_preds,batches)]) # same for both models
+    print("Dense: time %.2fs, pred MSE %.6f" % (dense_time,dense_mse))
+    print("%-8s %-10s %-10s %-12s %-12s %-12s" % ('tol','skipped','time',
+                                                   'pred MSE','mean |diff|',
+                                                   'max |diff|'))
+    for tol in args.tols:
+        skipped = []
+        mses = []
+        mean_diffs = []
+        max_diffs = []
+        start_t = time.time()
+        for X,dense in zip(batches,dense_preds):
+            preds,skipped_X = sparse_forward(model,X,args.block_size,tol,
+                                             args.gate,args.sparse_halo,
+                                             args.dilate)
+            skipped.append(skipped_X)
+            mses.append(F.mse_loss(preds,X[:,-preds.shape[1]:]).item())
+            mean_diffs.append(torch.mean(torch.abs(preds - dense)).item())
+            max_diffs.append(torch.max(torch.abs(preds - dense)).item())
+        sparse_time = time.time() - start_t
+        print("%-8.3f %-10.3f %-10.2f %-12.6f %-12.6f %-12.6f" % (
+              tol,np.mean(skipped),sparse_time,np.mean(mses),
+              np.mean(mean_diffs),np.max(max_diffs)))
+
+def main(args):
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda:0" if use_cuda else "cpu")
+    model = get_model(args,'pred',device)
+    if args.load_weights_from is not None:
+        model.load_state_dict(torch.load(args.load_weights_from,
+                                         map_location=device))
+    model.eval()
+    batches = get_test_batches(args,device)
+    with torch.no_grad():
+        report(model,batches,args)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    print(args)
+    main(args)
@@ -0,0 +1,47 @@
+# Streamed evaluation of overlapping KITTI windows: each drive is run once
+# as a stream, and every window is scored on the predictions of its frames
+# from that stream, instead of re-running it from zero states
+import torch
+
+from data import *
+from utils import *
+
+def stream_windows(model,dataset,device,bf16=False,window_ids=None):
+    """
+    Run each drive of a KITTI dataset once (PredNet or LadderNet with output
+    'pred'), in chunks up to the end of each window, carrying the states
+    over. Yields (i, X, preds) for windows i in window_ids (default all), in
+    order within each drive: X the window (len,C,H,W) and preds the
+    predictions of its frames after the first (len-1,C,H,W), made with the
+    context of the drive so far rather than from zero states at the start of
+    the window. Frames shared by overlapping windows are run only once.
+    """
+    if window_ids is not None:
+        window_ids = set(window_ids)
+    for drive in drive_windows(dataset,overlap=True):
+        # Streams start at the start of the drive even when only some of
+        # its windows are wanted, so results don't depend on the selection
+        next_frame = dataset.start_end_idxs[drive[0]][0]
+        if window_ids is not None:
+            drive = [i for i in drive if i in window_ids]
+        hidden = None
+        preds = {} # frame: prediction, kept for frames of later windows
+        for i in drive:
+            start,end = dataset.start_end_idxs[i]
+            if end >= next_frame:
+                # Frames not run yet, up to the end of this window
+                X = dataset.get_frames(next_frame,end).unsqueeze(0)
+                X = X.to(device)
+                continued = hidden is not None
+                with bf16_autocast(device,bf16):
+                    output,hidden = model(X,hidden,return_hidden=True)
+                first = next_frame if continued else next_frame + 1
+                for t in range(output.shape[1]):
+                    preds[first + t] = output[0,t].float()
+                next_frame = end + 1
+            for frame in [f for f in preds if f <= start]:
+                del preds[frame]
+            X = dataset.get_frames(start,end)
+            window_preds = torch.stack([preds[f]
+                                        for f in range(start + 1,end + 1)])
+            yield i,X,window_preds
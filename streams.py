@@ -0,0 +1,120 @@
+# Continuous batching of many video streams: the states of each stream live
+# in one slot (batch index) of preallocated state tensors, and each tick
+# advances all streams with a new frame in one batched model.step
+import torch
+
+from Ladder import *
+from utils import *
+
+def slot_states(model,n_slots,frame_shape,device,dtype=torch.float32):
+    # Zero states of n_slots streams (None where the model has no state yet)
+    X = torch.zeros((n_slots,1) + tuple(frame_shape),device=device,
+                    dtype=dtype)
+    return initial_hidden(model,X)
+
+class StreamSlots(object):
+    """
+    States of up to n_slots streams of frames of the same shape, for PredNet
+    or LadderNet. Streams are admitted to a free slot (its rows zeroed in
+    place) and evicted by freeing the slot: other slots are never copied.
+    step(frames) advances the streams in frames (dict stream: (C,H,W)) in
+    one batch: their rows are gathered, stepped and written back, or the
+    full state tensors are used directly when every slot steps in order.
+    LadderNet streams on their first frame have no predictions yet, and are
+    stepped as a separate batch.
+    """
+    def __init__(self,model,n_slots,frame_shape,device,dtype=torch.float32):
+        self.model = model
+        self.n_slots = n_slots
+        self.frame_shape = tuple(frame_shape)
+        self.states = slot_states(model,n_slots,frame_shape,device,dtype)
+        self.slots = {} # stream: slot
+        self.started = set() # streams stepped at least once
+        self.free = list(reversed(range(n_slots)))
+
+    def __contains__(self,stream):
+        return stream in self.slots
+
+    def __len__(self):
+        return len(self.slots)
+
+    def admit(self,stream):
+        if stream in self.slots:
+            return self.slots[stream]
+        if not self.free:
+            raise RuntimeError("No free slot for stream %s" % stream)
+        slot = self.free.pop()
+        map_structure(lambda h: h[slot].zero_(),self.states)
+        self.slots[stream] = slot
+        return slot
+
+    def evict(self,stream):
+        slot = self.slots.pop(stream,None)
+        if slot is not None:
+            self.started.discard(stream)
+            self.free.append(slot)
+
+    def step(self,frames):
+        # frames: dict stream: frame (C,H,W), one per stream. Returns dict
+        # stream: (pred, reps) with reps of the layers that have R cells.
+        for stream in frames:
+            self.admit(stream)
+        fresh = []
+        started = []
+        for stream in frames:
+            if self.first_step(stream):
+                fresh.append(stream)
+            else:
+                started.append(stream)
+        results = {}
+        for streams in [fresh,started]:
+            if streams:
+                results.update(self.step_group(streams,frames,
+                                               streams is fresh))
+        self.started.update(frames)
+        return results
+
+    def first_step(self,stream):
+        # Only LadderNet has states that are None before the first step
+        return isinstance(self.model,LadderNet) and \
+            stream not in self.started
+
+    def step_group(self,streams,frames,fresh):
+        slots = [self.slots[stream] for stream in streams]
+        X_t = torch.stack([frames[stream] for stream in streams])
+        X_t = sequence_to_memory_format(X_t.unsqueeze(1),
+                                        self.model.memory_format)[:,0]
+        idx = torch.tensor(slots,device=X_t.device)
+        in_order = slots == list(range(self.n_slots))
+        if fresh:
+            hidden = initial_hidden(self.model,X_t.unsqueeze(1))
+        elif in_order:
+            hidden = self.states
+        else:
+            hidden = map_structure(lambda h: h.index_select(0,idx),
+                                   self.states)
+        outputs,hidden = self.model.step(X_t,hidden)
+        if in_order and not fresh:
+            self.states = hidden
+        else:
+            self.states = self.write_states(self.states,hidden,idx)
+        preds = step_pred(self.model,outputs)
+        reps = [R_l for R_l in outputs[0] if R_l is not None]
+        return {stream:(preds[i],[R_l[i] for R_l in reps])
+                for i,stream in enumerate(streams)}
+
+    def write_states(self,states,new,idx):
+        # Copy new states into rows idx, allocating states that were None
+        # (LadderNet predictions before any stream was stepped)
+        if new is None:
+            return states
+        if isinstance(new,(list,tuple)):
+            if states is None:
+                states = [None]*len(new)
+            return type(new)(self.write_states(s,n,idx)
+                             for s,n in zip(states,new))
+        if states is None:
+            size = (self.n_slots,) + tuple(new.shape[1:])
+            states = zeros_state(new,size,self.model.memory_format)
+        states.index_copy_(0,idx,new.to(states.dtype))
+        return states
@@ -0,0 +1,5 @@
+# Modules live at the top level of the repo
+import os
+import sys
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
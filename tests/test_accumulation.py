@@ -0,0 +1,31 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from train import parser, get_model, batch_loss
+from custom_losses import get_loss_fn
+from accumulation import split_batch
+
+def gradients(model,X,micro_batch_size,loss_fn,args):
+    # Gradients of one batch accumulated over its micro-batches, as in train
+    model.zero_grad()
+    for X_m,w in split_batch(X,micro_batch_size):
+        output = model(X_m)
+        loss = w*batch_loss(loss_fn,output,X_m,False,args)
+        loss.backward()
+    return [p.grad.clone() for p in model.parameters() if p.grad is not None]
+
+@pytest.mark.parametrize('loss',['E','MSE'])
+def test_micro_batches_match_full_batch(loss):
+    args = parser.parse_args(['--loss',loss])
+    torch.manual_seed(0)
+    model_out = 'error' if loss == 'E' else 'pred'
+    model = get_model(args,model_out,'cpu')
+    loss_fn = get_loss_fn(args.loss,args.layer_lambdas)
+    X = torch.rand(4,3,args.in_channels,16,16)
+    full = gradients(model,X,4,loss_fn,args)
+    for micro_batch_size in [1,2,3]:
+        micro = gradients(model,X,micro_batch_size,loss_fn,args)
+        assert len(micro) == len(full)
+        for g_micro,g_full in zip(micro,full):
+            assert torch.allclose(g_micro,g_full,rtol=1e-4,atol=1e-6)
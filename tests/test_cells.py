@@ -0,0 +1,17 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from train import parser, get_model
+
+@pytest.mark.parametrize('model_type',['PredNet','ConvLSTM'])
+def test_grouped_cells_default_config(model_type):
+    # Default channels aren't all divisible by the default groups: convs use
+    # fewer groups (or none) instead of failing
+    args = parser.parse_args(['--model_type',model_type,
+                              '--R_cell_type','grouped'])
+    model = get_model(args,'pred','cpu')
+    X = torch.rand(2,3,args.in_channels,32,32)
+    preds = model(X)
+    assert preds.shape == (2,2,args.in_channels,32,32)
+    preds.sum().backward()
@@ -0,0 +1,140 @@
+# Tiled inference: run a model on overlapping spatial tiles of large frames
+# and stitch the results, so peak memory is bounded by the tile size
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import torch.nn as nn
+
+from utils import *
+
+def conv_radius(cell):
+    # Largest one-sided 'same' padding of the convs in a cell. Convs within
+    # a cell run in parallel, except for FC cells, where the o gate conv
+    # is applied to C_t after it is computed.
+    radius = 0
+    n_sequential = 1
+    for m in cell.modules():
+        if isinstance(m,nn.Conv2d):
+            k = max(m.kernel_size)
+            d = max(m.dilation)
+            radius = max(radius,(d*(k - 1) + 1) // 2)
+    if getattr(cell,'FC',False):
+        n_sequential = 2 # C_t is computed before the o gate conv
+    return n_sequential*radius
+
+def get_alignment(model):
+    # Tiles start at multiples of the total pooling factor so that pooled
+    # grids of tiles line up with those of the full frame
+    return 2**(getattr(model,'nb_layers',1) - 1)
+
+def get_halo(model,seq_len):
+    """
+    Upper bound on how far (in input pixels) information travels across a
+    frame over seq_len time steps. Each step, every cell of layer l can
+    move information by its conv radius at a scale of 2**l pixels, and
+    pooling/upsampling by up to 2**l more. Tiles with this much halo give
+    the same results as the full frame in their core. The bound grows with
+    seq_len: for 10 KITTI steps with the default PredNet it is about 600
+    pixels, more than the frame, so exact tiles are the full frame and only
+    a smaller (approximate) halo saves memory.
+    """
+    growth = 0
+    nb_layers = getattr(model,'nb_layers',1)
+    for child in model.children():
+        # Layers are in ModuleLists indexed by layer (ConvLSTM has one cell)
+        cells = child if isinstance(child,nn.ModuleList) else [child]
+        for l,cell in enumerate(cells):
+            if cell is not None: # e.g. A_layers[0], R_layers[0] with no_R0
+                growth += conv_radius(cell) * 2**l
+    growth += sum(2**l for l in range(nb_layers)) # pool/upsample
+    halo = seq_len * growth
+    align = get_alignment(model)
+    return -(-halo // align) * align # round up to alignment
+
+def get_tiles(size,tile_size,halo):
+    # (core start, core end, tile start, tile end) along one dim
+    tiles = []
+    for start in range(0,size,tile_size):
+        end = min(start + tile_size,size)
+        tiles.append((start,end,max(start - halo,0),min(end + halo,size)))
+    return tiles
+
+def tiled_forward(model,X,tile_size,halo=None,n_workers=1,device=None,
+                  bf16=False):
+    """
+    Inference with output 'pred' and/or 'rep' on overlapping tiles (models
+    without outputs to select, e.g. ConvLSTM, return 'pred').
+    X: (batch,len,channels,H,W) on any device (e.g. CPU for large frames);
+    each tile is moved to device and results are stitched on X's device.
+    tile_size: size of the core of each tile (multiple of 2**(nb_layers-1))
+    halo: extra context around each core (default: get_halo, exact)
+    n_workers: number of tiles run in parallel (threads)
+    """
+    requested = getattr(model,'output','pred')
+    outputs = get_outputs(requested)
+    msg = "Tiled inference supports output 'pred' and 'rep'"
+    assert outputs <= {'pred','rep'}, msg
+    align = get_alignment(model)
+    msg = "tile_size must be a multiple of %d" % align
+    assert tile_size % align == 0, msg
+    if halo is None:
+        halo = get_halo(model,X.shape[1])
+    halo = -(-halo // align) * align
+    if device is None:
+        device = X.device
+    height,width = X.shape[3],X.shape[4]
+    if tile_size + halo >= max(height,width):
+        print("Warning: tile halo %d covers the whole %dx%d frame, so tiles "
+              "are the full frame and save no memory; use a smaller halo "
+              "(approximate) or a shorter sequence" % (halo,height,width))
+    tiles = [(row,col) for row in get_tiles(height,tile_size,halo)
+                       for col in get_tiles(width,tile_size,halo)]
+
+    def run_tile(tile):
+        # Autocast and no_grad are thread-local: set them in each worker
+        (_,_,y0,y1),(_,_,x0,x1) = tile
+        X_tile = X[:,:,:,y0:y1,x0:x1].to(device)
+        with torch.no_grad():
+            with bf16_autocast(device,bf16):
+                output = model(X_tile)
+        return select_outputs_dict(output,requested)
+
+    if n_workers > 1:
+        with ThreadPoolExecutor(n_workers) as executor:
+            return stitch(tiles,executor.map(run_tile,tiles),X)
+    return stitch(tiles,map(run_tile,tiles),X)
+
+def select_outputs_dict(output,requested):
+    # Model return value as a dict of outputs
+    if isinstance(requested,str):
+        return {requested:output}
+    return output
+
+def get_scale(size,out_size):
+    # Downsampling factor (power of 2) of an output from repeated floor
+    # halving of size (max pooling)
+    scale = 1
+    while size // scale > out_size:
+        scale = 2*scale
+    return scale
+
+def stitch(tiles,tile_outputs,X):
+    # Copy the core of each tile output into full-size outputs. Rep of layer
+    # l is at 1/2**l resolution: tiles are aligned so its core is too.
+    stitched = {}
+    for tile,output in zip(tiles,tile_outputs):
+        (cy0,cy1,y0,y1),(cx0,cx1,x0,_) = tile
+        for name,value in output.items():
+            values = value if name == 'rep' else [value]
+            if name not in stitched:
+                stitched[name] = [None]*len(values)
+            for i,v in enumerate(values):
+                s = get_scale(y1 - y0,v.shape[-2])
+                if stitched[name][i] is None:
+                    size = list(v.shape[:-2]) + [X.shape[3]//s,X.shape[4]//s]
+                    stitched[name][i] = v.new_zeros(size,device=X.device)
+                core = v[...,(cy0 - y0)//s:(cy1 - y0)//s,
+                             (cx0 - x0)//s:(cx1 - x0)//s]
+                stitched[name][i][...,cy0//s:cy1//s,cx0//s:cx1//s] = core
+    return {name:(values if name == 'rep' else values[0])
+            for name,values in stitched.items()}
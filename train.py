@@ -1,12 +1,15 @@
 import os
 import time
+import queue
 import argparse
+import traceback
 import json
 import numpy as np
 
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.multiprocessing as mp
 from torch.utils.data import DataLoader
 
 from data import *
@@ -16,6 +19,9 @@ from Ladder import *
 from StackedConvLSTM import *
 from custom_losses import *
 from utils import *
+from stream_eval import stream_windows
+from resume import *
+from accumulation import *
 
 parser = argparse.ArgumentParser()
 # Training data
@@ -46,9 +52,34 @@ parser.add_argument('--downsample_size',type=int,default=128,
 parser.add_argument('--last_only',type=str2bool,default=False,
                     help='Train on sequences of static (final) images.')
 parser.add_argument('--batch_size', type=int, default=4,
-                    help='Samples per batch')
+                    help='Samples per batch (per optimizer step)')
+parser.add_argument('--micro_batch_size', type=int, default=0,
+                    help='Samples per forward/backward pass: gradients are ' +
+                         'accumulated over the micro-batches of each ' +
+                         'batch. 0: batch_size, or probed with ' +
+                         'memory_budget')
+parser.add_argument('--memory_budget', type=float, default=0.0,
+                    help='GB for training: the largest micro_batch_size ' +
+                         '(up to batch_size) whose forward and backward, ' +
+                         'with weights, gradients and Adam state, fit is ' +
+                         'probed before training. 0: no probe')
 parser.add_argument('--num_iters', type=int, default=75000,
                     help='Number of optimizer steps before stopping')
+parser.add_argument('--tbptt', type=str2bool, default=False,
+                    help='Truncated BPTT: walk consecutive seq_len chunks ' +
+                         'of each KITTI drive, carrying detached states ' +
+                         'between chunks and stepping optimizer per chunk')
+parser.add_argument('--tbptt_run_len', type=int, default=10,
+                    help='Number of consecutive seq_len chunks before ' +
+                         'resetting states when using tbptt')
+parser.add_argument('--eval_stride', type=int, default=None,
+                    help='Start a val/test KITTI window every eval_stride ' +
+                         'images (overlapping windows if < seq_len). ' +
+                         'Default: seq_len')
+parser.add_argument('--stream_eval', type=str2bool, default=False,
+                    help='Checkpoint KITTI by running each drive once as a ' +
+                         'stream and scoring windows on its predictions, ' +
+                         'rather than each window from zero states')
 
 # Models
 parser.add_argument('--model_type', choices=['PredNet','ConvLSTM',
@@ -148,6 +179,47 @@ parser.add_argument('--no_R0', type=str2bool, default=True,
 parser.add_argument('--no_skip0', type=str2bool, default=True,
                     help='Boolean indicating whether not to include' +
                          'skip connection in first layer of LadderNet')
+# Memory and precision options
+parser.add_argument('--bf16', type=str2bool, default=False,
+                    help='Run model forward under bfloat16 autocast ' +
+                         '(losses, SatLU and correlation stay in fp32)')
+parser.add_argument('--grad_checkpoint', type=int, default=0,
+                    help='Recompute activations in backward, checkpointing ' +
+                         'every this many time steps (0 = no checkpointing)')
+parser.add_argument('--memory_format', default='contiguous',
+                    choices=['contiguous','channels_last'],
+                    help='Memory format of conv weights, states and ' +
+                         'activations (PredNet and LadderNet only)')
+parser.add_argument('--fused_gates', type=str2bool, default=False,
+                    help='Compute all ConvLSTM gates with two convs and a ' +
+                         'fused elementwise update that stores fewer ' +
+                         'activations (non-FC cells, not MultiConvLSTM)')
+parser.add_argument('--R_cell_type', default='dense', choices=cell_types,
+                    help='Gate convs of R cells (ConvLSTM cell for ' +
+                         'ConvLSTM): dense, depthwise-separable, grouped, ' +
+                         'or bottleneck (1x1 reduce before k x k conv)')
+parser.add_argument('--R_cell_groups', type=int, default=4,
+                    help='Groups of gate convs with R_cell_type grouped. ' +
+                         'Each conv uses the largest number of groups up ' +
+                         'to this that divides its in and out channels ' +
+                         '(dense when the channels share no factor)')
+parser.add_argument('--R_cell_reduction', type=int, default=4,
+                    help='Channel reduction of the 1x1 conv with ' +
+                         'R_cell_type bottleneck')
+parser.add_argument('--static_input', default='never',
+                    choices=['never','detect','always'],
+                    help='Reuse input-side results (A with send_acts, ' +
+                         'LadderNet encoder, ConvLSTM input convs) when the ' +
+                         'input is bit-identical to the previous step: ' +
+                         'detect checks each step, always assumes it ' +
+                         '(e.g. CCN with last_only). Outputs are ' +
+                         'unchanged. PredNet without send_acts has little ' +
+                         'to reuse (A above layer 0 and the inputs of R ' +
+                         'come from errors, which change every step), so ' +
+                         'it is not faster on static input')
+parser.add_argument('--compile', type=str2bool, default=False,
+                    help='Compile the model with torch.compile ' +
+                         '(first iterations are slower while compiling)')
 
 # Optimization
 parser.add_argument('--loss', default='E',choices=['E','MSE','L1','BCE'])
@@ -162,6 +234,22 @@ parser.add_argument('--layer_lambdas', type=float,
 parser.add_argument('--wd', type=float, default=0.0,
                     help='weight decay')
 
+# Distillation
+parser.add_argument('--distill', default='none',
+                    choices=['none','pred','rep','both'],
+                    help='Also train the model to match the predictions ' +
+                         'and/or last step reps of a frozen teacher')
+parser.add_argument('--teacher_args', default=None,
+                    help='Json file with train.py arguments of the teacher ' +
+                         '(model_type, stack_sizes, etc.; others default)')
+parser.add_argument('--teacher_weights', default=None,
+                    help='Path to saved weights of the teacher')
+parser.add_argument('--distill_pred_weight', type=float, default=1.0,
+                    help='Weight of MSE between student and teacher preds')
+parser.add_argument('--distill_rep_weight', type=float, default=1.0,
+                    help='Weight of MSE between student reps (through 1x1 ' +
+                         'convs) and teacher reps, averaged over layers')
+
 # Output options
 parser.add_argument('--record_E', default=False,
                     help='Record E for each layer')
@@ -175,8 +263,31 @@ parser.add_argument('--checkpoint_path',default=None,
                     help='Path to output saved weights.')
 parser.add_argument('--checkpoint_every', type=int, default=5,
                     help='Epochs before evaluating model and saving weights')
+parser.add_argument('--eval_subset', type=int, default=0,
+                    help='Evaluate checkpoints on a fixed random subset of ' +
+                         'this many sequences of each split, cached in ' +
+                         'memory, with 95%% confidence intervals. 0: full')
+parser.add_argument('--eval_seed', type=int, default=0,
+                    help='Seed of the random eval subsets')
+parser.add_argument('--async_eval', type=str2bool, default=False,
+                    help='Evaluate snapshots of the weights in a background ' +
+                         'process while training continues; results are ' +
+                         'merged into the results file when they arrive')
 parser.add_argument('--record_loss_every', type=int, default=20,
                     help='iters before printing and recording loss')
+parser.add_argument('--state_dir', default=None,
+                    help='Directory of full training states (model, ' +
+                         'optimizer, scheduler, counters, RNG, data order) ' +
+                         'to resume from. Training resumes from the latest ' +
+                         'one, and a final one is written on SIGTERM.')
+parser.add_argument('--save_state_every', type=int, default=1000,
+                    help='Iters between training states (written in the ' +
+                         'background)')
+parser.add_argument('--keep_states', type=int, default=2,
+                    help='Number of most recent training states kept')
+parser.add_argument('--seed', type=int, default=None,
+                    help='Seed of the order of training batches (random ' +
+                         'by default, kept in training states)')
 
 def main(args):
     # CUDA
@@ -184,78 +295,60 @@ def main(args):
     device = torch.device("cuda:0" if use_cuda else "cpu")
 
     # Data
-    if args.dataset == 'KITTI':
-        train_data = KITTI(args.train_data_path,args.train_sources_path,
-                           args.seq_len)
-        val_data = KITTI(args.val_data_path,args.val_sources_path,
-                         args.seq_len)
-        test_data = KITTI(args.test_data_path,args.test_sources_path,
-                          args.seq_len)
-    elif args.dataset == 'CCN':
-        downsample_size = (args.downsample_size,args.downsample_size)
-        train_data = CCN(args.train_data_path,args.seq_len,
-                         downsample_size=downsample_size,
-                         last_only=args.last_only)
-        val_data = CCN(args.val_data_path,args.seq_len,
-                       downsample_size=downsample_size,
-                       last_only=args.last_only)
-        test_data = CCN(args.test_data_path,args.seq_len,
-                        downsample_size=downsample_size,
-                        last_only=args.last_only)
-    train_loader = DataLoader(train_data,args.batch_size,shuffle=True)
-    val_loader = DataLoader(val_data,args.batch_size,shuffle=True)
-    test_loader = DataLoader(test_data,args.batch_size,shuffle=True)
+    train_data,val_data,test_data = get_datasets(args)
+    # Order of each epoch from seed and epoch, to resume mid-epoch
+    if args.seed is None:
+        args.seed = random_seed()
+    if args.tbptt:
+        train_sampler = DriveSampler(train_data,args.batch_size,
+                                     args.tbptt_run_len,seed=args.seed)
+    else:
+        train_sampler = ResumableSampler(train_data,args.batch_size,
+                                         seed=args.seed)
+    train_loader = DataLoader(train_data,batch_sampler=train_sampler)
+    if args.async_eval:
+        # Evaluation of weight snapshots in a background process
+        ctx = mp.get_context('spawn')
+        eval_tasks = ctx.Queue()
+        eval_results = ctx.Queue()
+        eval_process = ctx.Process(target=eval_worker,
+                                   args=(args,device,eval_tasks,eval_results))
+        eval_process.start()
+        snapshots = {} # epoch: weights being evaluated
+    else:
+        eval_loaders = get_eval_loaders(args,train_data,val_data,test_data)
 
     # Model
     model_out = 'error' if args.loss == 'E' else 'pred'
-    if args.model_type == 'PredNet':
-        model = PredNet(args.in_channels,args.stack_sizes,args.R_stack_sizes,
-                        args.A_kernel_sizes,args.Ahat_kernel_sizes,
-                        args.R_kernel_sizes,args.use_satlu,args.pixel_max,
-                        args.Ahat_act,args.satlu_act,args.error_act,
-                        args.LSTM_act,args.LSTM_c_act,args.bias,
-                        args.use_1x1_out,args.FC,args.dropout_p,
-                        args.send_acts,args.no_ER,args.RAhat,args.no_A_conv,
-                        args.higher_satlu,args.local_grad,args.conv_dilation,
-                        args.use_BN,model_out,device)
-    elif args.model_type == 'MultiConvLSTM':
-        model = MultiConvLSTM(args.in_channels,args.R_stack_sizes,
-                              args.R_kernel_sizes,args.use_satlu,args.pixel_max,
-                              args.Ahat_act,args.satlu_act,args.error_act,
-                              args.LSTM_act,args.LSTM_c_act,args.bias,
-                              args.use_1x1_out,args.FC,args.local_grad,
-                              model_out,device)
-    elif args.model_type == 'ConvLSTM':
-        model = ConvLSTM(args.in_channels,args.hidden_channels,args.kernel_size,
-                         args.LSTM_act,args.LSTM_c_act,args.out_act,
-                         args.bias,args.FC,device)
-    elif args.model_type == 'LadderNet':
-        model = LadderNet(args.in_channels,args.stack_sizes,args.R_stack_sizes,
-                          args.A_kernel_sizes,args.Ahat_kernel_sizes,
-                          args.R_kernel_sizes,args.conv_dilation,args.use_BN,
-                          args.use_satlu,args.pixel_max,args.A_act,
-                          args.Ahat_act,args.satlu_act,args.error_act,
-                          args.LSTM_act,args.LSTM_c_act,args.bias,
-                          args.use_1x1_out,args.FC,args.no_R0,args.no_skip0,
-                          args.no_A_conv,args.higher_satlu,args.local_grad,
-                          model_out,device)
-    elif args.model_type == 'StackedConvLSTM':
-        model = StackedConvLSTM(args.in_channels,args.R_stack_sizes,
-                                args.R_kernel_sizes,args.use_1x1_out,
-                                args.FC,args.local_grad,args.forward_conv,
-                                model_out,device)
+    model = get_model(args,model_out,device)
     print(model)
     if args.load_weights_from is not None:
         model.load_state_dict(torch.load(args.load_weights_from))
     model.to(device)
     model.train()
+    micro_batch_size = get_micro_batch_size(model,train_data,device,args)
+    print("Batch size %d in micro-batches of %d" % (args.batch_size,
+                                                    micro_batch_size))
+    if args.compile:
+        model = compile_model(model)
 
     # Select loss function
     loss_fn = get_loss_fn(args.loss,args.layer_lambdas)
     loss_fn = loss_fn.to(device)
 
+    # Distillation: frozen teacher, and loss with adapters trained along
+    # with the model
+    distill_outputs = get_distill_outputs(args.distill)
+    if distill_outputs:
+        teacher = get_teacher(args,distill_outputs,device)
+        X_0 = train_data[0].unsqueeze(0).to(device)
+        distill_fn = get_distill_fn(model,teacher,X_0,args)
+        distill_fn = distill_fn.to(device)
+
     # Optimizer
-    params = model.parameters()
+    params = list(model.parameters())
+    if distill_outputs:
+        params += list(distill_fn.parameters())
     optimizer = optim.Adam(params, lr=args.learning_rate,weight_decay=args.wd)
     lrs_step_size = args.num_iters // (args.lr_steps+1)
     scheduler = optim.lr_scheduler.StepLR(optimizer,step_size=lrs_step_size,
@@ -265,136 +358,485 @@ def main(args):
     ave_time = 0.0
     loss_data = [] # records loss every args.record_loss_every iters
     corr_data = [] # records correlation every args.record_loss_every iters
-    train_losses = [] # records mean training loss every checkpoint
-    train_corrs = [] # records mean training  correlation every checkpoint
-    val_losses = [] # records mean validation loss every checkpoint
-    val_corrs = [] # records mean validation correlation every checkpoint
-    test_losses = [] # records mean test loss every checkpoint
-    test_corrs = [] # records mean test correlation every checkpoint
     best_val_loss = float("inf") # will only save best weights
+    stats = {'loss_data':loss_data,
+             'corr_data':corr_data}
     if args.record_E:
         E_data = {'layer%d' % i:[] for i in range(model.nb_layers)}
-        train_Es = {'layer%d' % i:[] for i in range(model.nb_layers)}
-        val_Es = {'layer%d' % i:[] for i in range(model.nb_layers)}
-        test_Es = {'layer%d' % i:[] for i in range(model.nb_layers)}
-    # Training loop
+        stats['E_data'] = E_data
+    stats.update(new_eval_stats(model,args)) # train, val, test checkpoints
+
+    # Resume from the latest training state
     iter = 0
     epoch_count = 0
+    start_batch = 0 # batches of the first epoch already done
+    hidden = None
+    module = getattr(model,'_orig_mod',model) # if compiled
+    if args.state_dir is not None:
+        writer = CheckpointWriter(args.state_dir,args.keep_states)
+        stop = StopRequest()
+        state = load_state(args.state_dir)
+        if state is not None:
+            module.load_state_dict(state['model'])
+            optimizer.load_state_dict(state['optimizer'])
+            scheduler.load_state_dict(state['scheduler'])
+            if distill_outputs:
+                distill_fn.load_state_dict(state['distill'])
+            iter = state['iter']
+            epoch_count = state['epoch'] - 1 # epoch in progress
+            start_batch = state['batch']
+            hidden = to_device(state['hidden'],device)
+            args.seed = state['seed']
+            train_sampler.seed = args.seed
+            ave_time = state['ave_time']
+            best_val_loss = state['best_val_loss']
+            stats = state['stats']
+            loss_data = stats['loss_data']
+            corr_data = stats['corr_data']
+            if args.record_E:
+                E_data = stats['E_data']
+            set_rng_state(state['rng'])
+
+    # Training loop
     while iter < args.num_iters:
         epoch_count += 1
+        train_sampler.set_epoch(epoch_count,start_batch)
+        batch_count = start_batch # batches seen this epoch
+        chunk_count = start_batch # chunks seen this epoch (tbptt)
+        if start_batch == 0:
+            hidden = None
+        start_batch = 0
         for X in train_loader:
             iter += 1
+            batch_count += 1
             optimizer.zero_grad()
             # Forward
             start_t = time.time()
-            X = X.to(device)
-            output = model(X)
-            # Compute loss
-            if args.loss == 'E':
-                loss = loss_fn(output)
-            else:
-                X_no_t0 = X[:,1:,:,:,:]
-                loss = loss_fn(output,X_no_t0)
-            # Backward pass
-            loss.backward()
+            # Predictions for recording correlation and outputs matched to
+            # the teacher come from the same pass
+            record = iter % args.record_loss_every == 0
+            model_output = model.output
+            extra_outputs = []
+            if record and args.record_corr and args.loss == 'E':
+                extra_outputs.append('pred')
+            extra_outputs += [out for out in distill_outputs
+                              if out not in extra_outputs + [model_output]]
+            if extra_outputs:
+                model.output = tuple([model_output] + extra_outputs)
+            if args.tbptt:
+                # Reset states at the start of each run of consecutive chunks
+                if chunk_count % args.tbptt_run_len == 0:
+                    hidden = None
+                chunk_count += 1
+            continued = args.tbptt and hidden is not None
+            # Gradients accumulated over the micro-batches of the batch, with
+            # mean losses weighted by each micro-batch's share of the batch
+            micro_batches = split_batch(X,micro_batch_size)
+            if args.tbptt:
+                hiddens = split_hidden(hidden,len(micro_batches),
+                                       micro_batch_size)
+                new_hiddens = []
+            loss_sum = 0.0
+            E_means = 0.0
+            corr = 0.0
+            for m,(X_m,w) in enumerate(micro_batches):
+                X_m = X_m.to(device)
+                if args.tbptt:
+                    with bf16_autocast(device,args.bf16):
+                        output,hidden_m = model(X_m,hiddens[m],
+                                                return_hidden=True)
+                    new_hiddens.append(detach_hidden(hidden_m)) # truncate
+                else:
+                    with bf16_autocast(device,args.bf16):
+                        output = model(X_m)
+                if extra_outputs:
+                    outputs = output
+                    output = outputs[model_output]
+                else:
+                    outputs = {model_output:output}
+                preds = outputs.get('pred')
+                # Compute loss (in fp32)
+                loss = w*batch_loss(loss_fn,output,X_m,continued,args)
+                if distill_outputs:
+                    with torch.no_grad():
+                        with bf16_autocast(device,args.bf16):
+                            teacher_outputs = teacher(X_m)
+                    loss = loss + w*distill_fn(outputs,teacher_outputs)
+                # Backward pass
+                loss.backward()
+                loss_sum += loss.detach()
+                if record and args.record_E:
+                    E_means = E_means + w*torch.mean(output.detach(),dim=0)
+                if record and args.record_corr:
+                    target = X_m if continued else X_m[:,1:,:,:,:]
+                    corr = corr + w*correlation(preds.detach(),target)
+            if extra_outputs:
+                model.output = model_output
+            if args.tbptt:
+                hidden = cat_hidden(new_hiddens)
             optimizer.step()
             scheduler.step()
             # Record loss
             iter_time = time.time() - start_t
             ave_time = (ave_time*(iter-1) + iter_time)/iter
-            if iter % args.record_loss_every == 0:
-                loss_datapoint = loss.data.item()
+            if record:
+                loss_datapoint = loss_sum.item()
                 print('Epoch:', epoch_count,
                       'Iter:', iter,
+                      'Samples:', iter*args.batch_size,
                       'Loss:', loss_datapoint,
                       'lr:', scheduler.get_lr(),
                       'ave time: ', ave_time)
                 loss_data.append(loss_datapoint)
                 if args.record_E:
-                    E_means = torch.mean(output.detach(),dim=0)
                     for l in range(model.nb_layers):
                         E_datapoint = E_means[l].data.item()
                         E_data['layer%d' % l].append(E_datapoint)
                 if args.record_corr:
-                    model_output = model.output
-                    model.output = 'pred'
-                    output = model(X)
-                    X_no_t0 = X[:,1:,:,:,:]
-                    corr = correlation(output,X_no_t0)
                     corr_data.append(corr.data.item())
-                    model.output = model_output
+            # Merge results of background evaluations that have arrived
+            if args.async_eval:
+                arrived = get_eval_results(eval_results)
+                best_val_loss = merge_eval(arrived,snapshots,stats,
+                                           best_val_loss,args)
+            # Training state (in the background), and a final one if asked
+            # to stop
+            if args.state_dir is not None:
+                if iter % args.save_state_every == 0 or stop.requested:
+                    state = {'model':module.state_dict(),
+                             'optimizer':optimizer.state_dict(),
+                             'scheduler':scheduler.state_dict(),
+                             'iter':iter,
+                             'epoch':epoch_count,
+                             'batch':batch_count,
+                             'hidden':hidden if args.tbptt else None,
+                             'ave_time':ave_time,
+                             'best_val_loss':best_val_loss,
+                             'stats':stats,
+                             'seed':args.seed,
+                             'rng':get_rng_state()}
+                    if distill_outputs:
+                        state['distill'] = distill_fn.state_dict()
+                    writer.save(state,iter)
+                if stop.requested:
+                    writer.close()
+                    if args.async_eval:
+                        eval_process.terminate()
+                    print("Saved training state at iter %d, stopping" % iter)
+                    return
             if iter >= args.num_iters:
                 break
-        # Checkpoint
+        # Checkpoint: evaluate now, or send a snapshot of the weights to
+        # the background process
         last_epoch = (iter >= args.num_iters)
         if epoch_count % args.checkpoint_every == 0 or last_epoch:
-            # Train
-            print("Checking training loss...")
-            train_checkpoint = checkpoint(train_loader,model,device,args)
-            if args.record_E:
-                train_loss,train_corr,train_E = train_checkpoint
-                for l in range(model.nb_layers):
-                    train_Es['layer%d' % l].append(train_E[l])
-            else:
-                train_loss,train_corr = train_checkpoint
-            print("Training loss is ", train_loss)
-            print("Training average correlation is ", train_corr)
-            train_losses.append(train_loss)
-            train_corrs.append(train_corr)
-            # Validation
-            print("Checking validation loss...")
-            val_checkpoint = checkpoint(val_loader,model,device,args)
-            if args.record_E:
-                val_loss,val_corr,val_E = val_checkpoint
-                for l in range(model.nb_layers):
-                    val_Es['layer%d' % l].append(val_E[l])
+            if args.async_eval:
+                module = getattr(model,'_orig_mod',model) # if compiled
+                snapshot = {name:value.detach().cpu().clone() for name,value
+                            in module.state_dict().items()}
+                snapshots[epoch_count] = snapshot
+                eval_tasks.put((epoch_count,snapshot))
             else:
-                val_loss,val_corr = val_checkpoint
-            print("Validation loss is ", val_loss)
-            print("Validation average correlation is ",val_corr)
-            val_losses.append(val_loss)
-            val_corrs.append(val_corr)
-            # Test
-            print("Checking test loss...")
-            test_checkpoint = checkpoint(test_loader,model,device,args)
-            if args.record_E:
-                test_loss,test_corr,test_E = test_checkpoint
-                for l in range(model.nb_layers):
-                    test_Es['layer%d' % l].append(test_E[l])
-            else:
-                test_loss,test_corr = test_checkpoint
-            print("Test loss is ", test_loss)
-            print("Test average correlation is ", test_corr)
-            test_losses.append(test_loss)
-            test_corrs.append(test_corr)
-            # Write stats file
-            if not os.path.isdir(args.results_dir):
-                os.mkdir(args.results_dir)
-            stats = {'loss_data':loss_data,
-                     'corr_data':corr_data,
-                     'train_mse_losses':train_losses,
-                     'train_corrs':train_corrs,
-                     'val_mse_losses':val_losses,
-                     'val_corrs':val_corrs,
-                     'test_mse_losses':test_losses,
-                     'test_corrs':test_corrs}
+                results = run_checkpoint(eval_loaders,model,device,args)
+                snapshots = {epoch_count:model.state_dict()}
+                best_val_loss = merge_eval([(epoch_count,results)],snapshots,
+                                           stats,best_val_loss,args)
+    # Wait for the remaining background evaluations
+    if args.async_eval:
+        eval_tasks.put(None)
+        arrived = wait_eval_results(eval_results,eval_process,len(snapshots))
+        best_val_loss = merge_eval(arrived,snapshots,stats,best_val_loss,args)
+        eval_process.join()
+    if args.state_dir is not None:
+        writer.close() # last training state on disk
+
+
+def get_datasets(args):
+    if args.dataset == 'KITTI':
+        train_data = KITTI(args.train_data_path,args.train_sources_path,
+                           args.seq_len)
+        val_data = KITTI(args.val_data_path,args.val_sources_path,
+                         args.seq_len,stride=args.eval_stride)
+        test_data = KITTI(args.test_data_path,args.test_sources_path,
+                          args.seq_len,stride=args.eval_stride)
+    elif args.dataset == 'CCN':
+        downsample_size = (args.downsample_size,args.downsample_size)
+        train_data = CCN(args.train_data_path,args.seq_len,
+                         downsample_size=downsample_size,
+                         last_only=args.last_only)
+        val_data = CCN(args.val_data_path,args.seq_len,
+                       downsample_size=downsample_size,
+                       last_only=args.last_only)
+        test_data = CCN(args.test_data_path,args.seq_len,
+                        downsample_size=downsample_size,
+                        last_only=args.last_only)
+    return train_data,val_data,test_data
+
+def get_eval_loaders(args,train_data,val_data,test_data):
+    # Loaders of each split for checkpoints: full datasets, or fixed random
+    # subsets of eval_subset sequences loaded once and kept in memory
+    loaders = []
+    for split,data in [('train',train_data),('val',val_data),
+                       ('test',test_data)]:
+        if args.eval_subset > 0:
+            data = CachedSubset(data,args.eval_subset,args.eval_seed)
+        loaders.append((split,DataLoader(data,args.batch_size,shuffle=False)))
+    return loaders
+
+def run_checkpoint(loaders,model,device,args):
+    # Checkpoint results of each split
+    results = []
+    for split,loader in loaders:
+        print("Checking %s loss..." % split)
+        results.append((split,checkpoint(loader,model,device,args)))
+    return results
+
+def eval_worker(args,device,tasks,results):
+    # Background process: checkpoints of weight snapshots, until None. A
+    # failed checkpoint is sent back as (epoch, traceback) so that no epoch
+    # is left without an answer.
+    try:
+        train_data,val_data,test_data = get_datasets(args)
+        loaders = get_eval_loaders(args,train_data,val_data,test_data)
+        model_out = 'error' if args.loss == 'E' else 'pred'
+        model = get_model(args,model_out,device)
+        model.to(device)
+        setup_error = None
+    except Exception:
+        setup_error = traceback.format_exc()
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        epoch,state_dict = task
+        if setup_error is not None:
+            results.put((epoch,setup_error))
+            continue
+        try:
+            model.load_state_dict(state_dict)
+            results.put((epoch,run_checkpoint(loaders,model,device,args)))
+        except Exception:
+            results.put((epoch,traceback.format_exc()))
+
+def get_eval_results(results):
+    # Results of background evaluations that have arrived (non-blocking)
+    arrived = []
+    while True:
+        try:
+            arrived.append(results.get_nowait())
+        except queue.Empty:
+            return arrived
+
+def wait_eval_results(results,process,n,timeout=10.0):
+    # The n remaining results, unless the background process exits without
+    # sending them: then those that arrived, and the failure is reported
+    arrived = []
+    while len(arrived) < n:
+        try:
+            arrived.append(results.get(timeout=timeout))
+        except queue.Empty:
+            if not process.is_alive():
+                print("Background evaluation exited (code %s) with %d of "
+                      "%d checkpoints missing" % (process.exitcode,
+                                                  n - len(arrived),n))
+                break
+    return arrived
+
+def new_eval_stats(model,args):
+    # Checkpoint results of each split (with 95% confidence intervals on
+    # subsets), and the epoch of each checkpoint
+    stats = {'eval_epochs':[]}
+    for split in ['train','val','test']:
+        stats['%s_mse_losses' % split] = []
+        stats['%s_corrs' % split] = []
+        if args.eval_subset > 0:
+            stats['%s_mse_cis' % split] = []
+            stats['%s_corr_cis' % split] = []
+        if args.record_E:
+            stats['%s_Es' % split] = {'layer%d' % i:[]
+                                      for i in range(model.nb_layers)}
+    return stats
+
+def merge_eval(arrived,snapshots,stats,best_val_loss,args):
+    """
+    Add checkpoint results (epoch, results of each split) to stats, save
+    the weights of the epoch (from snapshots) if the val loss is the best so
+    far, and write the results file. Failed checkpoints (epoch, traceback)
+    are reported and skipped. Returns the best val loss.
+    """
+    for epoch,results in sorted(arrived,key=lambda r: r[0]):
+        if isinstance(results,str):
+            print("Checkpoint of epoch %d failed:\n%s" % (epoch,results))
+            snapshots.pop(epoch)
+            continue
+        stats['eval_epochs'].append(epoch)
+        for split,result in results:
+            stats['%s_mse_losses' % split].append(result['mse'])
+            stats['%s_corrs' % split].append(result['corr'])
+            if args.eval_subset > 0:
+                stats['%s_mse_cis' % split].append(result['mse_ci'])
+                stats['%s_corr_cis' % split].append(result['corr_ci'])
             if args.record_E:
-                stats['E_data'] = E_data
-                stats['train_Es'] = train_Es
-                stats['val_Es'] = val_Es
-                stats['test_Es'] = test_Es
-            results_file_name = '%s/%s' % (args.results_dir,args.out_data_file)
-            with open(results_file_name, 'w') as f:
-                json.dump(stats, f)
-            # Save model weights
-            if val_loss < best_val_loss: # use val (not test) to decide to save
-                best_val_loss = val_loss
-                if args.checkpoint_path is not None:
-                    torch.save(model.state_dict(),
-                               args.checkpoint_path)
+                for l,E_l in enumerate(result['E']):
+                    stats['%s_Es' % split]['layer%d' % l].append(E_l)
+            print("Epoch %d %s loss is " % (epoch,split),result['mse'])
+            print("Epoch %d %s average correlation is " % (epoch,split),
+                  result['corr'])
+        val_loss = dict(results)['val']['mse']
+        state_dict = snapshots.pop(epoch)
+        if val_loss < best_val_loss: # use val (not test) to decide to save
+            best_val_loss = val_loss
+            if args.checkpoint_path is not None:
+                torch.save(state_dict,args.checkpoint_path)
+    if arrived:
+        if not os.path.isdir(args.results_dir):
+            os.mkdir(args.results_dir)
+        results_file_name = '%s/%s' % (args.results_dir,args.out_data_file)
+        with open(results_file_name, 'w') as f:
+            json.dump(stats, f)
+    return best_val_loss
+
+def batch_loss(loss_fn,output,X,continued,args):
+    # Loss of a batch (mean over the batch, in fp32): errors with loss E, or
+    # predictions against their frames (the first one too if continued, as
+    # it is predicted from carried-over states)
+    if args.loss == 'E':
+        return loss_fn(output)
+    elif continued:
+        return loss_fn(output.float(),X)
+    return loss_fn(output.float(),X[:,1:,:,:,:])
+
+def get_micro_batch_size(model,train_data,device,args):
+    # micro_batch_size, or the largest that fits memory_budget (probed with
+    # the model's forward and backward on training sequences)
+    if args.micro_batch_size > 0:
+        return min(args.micro_batch_size,args.batch_size)
+    if args.memory_budget <= 0:
+        return args.batch_size
+    loss_fn = get_loss_fn(args.loss,args.layer_lambdas).to(device)
+    def run(X):
+        with bf16_autocast(device,args.bf16):
+            output = model(X)
+        batch_loss(loss_fn,output,X,False,args).backward()
+    def get_batch(b):
+        n = len(train_data)
+        return torch.stack([train_data[i % n] for i in range(b)]).to(device)
+    params = [p for p in model.parameters() if p.requires_grad]
+    adam_bytes = 2*tensor_bytes(params) # exp_avg and exp_avg_sq
+    budget = args.memory_budget * 2**30
+    return probe_micro_batch(model,run,get_batch,budget,args.batch_size,
+                             device,adam_bytes)
+
+def get_model(args,model_out,device):
+    if args.model_type == 'PredNet':
+        model = PredNet(args.in_channels,args.stack_sizes,args.R_stack_sizes,
+                        args.A_kernel_sizes,args.Ahat_kernel_sizes,
+                        args.R_kernel_sizes,args.use_satlu,args.pixel_max,
+                        args.Ahat_act,args.satlu_act,args.error_act,
+                        args.LSTM_act,args.LSTM_c_act,args.bias,
+                        args.use_1x1_out,args.FC,args.dropout_p,
+                        args.send_acts,args.no_ER,args.RAhat,args.no_A_conv,
+                        args.higher_satlu,args.local_grad,args.conv_dilation,
+                        args.use_BN,model_out,device,
+                        grad_checkpoint=args.grad_checkpoint,
+                        memory_format=args.memory_format,
+                        fused_gates=args.fused_gates,
+                        static_input=args.static_input,
+                        R_cell_type=args.R_cell_type,
+                        R_cell_groups=args.R_cell_groups,
+                        R_cell_reduction=args.R_cell_reduction)
+    elif args.model_type == 'MultiConvLSTM':
+        model = MultiConvLSTM(args.in_channels,args.R_stack_sizes,
+                              args.R_kernel_sizes,args.use_satlu,args.pixel_max,
+                              args.Ahat_act,args.satlu_act,args.error_act,
+                              args.LSTM_act,args.LSTM_c_act,args.bias,
+                              args.use_1x1_out,args.FC,args.local_grad,
+                              model_out,device)
+    elif args.model_type == 'ConvLSTM':
+        model = ConvLSTM(args.in_channels,args.hidden_channels,args.kernel_size,
+                         args.LSTM_act,args.LSTM_c_act,args.out_act,
+                         args.bias,args.FC,device,
+                         fused_gates=args.fused_gates,
+                         static_input=args.static_input,
+                         R_cell_type=args.R_cell_type,
+                         R_cell_groups=args.R_cell_groups,
+                         R_cell_reduction=args.R_cell_reduction)
+    elif args.model_type == 'LadderNet':
+        model = LadderNet(args.in_channels,args.stack_sizes,args.R_stack_sizes,
+                          args.A_kernel_sizes,args.Ahat_kernel_sizes,
+                          args.R_kernel_sizes,args.conv_dilation,args.use_BN,
+                          args.use_satlu,args.pixel_max,args.A_act,
+                          args.Ahat_act,args.satlu_act,args.error_act,
+                          args.LSTM_act,args.LSTM_c_act,args.bias,
+                          args.use_1x1_out,args.FC,args.no_R0,args.no_skip0,
+                          args.no_A_conv,args.higher_satlu,args.local_grad,
+                          model_out,device,
+                          grad_checkpoint=args.grad_checkpoint,
+                          memory_format=args.memory_format,
+                          fused_gates=args.fused_gates,
+                          static_input=args.static_input,
+                          R_cell_type=args.R_cell_type,
+                          R_cell_groups=args.R_cell_groups,
+                          R_cell_reduction=args.R_cell_reduction)
+    elif args.model_type == 'StackedConvLSTM':
+        model = StackedConvLSTM(args.in_channels,args.R_stack_sizes,
+                                args.R_kernel_sizes,args.use_1x1_out,
+                                args.FC,args.local_grad,args.forward_conv,
+                                model_out,device,
+                                fused_gates=args.fused_gates)
+    return model
+
+def get_distill_outputs(distill):
+    # Teacher outputs matched in distillation
+    if distill == 'none':
+        return []
+    elif distill == 'both':
+        return ['pred','rep']
+    return [distill]
 
+def get_teacher(args,distill_outputs,device):
+    # Teacher built from train.py defaults updated with args.teacher_args
+    teacher_args = parser.parse_args([])
+    with open(args.teacher_args,'r') as f:
+        vars(teacher_args).update(json.load(f))
+    teacher = get_model(teacher_args,tuple(distill_outputs),device)
+    teacher.load_state_dict(torch.load(args.teacher_weights,
+                                       map_location=device))
+    teacher.to(device)
+    teacher.eval()
+    for param in teacher.parameters():
+        param.requires_grad = False
+    return teacher
+
+def get_distill_fn(model,teacher,X,args):
+    # Rep channels of each layer of student and teacher, from a short input
+    student_channels = []
+    teacher_channels = []
+    if args.distill in ['rep','both']:
+        model_output = model.output
+        model.output = 'rep'
+        with torch.no_grad():
+            student_channels = [rep.shape[1] for rep in model(X[:,:2])]
+            teacher_channels = [rep.shape[1]
+                                for rep in teacher(X[:,:2])['rep']]
+        model.output = model_output
+    pred_weight = args.distill_pred_weight
+    if args.distill not in ['pred','both']:
+        pred_weight = 0.0
+    rep_weight = args.distill_rep_weight
+    if args.distill not in ['rep','both']:
+        rep_weight = 0.0
+    return DistillLoss(student_channels,teacher_channels,pred_weight,
+                       rep_weight)
 
 def correlation(X,Y):
+    # Mean over the batch of the correlation of each sequence
+    return torch.mean(correlations(X,Y),dim=0)
+
+def correlations(X,Y):
+    # Correlation of each sequence in the batch. Always computed in fp32
+    X = X.float()
+    Y = Y.float()
     batch_size = X.shape[0]
     X = X.view(batch_size,-1)
     Y = Y.view(batch_size,-1)
@@ -407,15 +849,31 @@ def correlation(X,Y):
     X_n = X_c/X_norm
     Y_n = Y_c/Y_norm
     corr = torch.sum(X_n*Y_n,dim=1)
-    ave_corr = torch.mean(corr,dim=0)
-    return ave_corr
+    return corr
+
+def summarize(values,name):
+    # Mean of per-sequence values, and half-width of its 95% confidence
+    # interval (normal approximation)
+    values = np.array(values)
+    summary = {name:float(np.mean(values))}
+    if len(values) > 1:
+        sem = np.std(values,ddof=1) / np.sqrt(len(values))
+        summary[name + '_ci'] = float(1.96 * sem)
+    else:
+        summary[name + '_ci'] = None
+    return summary
 
 def checkpoint(dataloader, model, device, args):
-    # Always use MSE loss for checkpointing:
-    mse_loss = nn.MSELoss()
+    # Mean MSE (always used for checkpointing) and correlation over
+    # sequences, with confidence intervals, and mean E if record_E
+    if args.stream_eval:
+        return stream_checkpoint(dataloader.dataset,model,device,args)
     model.eval()
     model_output = model.output # Save model output type to undo after done
-    model.output = 'pred' # model output is pred for mse loss
+    if args.record_E:
+        model.output = ('pred','error') # errors from the same forward pass
+    else:
+        model.output = 'pred' # model output is pred for mse loss
     with torch.no_grad():
         losses = []
         corrs = []
@@ -424,32 +882,52 @@ def checkpoint(dataloader, model, device, args):
         for X in dataloader:
             # Forward
             X = X.to(device)
-            output = model(X)
-            # Compute loss
+            with bf16_autocast(device,args.bf16):
+                output = model(X)
+            if args.record_E:
+                errors = output['error']
+                output = output['pred']
+            output = output.float()
+            # Compute loss of each sequence
             X_no_t0 = X[:,1:,:,:,:]
-            loss = mse_loss(output,X_no_t0)
-            corr = correlation(output,X_no_t0)
+            loss = torch.mean((output - X_no_t0)**2,dim=(1,2,3,4))
+            corr = correlations(output,X_no_t0)
             # Record loss
-            loss_datapoint = loss.data.item()
-            corr_datapoint = corr.data.item()
-            losses.append(loss_datapoint)
-            corrs.append(corr_datapoint)
+            losses += loss.tolist()
+            corrs += corr.tolist()
             # record E
             if args.record_E:
-                model.output = 'error'
-                errors = model(X)
                 E_means = torch.mean(errors.detach(),dim=0)
                 for l in range(model.nb_layers):
                     Es[l].append(E_means[l].data.item())
-                model.output = 'pred'
 
     model.train()
     model.output = model_output # Undo model output change to resume training
+    results = summarize(losses,'mse')
+    results.update(summarize(corrs,'corr'))
     if args.record_E:
-        mean_Es = [np.mean(Es[l]) for l in range(model.nb_layers)]
-        return np.mean(losses),np.mean(corrs),mean_Es
-    else:
-        return np.mean(losses),np.mean(corrs)
+        results['E'] = [np.mean(Es[l]) for l in range(model.nb_layers)]
+    return results
+
+def stream_checkpoint(dataset, model, device, args):
+    # MSE and correlation of each window from predictions of one stream per
+    # drive (frames shared by overlapping windows are only run once)
+    model.eval()
+    model_output = model.output
+    model.output = 'pred'
+    losses = []
+    corrs = []
+    with torch.no_grad():
+        for i,X,preds in stream_windows(model,dataset,device,args.bf16):
+            preds = preds.unsqueeze(0)
+            X_no_t0 = X[1:].unsqueeze(0).to(device)
+            losses.append(nn.functional.mse_loss(preds,X_no_t0).item())
+            corrs.append(correlation(preds,X_no_t0).item())
+    model.train()
+    model.output = model_output
+    results = summarize(losses,'mse')
+    results.update(summarize(corrs,'corr'))
+    return results
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -462,6 +940,36 @@ if __name__ == '__main__':
         model_has_E = args.model_type in ['PredNet','MultiConvLSTM',
                                           'LadderNet','StackedConvLSTM']
         assert model_has_E and args.loss == 'E', msg
+    if args.tbptt:
+        msg = "Truncated BPTT requires KITTI with PredNet or LadderNet"
+        model_has_state = args.model_type in ['PredNet','LadderNet']
+        assert model_has_state and args.dataset == 'KITTI', msg
+    if args.stream_eval:
+        msg = "Streamed evaluation requires KITTI with PredNet or LadderNet"
+        model_has_state = args.model_type in ['PredNet','LadderNet']
+        assert model_has_state and args.dataset == 'KITTI', msg
+        msg = "Streamed evaluation doesn't record E"
+        assert not args.record_E, msg
+    if args.eval_subset > 0:
+        msg = "Eval subsets can't be used with stream_eval"
+        assert not args.stream_eval, msg
+    if args.memory_format != 'contiguous':
+        msg = "memory_format is only available for PredNet and LadderNet"
+        assert args.model_type in ['PredNet','LadderNet'], msg
+    if args.distill != 'none':
+        msg = "Distillation needs teacher_args and teacher_weights"
+        assert args.teacher_args is not None, msg
+        assert args.teacher_weights is not None, msg
+        msg = "Distillation is not available with tbptt"
+        assert not args.tbptt, msg
+    if args.distill in ['rep','both']:
+        msg = "ConvLSTM has no reps to distill"
+        assert args.model_type != 'ConvLSTM', msg
+    if args.R_cell_type != 'dense':
+        msg = "R_cell_type is available for PredNet, LadderNet and ConvLSTM"
+        assert args.model_type in ['PredNet','LadderNet','ConvLSTM'], msg
+        msg = "fused_gates needs dense gate convs"
+        assert not args.fused_gates, msg
     if args.model_type in ['PredNet','LadderNet']:
         if args.local_grad and not args.no_A_conv:
             print("WARNING: TRAINING WITH LOCAL GRADIENTS DOES NOT MAKE SENSE "
@@ -1,7 +1,19 @@
-import numpy as np
+import copy
+import math
+import argparse
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from activations import Hardsigmoid, SatLU
 
+def child_parser(parent):
+    # Parser with all options of parent (e.g. train.py's) that a script can
+    # extend or redefine. Parents share their actions with child parsers, and
+    # conflict_handler='resolve' edits them in place, so the parent is copied
+    # first to leave it unchanged.
+    return argparse.ArgumentParser(parents=[copy.deepcopy(parent)],
+                                   conflict_handler='resolve')
+
 def str2bool(v):
     if v.lower() in ('yes', 'true', 't', 'y', '1'):
         return True
@@ -30,11 +42,166 @@ def get_pad_same(in_height,in_width,kernel_size,dilation=1):
     elif isinstance(kernel_size,tuple):
         k_height = kernel_size[0]
         k_width = kernel_size[1]
-    # Padding so that conv2d gives same dimensions
-    pad_width = dilation*(k_width - 1) / 2 # stride = 1
-    pad_height = dilation*(k_height - 1) / 2 # stride = 1
-    left_pad = int(np.floor(pad_width))
-    right_pad = int(np.ceil(pad_width))
-    top_pad = int(np.floor(pad_height))
-    bottom_pad = int(np.floor(pad_height))
+    # Padding so that conv2d gives same dimensions (integer math only, so
+    # this can be traced without graph breaks)
+    pad_width = dilation*(k_width - 1) # total padding, stride = 1
+    pad_height = dilation*(k_height - 1) # total padding, stride = 1
+    left_pad = pad_width // 2
+    right_pad = pad_width - left_pad
+    top_pad = pad_height // 2
+    bottom_pad = pad_height // 2
     return (left_pad, right_pad, top_pad, bottom_pad)
+
+def get_conv_pad(kernel_size,dilation=1):
+    # 'Same' padding as (padding for the conv, padding for F.pad). Symmetric
+    # padding (odd kernel sizes) is done by the conv itself, which avoids a
+    # padded copy of every input and keeps its memory format. Otherwise the
+    # conv has no padding and inputs are padded with F.pad.
+    padding = get_pad_same(None,None,kernel_size,dilation)
+    left_pad, right_pad, top_pad, bottom_pad = padding
+    if left_pad == right_pad and top_pad == bottom_pad:
+        return (top_pad,left_pad), None
+    return 0, padding
+
+# Convs used for the gates of ConvLSTM cells
+cell_types = ['dense','depthwise','grouped','bottleneck']
+
+def gate_conv(in_channels,out_channels,kernel_size,padding,bias,
+              cell_type='dense',groups=4,reduction=4):
+    """
+    k x k conv for a ConvLSTM gate (same padding as given):
+        dense: full conv
+        depthwise: depthwise k x k conv, then 1 x 1 conv (depthwise-separable)
+        grouped: conv with the largest number of groups, up to groups, that
+            divides both in and out channels (dense if there is none)
+        bottleneck: 1 x 1 conv down to out_channels // reduction channels,
+            then k x k conv
+    Convs before the k x k conv have no bias, so zero-padded inputs stay
+    zero and manual padding (get_conv_pad) is still 'same' padding.
+    """
+    if cell_type == 'dense':
+        return nn.Conv2d(in_channels,out_channels,kernel_size,1,padding,1,1,
+                         bias)
+    elif cell_type == 'depthwise':
+        depthwise = nn.Conv2d(in_channels,in_channels,kernel_size,1,padding,
+                              1,in_channels,False)
+        pointwise = nn.Conv2d(in_channels,out_channels,1,1,0,1,1,bias)
+        return nn.Sequential(depthwise,pointwise)
+    elif cell_type == 'grouped':
+        # e.g. 54 -> 48 channels with 4 groups: 2 groups
+        groups = math.gcd(math.gcd(in_channels,out_channels),groups)
+        return nn.Conv2d(in_channels,out_channels,kernel_size,1,padding,1,
+                         groups,bias)
+    elif cell_type == 'bottleneck':
+        mid_channels = max(out_channels // reduction,1)
+        reduce = nn.Conv2d(in_channels,mid_channels,1,1,0,1,1,False)
+        conv = nn.Conv2d(mid_channels,out_channels,kernel_size,1,padding,1,1,
+                         bias)
+        return nn.Sequential(reduce,conv)
+    raise ValueError("Unknown cell type %s" % cell_type)
+
+def pad_same(x,padding):
+    # Manual zero-padding with padding from get_conv_pad (None: done by conv)
+    if padding is None:
+        return x
+    return F.pad(x,padding)
+
+def get_memory_format(memory_format):
+    if memory_format == 'channels_last':
+        return torch.channels_last
+    elif memory_format == 'contiguous':
+        return torch.contiguous_format
+    raise ValueError("Unknown memory format: %s" % memory_format)
+
+def sequence_to_memory_format(X,memory_format):
+    # Copy a (batch,len,channels,H,W) sequence once so that every frame
+    # X[:,t] is already in the memory format of the model
+    if memory_format == torch.channels_last:
+        return X.permute(0,1,3,4,2).contiguous().permute(0,1,4,2,3)
+    return X.contiguous()
+
+def zeros_state(X,size,memory_format):
+    # Zero state with the device and dtype of X, in the given memory format
+    return torch.empty(size,dtype=X.dtype,device=X.device,
+                       memory_format=memory_format).zero_()
+
+def get_outputs(output):
+    # Outputs requested from a model: one of 'error','pred','rep', or a
+    # collection of them (all computed in one forward pass)
+    if isinstance(output,str):
+        return {output}
+    return set(output)
+
+def select_outputs(outputs,output):
+    # Model return value: the single requested output, or a dict of outputs
+    if isinstance(output,str):
+        return outputs[output]
+    return outputs
+
+def detach_hidden(hidden):
+    # Detach nested lists/tuples of recurrent states from the graph (None kept)
+    if isinstance(hidden,torch.Tensor):
+        return hidden.detach()
+    elif isinstance(hidden,(list,tuple)):
+        return type(hidden)(detach_hidden(h) for h in hidden)
+    return hidden
+
+def map_structure(fn,*structures):
+    # Apply fn to the tensors of nested lists/tuples of tensors (or None)
+    first = structures[0]
+    if first is None:
+        return None
+    if isinstance(first,(list,tuple)):
+        return type(first)(map_structure(fn,*items)
+                           for items in zip(*structures))
+    return fn(*structures)
+
+def is_laddernet(model):
+    from Ladder import LadderNet # Ladder imports utils
+    return isinstance(model,LadderNet)
+
+def initial_hidden(model,X):
+    # Zero states of model.step for X (LadderNet has no predictions yet)
+    if is_laddernet(model):
+        return (model.initialize(X),None)
+    return model.initialize(X)
+
+def step_pred(model,outputs):
+    # Layer 0 prediction from the outputs of model.step
+    Ahat = outputs[2]
+    return Ahat[0] if is_laddernet(model) else Ahat
+
+def input_cache_exact(model):
+    # Reusing input-side results across time steps gives exactly the same
+    # outputs, except when training with dropout (new mask every step) or
+    # batch norm (statistics updated every step)
+    if not model.training:
+        return True
+    for m in model.modules():
+        if isinstance(m,nn.Dropout) and m.p > 0:
+            return False
+        if isinstance(m,nn.modules.batchnorm._BatchNorm):
+            return False
+    return True
+
+def reuse_input(X,t,static_input):
+    # Whether input-side results of step t-1 can be reused on step t.
+    # static_input: 'never', 'detect' (bit-identical consecutive inputs), or
+    # 'always' (all inputs of a sequence are the same, e.g. CCN last_only)
+    if t == 0 or static_input == 'never':
+        return False
+    if static_input == 'always':
+        return True
+    return torch.equal(X[:,t],X[:,t-1])
+
+def compile_model(model):
+    # Compile in place so that attributes (e.g. model.output) and state_dict
+    # keys are unchanged
+    model.compile()
+    return model
+
+def bf16_autocast(device,enabled=True):
+    # Mixed precision context: conv-heavy ops run in bfloat16
+    device_type = torch.device(device).type
+    return torch.autocast(device_type=device_type,dtype=torch.bfloat16,
+                          enabled=enabled)